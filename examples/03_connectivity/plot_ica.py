@@ -29,16 +29,18 @@ from sammba.registration import TemplateRegistrator
 registrator = TemplateRegistrator(brain_volume=400, caching=True,
                                   template=dorr.t2, use_rats_tool=False,
                                   template_brain_mask=dorr_masks.brain,
-                                  registration_kind='affine')
+                                  registration_kind='affine',
+                                  output_dir='ica', n_jobs=-1)
 
-registered_funcs = []
-for anat, func in zip(retest.anat, retest.func):
-    animal_id = os.path.basename(os.path.dirname(anat))
-    registrator.output_dir = os.path.join('ica', animal_id)
-    registrator.fit_anat(anat)
-    registrator.fit_modality(func, 'func', t_r=1., voxel_size=(.3, .3, .3),
-                             prior_rigid_body_registration=True)
-    registered_funcs.append(registrator.registered_func_)
+##############################################################################
+# The template brain is computed once, then the animals are registered in
+# parallel, each one in its own subdirectory of the output directory.
+animal_ids = [os.path.basename(os.path.dirname(anat)) for anat in retest.anat]
+registered_funcs = registrator.fit_many(retest.anat, retest.func,
+                                        modality='func',
+                                        animal_ids=animal_ids,
+                                        t_r=1., voxel_size=(.3, .3, .3),
+                                        prior_rigid_body_registration=True)
 
 ##############################################################################
 # Run ICA
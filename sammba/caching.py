@@ -0,0 +1,484 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from nipype import config
+from nipype.caching import Memory
+from nipype.interfaces.base import specs
+from nipype.utils.filemanip import loadpkl
+from nilearn._utils.compat import _basestring
+
+
+_FINGERPRINT_METHODS = ['xxhash', 'stat']
+
+# Environment variable holding the cache root, so that it is inherited by
+# the worker processes
+_CACHE_DIR_VARIABLE = 'SAMMBA_CACHE_DIR'
+
+# Environment variable holding the fingerprint method, so that the worker
+# processes hash the cached steps inputs as the parent process
+_FINGERPRINT_METHOD_VARIABLE = 'SAMMBA_FINGERPRINT_METHOD'
+
+# Manifest of the pinned files, next to the nipype_mem directory
+_PINNED_FILES_MANIFEST = 'sammba_pinned_files.json'
+
+# Memoised fingerprints, per (path, method)
+_fingerprints = {}
+
+_nipype_hash_infile = specs.hash_infile
+_nipype_hash_method = None
+# Fingerprint method currently used by nipype within this process
+_applied_fingerprint_method = None
+
+
+def _stat_key(in_file):
+    stat = os.stat(in_file)
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+def _xxhash_file(in_file, chunk_size=1 << 20):
+    """ Streams the raw bytes of a file, without decompressing it, through
+    a 64 bits xxhash.
+    """
+    try:
+        import xxhash
+    except ImportError:
+        raise ImportError("The 'xxhash' fingerprint method requires the "
+                          "xxhash package to be installed.")
+
+    hasher = xxhash.xxh64()
+    with open(in_file, 'rb') as fp:
+        chunk = fp.read(chunk_size)
+        while chunk:
+            hasher.update(chunk)
+            chunk = fp.read(chunk_size)
+
+    return hasher.hexdigest()
+
+
+def _md5_file(in_file, chunk_size=1 << 20):
+    hasher = hashlib.md5()
+    with open(in_file, 'rb') as fp:
+        chunk = fp.read(chunk_size)
+        while chunk:
+            hasher.update(chunk)
+            chunk = fp.read(chunk_size)
+
+    return hasher.hexdigest()
+
+
+def _fingerprint(in_file, method):
+    in_file = os.path.abspath(in_file)
+    stat_key = _stat_key(in_file)
+    memoised = _fingerprints.get((in_file, method))
+    if memoised is not None and memoised[0] == stat_key:
+        return memoised[1]
+
+    if method == 'xxhash':
+        fingerprint = _xxhash_file(in_file)
+    elif method == 'md5':
+        fingerprint = _md5_file(in_file)
+    else:
+        fingerprint = hashlib.md5(
+            ' '.join([str(value) for value in stat_key]).encode()).hexdigest()
+
+    _fingerprints[(in_file, method)] = (stat_key, fingerprint)
+    return fingerprint
+
+
+def file_fingerprint(in_file, method='stat'):
+    """ Computes a cache key for a file. The fingerprint is memoised per
+    path for the life of the process and only recomputed when the size, the
+    modification time or the inode of the file change.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to an existing file.
+
+    method : one of {'xxhash', 'stat'}, optional
+        If 'xxhash', the raw file content is hashed with xxhash, which needs
+        the xxhash package. If 'stat', the fingerprint is made of the file
+        size, modification time and inode, and the file is never read.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest.
+    """
+    _check_fingerprint_method(method)
+    return _fingerprint(in_file, method)
+
+
+def _check_fingerprint_method(method):
+    if method not in _FINGERPRINT_METHODS:
+        raise ValueError('Fingerprint method must be one of {0}, you entered '
+                         '{1}'.format(_FINGERPRINT_METHODS, method))
+
+
+def _apply_fingerprint_method():
+    """ Makes nipype hash the file inputs of the cached steps with the
+    fingerprint method set by sammba.caching.set_fingerprint_method, which
+    is read from the environment so that the worker processes follow it.
+    """
+    global _nipype_hash_method, _applied_fingerprint_method
+
+    method = os.environ.get(_FINGERPRINT_METHOD_VARIABLE)
+    if method == _applied_fingerprint_method:
+        return
+
+    if method is None:
+        specs.hash_infile = _nipype_hash_infile
+        if _nipype_hash_method is not None:
+            config.set('execution', 'hash_method', _nipype_hash_method)
+            _nipype_hash_method = None
+        _applied_fingerprint_method = None
+        return
+
+    _check_fingerprint_method(method)
+
+    def hash_infile(afile, **kwargs):
+        if not os.path.isfile(afile):
+            return None
+        return file_fingerprint(afile, method=method)
+
+    specs.hash_infile = hash_infile
+    # nipype calls hash_infile only when hashing by content
+    if _nipype_hash_method is None:
+        _nipype_hash_method = config.get('execution', 'hash_method')
+    config.set('execution', 'hash_method', 'content')
+    _applied_fingerprint_method = method
+
+
+def set_fingerprint_method(method):
+    """ Sets how the file inputs of the steps cached with
+    nipype.caching.Memory are hashed to decide whether a step has already
+    been run. The setting holds for the whole process and the processes it
+    starts.
+
+    Parameters
+    ----------
+    method : one of {'xxhash', 'stat'} or None
+        Passed to sammba.caching.file_fingerprint. 'xxhash' hashes the raw
+        compressed files, which is much faster than nipype's content hashing
+        while detecting any change. 'stat' uses the file size, modification
+        time and inode. If None, nipype's own hashing is restored.
+    """
+    if method is None:
+        os.environ.pop(_FINGERPRINT_METHOD_VARIABLE, None)
+    else:
+        _check_fingerprint_method(method)
+        if method == 'xxhash':
+            # Fail now rather than within a cached step
+            _xxhash_file(os.devnull)
+        os.environ[_FINGERPRINT_METHOD_VARIABLE] = method
+    _apply_fingerprint_method()
+
+
+def set_cache_dir(cache_dir):
+    """ Sets a cache root shared by all the cached steps, instead of one
+    cache per output directory. Steps called with identical inputs, such as
+    the template brain extraction or the template resampling done by each
+    animal pipeline, are then computed once and reused by every pipeline.
+    The setting holds for the whole process and the processes it starts.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        Path to the cache root, created if needed. If None, each step is
+        cached within its own output directory.
+    """
+    if cache_dir is None:
+        os.environ.pop(_CACHE_DIR_VARIABLE, None)
+        return
+
+    cache_dir = os.path.abspath(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    os.environ[_CACHE_DIR_VARIABLE] = cache_dir
+
+
+def get_cache_dir():
+    """ Returns the shared cache root, or None if it has not been set.
+    """
+    return os.environ.get(_CACHE_DIR_VARIABLE)
+
+
+def _get_caching_environ():
+    """ Returns the caching settings held in the environment, to be passed
+    to worker processes possibly started before they were set.
+    """
+    return dict([(name, os.environ.get(name))
+                 for name in [_CACHE_DIR_VARIABLE,
+                              _FINGERPRINT_METHOD_VARIABLE]])
+
+
+def _set_caching_environ(caching_environ):
+    """ Sets the caching settings returned by _get_caching_environ.
+    """
+    for name, value in caching_environ.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    _apply_fingerprint_method()
+
+
+class _Memory(Memory):
+    """ nipype.caching.Memory which also updates the modification time of
+    the directory of each called step, cached or not, to track the least
+    recently used ones.
+    """
+    def _log_name(self, dir_name, job_name):
+        super(_Memory, self)._log_name(dir_name, job_name)
+        job_dir = os.path.join(self.base_dir, dir_name, job_name)
+        if os.path.isdir(job_dir):
+            os.utime(job_dir, None)
+
+
+def _get_cache_base_dir(write_dir):
+    """ Returns the directory holding the nipype_mem cache of the steps
+    writing to the given directory.
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return write_dir
+
+    return cache_dir
+
+
+def _get_memory(write_dir):
+    """ Returns the nipype.caching.Memory for steps writing to the given
+    directory, within the shared cache root if one is set. The file inputs
+    are hashed with the fingerprint method set in the environment.
+    """
+    _apply_fingerprint_method()
+    return _Memory(_get_cache_base_dir(write_dir))
+
+
+def _shared_write_dir(in_files, write_dir, **parameters):
+    """ Returns the directory to write the outputs of a step which does not
+    depend on the animal, such as a template preprocessing. With a shared
+    cache root, it is a subdirectory of the root addressed by the content
+    of the input files and the step parameters, so that the output paths and
+    hence the cache entries of identical calls match across pipelines.
+
+    Parameters
+    ----------
+    in_files : list of str or None
+        Paths to the input files. None values are ignored.
+
+    write_dir : str
+        Output directory used when no shared cache root is set.
+
+    parameters : dict
+        JSON serializable parameters of the step.
+
+    Returns
+    -------
+    str
+        Path to the existing output directory.
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return write_dir
+
+    key = [_fingerprint(in_file, 'md5') for in_file in in_files
+           if in_file is not None]
+    key.append(json.dumps(parameters, sort_keys=True))
+    digest = hashlib.md5(' '.join(key).encode()).hexdigest()
+    shared_dir = os.path.join(cache_dir, 'shared', digest)
+    try:
+        os.makedirs(shared_dir)
+    except OSError:
+        # Possibly created meanwhile by a concurrent pipeline
+        if not os.path.isdir(shared_dir):
+            raise
+    return shared_dir
+
+
+def _read_pinned_files(cache_dir):
+    manifest_file = os.path.join(cache_dir, _PINNED_FILES_MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return []
+
+    with open(manifest_file, 'r') as fp:
+        return json.load(fp)
+
+
+def pin_files(files, cache_dir):
+    """ Protects files from the eviction done by sammba.caching.prune_cache.
+
+    Parameters
+    ----------
+    files : list of str or None
+        Paths to the files to keep, typically the final transforms of a
+        pipeline. None values are ignored.
+
+    cache_dir : str
+        Directory holding the nipype_mem cache of the steps which produced
+        the files.
+    """
+    pinned_files = set(_read_pinned_files(cache_dir))
+    pinned_files.update([os.path.abspath(path) for path in files
+                         if path is not None])
+
+    # Write then rename, so that a crash never leaves a truncated manifest
+    manifest_file = os.path.join(cache_dir, _PINNED_FILES_MANIFEST)
+    tmp_manifest_file = manifest_file + '.tmp'
+    with open(tmp_manifest_file, 'w') as fp:
+        json.dump(sorted(pinned_files), fp, indent=2)
+    os.rename(tmp_manifest_file, manifest_file)
+
+
+def _list_output_files(value):
+    """ Lists the absolute paths among nested outputs values.
+    """
+    if isinstance(value, (list, tuple)):
+        files = []
+        for item in value:
+            files.extend(_list_output_files(item))
+        return files
+
+    if isinstance(value, _basestring) and os.path.isabs(value):
+        return [value]
+
+    return []
+
+
+def _get_cache_entries(cache_dir):
+    """ Lists the steps cached in the nipype_mem directory of the given
+    directory, with their files, size and last use time.
+    """
+    memory_dir = os.path.join(os.path.abspath(cache_dir), 'nipype_mem')
+    entries = []
+    if not os.path.isdir(memory_dir):
+        return entries
+
+    for dir_name in sorted(os.listdir(memory_dir)):
+        interface_dir = os.path.join(memory_dir, dir_name)
+        if dir_name.startswith('log.') or not os.path.isdir(interface_dir):
+            continue
+
+        for job_name in sorted(os.listdir(interface_dir)):
+            job_dir = os.path.join(interface_dir, job_name)
+            if not os.path.isdir(job_dir):
+                continue
+
+            files = []
+            for root, _, filenames in os.walk(job_dir):
+                files.extend([os.path.join(root, filename)
+                              for filename in filenames])
+
+            # Outputs written outside the step directory
+            result_file = os.path.join(job_dir,
+                                       'result_{}.pklz'.format(job_name))
+            if os.path.isfile(result_file):
+                try:
+                    outputs = loadpkl(result_file).outputs.get()
+                except Exception:
+                    outputs = {}
+                for value in outputs.values():
+                    files.extend([
+                        path for path in _list_output_files(value)
+                        if os.path.isfile(path) and
+                        not path.startswith(job_dir + os.sep)])
+
+            entries.append({'dir': job_dir,
+                            'files': set(files),
+                            'last_used': os.path.getmtime(job_dir)})
+
+    return entries
+
+
+def prune_cache(cache_dir, max_bytes=None, max_age=None, dry_run=False,
+                verbose=True):
+    """ Evicts cached steps, together with their output files, to bound the
+    disk space used by a nipype_mem cache. Steps not used for more than
+    `max_age` days are evicted first, then the least recently used ones
+    until the cache fits within `max_bytes`. Steps producing files pinned
+    with sammba.caching.pin_files are never evicted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the nipype_mem cache, that is the output
+        directory of the cached steps or the shared cache root.
+
+    max_bytes : int or None, optional
+        Budget in bytes. If None, the size of the cache is not limited.
+
+    max_age : float or None, optional
+        Maximal time in days since the last use of a step. If None, steps
+        are not evicted based on their age.
+
+    dry_run : bool, optional
+        If True, nothing is removed.
+
+    verbose : bool, optional
+        If True, the evicted steps are printed.
+
+    Returns
+    -------
+    evicted : list of str
+        Paths to the directories of the evicted steps.
+    """
+    entries = _get_cache_entries(cache_dir)
+
+    # Any file of a step producing a pinned file is kept
+    pinned_files = set(_read_pinned_files(cache_dir))
+    protected_files = set()
+    for entry in entries:
+        if entry['files'] & pinned_files:
+            protected_files.update(entry['files'])
+
+    sizes = {}
+    for entry in entries:
+        for path in entry['files']:
+            sizes[path] = os.path.getsize(path)
+    total_bytes = sum(sizes.values())
+
+    to_evict = []
+    removed_files = set()
+    oldest_time = None
+    if max_age is not None:
+        oldest_time = time.time() - max_age * 24 * 3600.
+    for entry in sorted(entries, key=lambda entry: entry['last_used']):
+        if entry['files'] & protected_files:
+            continue
+        too_old = oldest_time is not None and \
+            entry['last_used'] < oldest_time
+        over_budget = max_bytes is not None and total_bytes > max_bytes
+        if not (too_old or over_budget):
+            continue
+        to_evict.append(entry)
+        new_files = entry['files'] - removed_files
+        total_bytes -= sum([sizes[path] for path in new_files])
+        removed_files.update(new_files)
+
+    # Steps referencing removed outputs are no more valid
+    evicted_dirs = set([entry['dir'] for entry in to_evict])
+    n_evicted = None
+    while n_evicted != len(to_evict):
+        n_evicted = len(to_evict)
+        for entry in entries:
+            if entry['dir'] not in evicted_dirs and \
+                    entry['files'] & removed_files and \
+                    not entry['files'] & protected_files:
+                to_evict.append(entry)
+                evicted_dirs.add(entry['dir'])
+                removed_files.update(entry['files'])
+
+    for entry in to_evict:
+        if verbose:
+            print('Evicting {0}'.format(entry['dir']))
+        if dry_run:
+            continue
+        for path in entry['files']:
+            if os.path.isfile(path):
+                os.remove(path)
+        if os.path.isdir(entry['dir']):
+            shutil.rmtree(entry['dir'])
+
+    return sorted(evicted_dirs)
@@ -0,0 +1,91 @@
+"""
+Command line interface of sammba, installed as the `sammba` command.
+"""
+import sys
+import argparse
+from .caching import get_cache_dir, prune_cache
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+
+def _parse_size(size):
+    """ Converts a size such as '500M' or '20G' to bytes.
+    """
+    size = size.strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    unit = ''
+    if size and size[-1] in _SIZE_UNITS:
+        unit = size[-1]
+        size = size[:-1]
+    try:
+        return int(float(size) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Size must be a number of bytes with an optional K, M, G or T '
+            'suffix, you entered {0}'.format(size + unit))
+
+
+def _prune(args):
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if cache_dir is None:
+        raise ValueError('No cache directory given and no shared cache '
+                         'root set')
+
+    evicted = prune_cache(cache_dir, max_bytes=args.max_size,
+                          max_age=args.max_age, dry_run=args.dry_run,
+                          verbose=args.verbose)
+    print('{0} cached steps evicted from {1}'.format(len(evicted),
+                                                     cache_dir))
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(prog='sammba')
+    subparsers = parser.add_subparsers(dest='command')
+    cache_parser = subparsers.add_parser(
+        'cache', help='Manage the cache of the pipelines steps')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command')
+    prune_parser = cache_subparsers.add_parser(
+        'prune', help='Evict the least recently used cached steps, except '
+                      'the ones producing pinned final transforms')
+    prune_parser.add_argument(
+        'cache_dir', nargs='?', default=None,
+        help='Directory holding the nipype_mem cache. Defaults to the '
+             'shared cache root, set by the SAMMBA_CACHE_DIR environment '
+             'variable.')
+    prune_parser.add_argument(
+        '--max-size', type=_parse_size, default=None,
+        help='Budget of the cache, such as 500M or 20G')
+    prune_parser.add_argument(
+        '--max-age', type=float, default=None,
+        help='Maximal number of days since the last use of a cached step')
+    prune_parser.add_argument(
+        '--dry-run', action='store_true',
+        help='List the steps to evict without removing anything')
+    prune_parser.add_argument('--verbose', action='store_true',
+                              help='Print the evicted steps')
+    prune_parser.set_defaults(function=_prune)
+    return parser
+
+
+def main(argv=None):
+    """ Entry point of the `sammba` command.
+    """
+    parser = _get_parser()
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'function'):
+        parser.print_help()
+        return 1
+
+    try:
+        args.function(args)
+    except ValueError as error:
+        parser.error(str(error))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,138 @@
 import os
 from nipype.interfaces import afni
+from nipype.interfaces.utility import Function, IdentityInterface
+from nipype.utils.filemanip import fname_presuffix
 import nipype.pipeline.engine as pe
+from sklearn.datasets.base import Bunch
 from sammba.segmentation import interfaces
+from sammba.preprocessing.bias_correction import _equivalent_unifize_kwargs
 
 
-def create_pipeline_graph(pipeline_name, graph_file,
-                          graph_kind='hierarchical'):
-    """Creates pipeline graph for a given piepline.
+def _to_int(values):
+    """ Casts the clip levels to integers, as expected by the brain mask
+    computation.
+    """
+    return [int(value) for value in values]
+
+
+def _suffixed_basenames(in_files, suffix):
+    """ Returns the base names of the given files with the given suffix,
+    to name the outputs within the node directories.
+    """
+    from nipype.utils.filemanip import split_filename
+
+    return [split_filename(in_file)[1] + suffix for in_file in in_files]
+
+
+def _listify(in_files):
+    return [[in_file] for in_file in in_files]
+
+
+def _pair_transforms(rigid_transform_files, affine_transform_files):
+    """ Pairs the rigid and affine transforms of each individual, for their
+    concatenation.
+    """
+    return [[(rigid_file, 'ONELINE'), (affine_file, 'ONELINE')]
+            for rigid_file, affine_file in zip(rigid_transform_files,
+                                               affine_transform_files)]
+
+
+def _pair_initial_warps(head_files, affine_transform_files):
+    """ Pairs the identity warp on each head with its affine transform, to
+    initialize the non-linear registration.
+    """
+    return [[('IDENT', head_file), affine_file]
+            for head_file, affine_file in zip(head_files,
+                                              affine_transform_files)]
+
+
+def _add_average(workflow, node, name, terminal_output, verbosity_kwargs,
+                 output_name='out_file'):
+    """ Adds the concatenation across individuals of a node outputs, for
+    quality check, and the computation of their mean.
+
+    Returns
+    -------
+    2-tuple of nipype.pipeline.engine.Node : The concatenation and the mean
+        nodes.
+    """
+    tcat = pe.Node(afni.TCat(out_file='{}.nii.gz'.format(name),
+                             outputtype='NIFTI_GZ',
+                             terminal_output=terminal_output,
+                             **verbosity_kwargs),
+                   name='concatenate_{}'.format(name))
+    tstat = pe.Node(afni.TStat(outputtype='NIFTI_GZ',
+                               terminal_output=terminal_output),
+                    name='average_{}'.format(name))
+    workflow.connect(node, output_name, tcat, 'in_files')
+    workflow.connect(tcat, 'out_file', tstat, 'in_file')
+    return tcat, tstat
+
+
+def create_pipeline_workflow(pipeline_name, anat_filenames=None,
+                             brain_volume=None, use_rats_tool=True,
+                             nonlinear_levels=[1, 2, 3],
+                             nonlinear_minimal_patches=[75],
+                             nonlinear_weight_file=None,
+                             convergence=0.005, blur_radius_coarse=1.1,
+                             verbose=1, unifize_kwargs=None,
+                             brain_masking_unifize_kwargs=None):
+    """Creates the nipype workflow of a given pipeline, doing the same steps
+    as sammba.registration.anats_to_common.
 
     Parameters
     ----------
-    pipeline_name : one of {'anat_to_common_rigid', 'anat_to_common_affine',
-        'anat_to_common_nonlinear'}
+    pipeline_name : one of {'anats_to_common_rigid', 'anats_to_common_affine',
+        'anats_to_common_nonlinear'}
         Pipeline name.
 
-    graph_file : str.
-        Path to save the graph image to.
+    anat_filenames : list of str or None, optional
+        Paths to the anatomical images. If None, the inputs are left
+        undefined, which is enough to draw the pipeline graph.
 
-    graph_kind : one of {'orig', 'hierarchical', 'flat', 'exec', 'colored'}, optional.
-        The kind of the graph, passed to
-        nipype.pipeline.workflows.Workflow().write_graph
+    brain_volume : int or None, optional
+        Volume of the brain in mm3 used for brain extraction.
+        Typically 400 for mouse and 1800 for rat.
+
+    use_rats_tool : bool, optional
+        If True, brain mask is computed using RATS Mathematical Morphology.
+        Otherwise, a histogram-based brain segmentation is used.
+
+    nonlinear_levels : list of int, optional
+        Maximal levels for each nonlinear warping iteration. Passed iteratively
+        to nipype.interfaces.afni.Qwarp
+
+    nonlinear_minimal_patches : list of int, optional
+        Minimal patches for the final nonlinear warps, passed to
+        nipype.interfaces.afni.Qwarp
+
+    nonlinear_weight_file : str, optional
+        Path to a mask used to weight non-linear registration.
+
+    convergence : float, optional
+        Convergence limit, passed to nipype.interfaces.afni.Allineate
+
+    blur_radius_coarse : float, optional
+        Radius passed to nipype.interfaces.afni.Allineate for
+        the "-twoblur" option
+
+    verbose : int, optional
+        Verbosity level.
+
+    unifize_kwargs : dict, optional
+        Is passed to nipype.interfaces.afni.Unifize, to
+        control bias correction of the template.
+
+    brain_masking_unifize_kwargs : dict, optional
+        Is passed to nipype.interfaces.afni.Unifize, to tune
+        the seperate bias correction step done prior to brain masking.
+
+    Returns
+    -------
+    workflow : nipype.pipeline.engine.Workflow
+        The pipeline workflow. Its node 'outputnode' has the fields
+        `registered` and `transforms`, as returned by
+        sammba.registration.anats_to_common
     """
     pipeline_names = ['anats_to_common_rigid', 'anats_to_common_affine',
                       'anats_to_common_nonlinear']
@@ -27,105 +140,448 @@ def create_pipeline_graph(pipeline_name, graph_file,
         raise NotImplementedError(
             'Pipeline name must be one of {0}, you entered {1}'.format(
                 pipeline_names, pipeline_name))
-    graph_kinds = ['orig', 'hierarchical', 'flat', 'exec', 'colored']
-    if graph_kind not in graph_kinds:
-        raise ValueError(
-            'Graph kind must be one of {0}, you entered {1}'.format(
-                graph_kinds, graph_kind))
+
+    if use_rats_tool:
+        ComputeMask = interfaces.MathMorphoMask
+    else:
+        ComputeMask = interfaces.HistogramMask
+
+    if verbose:
+        terminal_output = 'stream'
+        verbosity_kwargs = {'verbose': verbose > 1}
+        quietness_kwargs = {}
+        verb_quietness_kwargs = {'verb': verbose > 2}
+        verbosity_quietness_kwargs = {'verbose': verbose > 2}
+    else:
+        terminal_output = 'none'
+        verbosity_kwargs = {}
+        quietness_kwargs = {'quiet': True}
+        verb_quietness_kwargs = {'quiet': True}
+        verbosity_quietness_kwargs = {'quiet': True}
+
+    if brain_masking_unifize_kwargs is None:
+        brain_masking_unifize_kwargs = {}
+    brain_masking_unifize_kwargs = dict(brain_masking_unifize_kwargs,
+                                        **quietness_kwargs)
+    if unifize_kwargs is None:
+        unifize_kwargs = {}
+    unifize_kwargs = dict(unifize_kwargs, **quietness_kwargs)
 
     workflow = pe.Workflow(name=pipeline_name)
+    output_node = pe.Node(IdentityInterface(fields=['registered',
+                                                    'transforms']),
+                          name='outputnode')
 
     #######################################################################
-    # Specify rigid body registration pipeline steps
-    unifize = pe.Node(interface=afni.Unifize(), name='bias_correct')
-    clip_level = pe.Node(interface=afni.ClipLevel(),
-                         name='compute_mask_threshold')
-    compute_mask = pe.Node(interface=interfaces.MathMorphoMask(),
-                           name='compute_brain_mask')
-    apply_mask = pe.Node(interface=afni.Calc(), name='apply_brain_mask')
-    center_mass = pe.Node(interface=afni.CenterMass(),
-                          name='compute_and_set_cm_in_header')
-    refit_copy = pe.Node(afni.Refit(), name='copy_cm_in_header')
-    tcat1 = pe.Node(afni.TCat(), name='concatenate_across_individuals1')
-    tstat1 = pe.Node(afni.TStat(), name='compute_average1')
-    undump = pe.Node(afni.Undump(), name='create_empty_template')
-    refit_set = pe.Node(afni.Refit(), name='set_cm_in_header')
-    resample1 = pe.Node(afni.Resample(), name='resample1')
-    resample2 = pe.Node(afni.Resample(), name='resample2')
-    shift_rotate = pe.Node(afni.Allineate(), name='shift_rotate')
-    apply_allineate1 = pe.Node(afni.Allineate(), name='apply_transform1')
-    tcat2 = pe.Node(afni.TCat(), name='concatenate_across_individuals2')
-    tstat2 = pe.Node(afni.TStat(), name='compute_average2')
-    tcat3 = pe.Node(afni.TCat(), name='concatenate_across_individuals3')
-    tstat3 = pe.Node(afni.TStat(), name='compute_average3')
-
-    workflow.add_nodes([unifize, clip_level, compute_mask, apply_mask,
-                        center_mass,
-                        refit_copy, tcat1, tstat1, undump, refit_set,
-                        resample1, resample2, shift_rotate, apply_allineate1,
-                        tcat2, tstat2, tcat3, tstat3])
+    # Bias correct, extract the brain and set its center of mass as the
+    # image center, for each individual
+    copy = pe.MapNode(afni.Copy(terminal_output=terminal_output,
+                                **verbosity_kwargs),
+                      iterfield=['in_file', 'out_file'], name='copy')
+    if anat_filenames is not None:
+        copy.inputs.in_file = anat_filenames
+        copy.inputs.out_file = [
+            os.path.basename(fname_presuffix(anat_file,
+                                             suffix='_{}'.format(n)))
+            for n, anat_file in enumerate(anat_filenames)]
 
-    #######################################################################
-    # and connections
-    workflow.connect(unifize, 'out_file', clip_level, 'in_file')
-    workflow.connect(clip_level, 'clip_val',
+    unifize_for_masking = pe.MapNode(
+        afni.Unifize(out_file='%s_Unifized_for_brain_masking',
+                     outputtype='NIFTI_GZ', terminal_output=terminal_output,
+                     **brain_masking_unifize_kwargs),
+        iterfield=['in_file'], name='bias_correct_for_brain_masking')
+    clip_level = pe.MapNode(afni.ClipLevel(), iterfield=['in_file'],
+                            name='compute_mask_threshold')
+    compute_mask = pe.MapNode(ComputeMask(),
+                              iterfield=['in_file', 'intensity_threshold'],
+                              name='compute_brain_mask')
+    if brain_volume is not None:
+        compute_mask.inputs.volume_threshold = brain_volume
+    if _equivalent_unifize_kwargs(brain_masking_unifize_kwargs,
+                                  unifize_kwargs):
+        # The same bias correction is used for both roles
+        unifize = unifize_for_masking
+    else:
+        unifize = pe.MapNode(
+            afni.Unifize(out_file='%s_Unifized_for_brain_extraction',
+                         outputtype='NIFTI_GZ',
+                         terminal_output=terminal_output,
+                         **unifize_kwargs),
+            iterfield=['in_file'], name='bias_correct')
+    apply_mask = pe.MapNode(afni.Calc(expr='a*b', outputtype='NIFTI_GZ',
+                                      terminal_output=terminal_output),
+                            iterfield=['in_file_a', 'in_file_b'],
+                            name='apply_brain_mask')
+    center_mass = pe.MapNode(afni.CenterMass(set_cm=(0, 0, 0)),
+                             iterfield=['in_file'],
+                             name='compute_and_set_cm_in_header')
+    refit_copy = pe.MapNode(afni.Refit(terminal_output=terminal_output),
+                            iterfield=['in_file', 'duporigin_file'],
+                            name='copy_cm_in_header')
+
+    workflow.connect(copy, 'out_file', unifize_for_masking, 'in_file')
+    workflow.connect(unifize_for_masking, 'out_file', clip_level, 'in_file')
+    workflow.connect(clip_level, ('clip_val', _to_int),
                      compute_mask, 'intensity_threshold')
-    workflow.connect(unifize, 'out_file', compute_mask, 'in_file')
-    workflow.connect(compute_mask, 'out_file', apply_mask, 'in_file_a')
-    workflow.connect(unifize, 'out_file', apply_mask, 'in_file_b')
-    workflow.connect(apply_mask, 'out_file',
-                     center_mass, 'in_file')
+    workflow.connect(unifize_for_masking, 'out_file', compute_mask, 'in_file')
+    if unifize is not unifize_for_masking:
+        workflow.connect(copy, 'out_file', unifize, 'in_file')
+    workflow.connect(unifize, 'out_file', apply_mask, 'in_file_a')
+    workflow.connect(compute_mask, 'out_file', apply_mask, 'in_file_b')
+    workflow.connect(apply_mask, 'out_file', center_mass, 'in_file')
     workflow.connect(unifize, 'out_file', refit_copy, 'in_file')
-    workflow.connect(center_mass, 'out_file',
-                     refit_copy, 'duporigin_file')
-    workflow.connect(center_mass, 'out_file', tcat1, 'in_files')
-    workflow.connect(tcat1, 'out_file', tstat1, 'in_file')
-    workflow.connect(tstat1, 'out_file', undump, 'in_file')
+    workflow.connect(center_mass, 'out_file', refit_copy, 'duporigin_file')
+
+    #######################################################################
+    # Shift brains and heads to place their centers at the center of an
+    # empty template
+    tcat_raw, tstat_raw = _add_average(workflow, copy, 'raw_heads',
+                                       terminal_output, verbosity_kwargs)
+    undump = pe.Node(afni.Undump(out_file='undump.nii.gz',
+                                 outputtype='NIFTI_GZ',
+                                 terminal_output=terminal_output),
+                     name='create_empty_template')
+    refit_set = pe.Node(afni.Refit(xorigin='cen', yorigin='cen',
+                                   zorigin='cen',
+                                   terminal_output=terminal_output),
+                        name='set_cm_in_header')
+    resample_brains = pe.MapNode(
+        afni.Resample(resample_mode='Cu', outputtype='NIFTI_GZ',
+                      terminal_output=terminal_output),
+        iterfield=['in_file'], name='center_brains')
+    resample_heads = pe.MapNode(
+        afni.Resample(resample_mode='Cu', outputtype='NIFTI_GZ',
+                      terminal_output=terminal_output),
+        iterfield=['in_file'], name='center_heads')
+
+    workflow.connect(tstat_raw, 'out_file', undump, 'in_file')
     workflow.connect(undump, 'out_file', refit_set, 'in_file')
-    workflow.connect(refit_set, 'out_file', resample1, 'master')
-    workflow.connect(refit_copy, 'out_file', resample1, 'in_file')
-    workflow.connect(refit_set, 'out_file', resample2, 'master')
-    workflow.connect(center_mass, 'out_file', resample2, 'in_file')
-    workflow.connect(resample2, 'out_file', tcat2, 'in_files')
-    workflow.connect(tcat2, 'out_file', tstat2, 'in_file')
-    workflow.connect(tstat2, 'out_file', shift_rotate, 'reference')
-    workflow.connect(resample2, 'out_file', shift_rotate, 'in_file')
-    workflow.connect(tstat2, 'out_file', apply_allineate1, 'master')
-    workflow.connect(resample1, 'out_file',
-                     apply_allineate1, 'in_file')
+    workflow.connect(refit_set, 'out_file', resample_brains, 'master')
+    workflow.connect(center_mass, 'out_file', resample_brains, 'in_file')
+    workflow.connect(refit_set, 'out_file', resample_heads, 'master')
+    workflow.connect(refit_copy, 'out_file', resample_heads, 'in_file')
+    _add_average(workflow, resample_brains, 'centered_brains', terminal_output,
+                 verbosity_kwargs)
+    _, tstat_centered_heads = _add_average(
+        workflow, resample_heads, 'centered_heads', terminal_output,
+        verbosity_kwargs)
+
+    #######################################################################
+    # Rigid-body registration of the brains to the mean centered head and
+    # application to the heads
+    shift_rotate = pe.MapNode(
+        afni.Allineate(convergence=convergence, two_blur=blur_radius_coarse,
+                       warp_type='shift_rotate',
+                       terminal_output=terminal_output,
+                       **verbosity_quietness_kwargs),
+        iterfield=['in_file', 'out_matrix', 'out_file'], name='shift_rotate')
+    apply_shift_rotate = pe.MapNode(
+        afni.Allineate(terminal_output=terminal_output,
+                       **verbosity_quietness_kwargs),
+        iterfield=['in_file', 'in_matrix', 'out_file'],
+        name='apply_shift_rotate')
+
+    workflow.connect(resample_brains, 'out_file', shift_rotate, 'in_file')
+    workflow.connect(tstat_centered_heads, 'out_file',
+                     shift_rotate, 'reference')
+    workflow.connect(resample_brains,
+                     ('out_file', _suffixed_basenames, '_shr.aff12.1D'),
+                     shift_rotate, 'out_matrix')
+    workflow.connect(resample_brains,
+                     ('out_file', _suffixed_basenames, '_shr.nii.gz'),
+                     shift_rotate, 'out_file')
+    workflow.connect(resample_heads, 'out_file',
+                     apply_shift_rotate, 'in_file')
+    workflow.connect(tstat_centered_heads, 'out_file',
+                     apply_shift_rotate, 'master')
     workflow.connect(shift_rotate, 'out_matrix',
-                     apply_allineate1, 'in_matrix')
-    workflow.connect(apply_allineate1, 'out_file', tcat3, 'in_files')
-    workflow.connect(tcat3, 'out_file', tstat3, 'in_file')
-    if pipeline_name in ['anats_to_common_affine',
-                         'anat_to_common_nonlinear']:
-        mask = pe.Node(afni.MaskTool(), name='generate_count_mask')
-        allineate = pe.Node(afni.Allineate(), name='allineate')
-        catmatvec = pe.Node(afni.CatMatvec(), name='concatenate_transforms')
-        apply_allineate2 = pe.Node(afni.Allineate(), name='apply_transform2')
-        tcat3 = pe.Node(
-            afni.TCat(), name='concatenate_across_individuals4')
-        tstat3 = pe.Node(afni.TStat(), name='compute_average4')
-
-        workflow.add_nodes([mask, allineate, catmatvec, apply_allineate2,
-                            tcat3, tstat3])
-
-        workflow.connect(tcat2, 'out_file', mask, 'in_file')
-        workflow.connect(mask, 'out_file', allineate, 'weight')
-        workflow.connect(apply_allineate1, 'out_file',
-                         allineate, 'in_file')
-        workflow.connect(allineate, 'out_matrix',
-                         catmatvec, 'in_file')
-        #XXX how can we enter multiple files ? 
+                     apply_shift_rotate, 'in_matrix')
+    workflow.connect(resample_heads,
+                     ('out_file', _suffixed_basenames, '_shr.nii.gz'),
+                     apply_shift_rotate, 'out_file')
+    _add_average(workflow, apply_shift_rotate, 'rigid_body_registered_heads',
+                 terminal_output, verbosity_kwargs)
+    tcat_shr_brains, tstat_shr_brains = _add_average(
+        workflow, shift_rotate, 'rigid_body_registered_brains',
+        terminal_output, verbosity_kwargs)
+
+    if pipeline_name == 'anats_to_common_rigid':
+        workflow.connect(apply_shift_rotate, 'out_file',
+                         output_node, 'registered')
+        workflow.connect(shift_rotate, 'out_matrix',
+                         output_node, 'transforms')
+        return workflow
+
+    #######################################################################
+    # Affine registration of the heads, weighted by the brains count mask,
+    # and concatenation with the rigid-body transforms
+    count_mask = pe.Node(afni.MaskTool(count=True, verbose=verbose,
+                                       outputtype='NIFTI_GZ',
+                                       terminal_output=terminal_output),
+                         name='generate_count_mask')
+    allineate = pe.MapNode(
+        afni.Allineate(convergence=convergence, two_blur=blur_radius_coarse,
+                       one_pass=True, terminal_output=terminal_output,
+                       **verbosity_quietness_kwargs),
+        iterfield=['in_file', 'out_matrix', 'out_file'], name='allineate')
+    pair_transforms = pe.Node(
+        Function(input_names=['rigid_transform_files',
+                              'affine_transform_files'],
+                 output_names=['in_files'], function=_pair_transforms),
+        name='pair_transforms')
+    catmatvec = pe.MapNode(afni.CatMatvec(terminal_output=terminal_output),
+                           iterfield=['in_file', 'out_file'],
+                           name='concatenate_transforms')
+    apply_affine_brains = pe.MapNode(
+        afni.Allineate(terminal_output=terminal_output,
+                       **verbosity_quietness_kwargs),
+        iterfield=['in_file', 'in_matrix', 'out_file'],
+        name='apply_affine_to_brains')
+    apply_affine_heads = pe.MapNode(
+        afni.Allineate(terminal_output=terminal_output,
+                       **verbosity_quietness_kwargs),
+        iterfield=['in_file', 'in_matrix', 'out_file'],
+        name='apply_affine_to_heads')
+
+    workflow.connect(tcat_shr_brains, 'out_file', count_mask, 'in_file')
+    workflow.connect(apply_shift_rotate, 'out_file', allineate, 'in_file')
+    workflow.connect(tstat_shr_brains, 'out_file', allineate, 'reference')
+    workflow.connect(count_mask, 'out_file', allineate, 'weight')
+    workflow.connect(apply_shift_rotate,
+                     ('out_file', _suffixed_basenames, '_affine.aff12.1D'),
+                     allineate, 'out_matrix')
+    workflow.connect(apply_shift_rotate,
+                     ('out_file', _suffixed_basenames, '_affine.nii.gz'),
+                     allineate, 'out_file')
+    workflow.connect(shift_rotate, 'out_matrix',
+                     pair_transforms, 'rigid_transform_files')
+    workflow.connect(allineate, 'out_matrix',
+                     pair_transforms, 'affine_transform_files')
+    workflow.connect(pair_transforms, 'in_files', catmatvec, 'in_file')
+    workflow.connect(apply_shift_rotate,
+                     ('out_file', _suffixed_basenames,
+                      '_affine_catenated.aff12.1D'),
+                     catmatvec, 'out_file')
+    for apply_affine, centered in [(apply_affine_brains, resample_brains),
+                                   (apply_affine_heads, resample_heads)]:
+        workflow.connect(centered, 'out_file', apply_affine, 'in_file')
+        workflow.connect(tstat_shr_brains, 'out_file', apply_affine, 'master')
+        workflow.connect(catmatvec, 'out_file', apply_affine, 'in_matrix')
+        workflow.connect(centered,
+                         ('out_file', _suffixed_basenames,
+                          '_shr_affine_catenated.nii.gz'),
+                         apply_affine, 'out_file')
+    _, tstat_affine_heads = _add_average(
+        workflow, apply_affine_heads, 'affine_registered_heads',
+        terminal_output, verbosity_kwargs)
+    _add_average(workflow, apply_affine_brains, 'affine_registered_brains',
+                 terminal_output, verbosity_kwargs)
+
+    if pipeline_name == 'anats_to_common_affine':
+        workflow.connect(apply_affine_heads, 'out_file',
+                         output_node, 'registered')
+        workflow.connect(catmatvec, 'out_file', output_node, 'transforms')
+        return workflow
+
+    #######################################################################
+    # Successive cycles of non-linear registration of the centered heads
+    # to the mean of the warped heads
+    if nonlinear_weight_file is None:
+        union_mask = pe.Node(
+            afni.MaskTool(union=True, verbose=verbose,
+                          out_file='affine_registered_brains_unionmask.nii.gz',
+                          outputtype='NIFTI_GZ',
+                          terminal_output=terminal_output),
+            name='generate_union_mask')
+        dilated_mask = pe.Node(
+            afni.MaskTool(
+                dilate_inputs='4', verbose=verbose,
+                out_file='affine_registered_brains_unionmask_dil4.nii.gz',
+                outputtype='NIFTI_GZ', terminal_output=terminal_output),
+            name='dilate_union_mask')
+        workflow.connect(tcat_shr_brains, 'out_file',
+                         union_mask, 'in_file')
+        workflow.connect(union_mask, 'out_file', dilated_mask, 'in_file')
+        weight = (dilated_mask, 'out_file')
+    else:
+        weight = None
+
+    if nonlinear_levels is None:
+        nonlinear_levels = [1, 2, 3]
+    if nonlinear_minimal_patches is None:
+        nonlinear_minimal_patches = []
+
+    common_head = (tstat_affine_heads, 'out_file')
+    if nonlinear_levels:
+        pair_warps = pe.Node(
+            Function(input_names=['head_files', 'affine_transform_files'],
+                     output_names=['in_files'],
+                     function=_pair_initial_warps),
+            name='pair_initial_warps')
+        nwarp_cat = pe.MapNode(afni.NwarpCat(terminal_output=terminal_output),
+                               iterfield=['in_files', 'out_file'],
+                               name='affine_to_warp')
+        workflow.connect(resample_heads, 'out_file',
+                         pair_warps, 'head_files')
         workflow.connect(catmatvec, 'out_file',
-                         apply_allineate2, 'in_matrix')
-        workflow.connect(resample1, 'out_file',
-                         apply_allineate2, 'in_file')
-        workflow.connect(apply_allineate2, 'out_file', tcat3, 'in_files')
-        workflow.connect(tcat3, 'out_file', tstat3, 'in_file')
-
-    if pipeline_name == 'anats_to_common_nonlinear':
-        pass
+                         pair_warps, 'affine_transform_files')
+        workflow.connect(pair_warps, 'in_files', nwarp_cat, 'in_files')
+        workflow.connect(resample_heads,
+                         ('out_file', _suffixed_basenames, '_iniwarp.nii.gz'),
+                         nwarp_cat, 'out_file')
+        previous_warps = (nwarp_cat, 'out_file')
+    else:
+        previous_warps = (catmatvec, 'out_file')
+
+    inilev = 0
+    qwarp_kwargs_list = [dict(maxlev=maxlev) for maxlev in nonlinear_levels]
+    qwarp_kwargs_list += [dict(minpatch=minpatch)
+                          for minpatch in nonlinear_minimal_patches]
+    for n_iter, qwarp_kwargs in enumerate(qwarp_kwargs_list):
+        qwarp = pe.MapNode(
+            afni.Qwarp(noneg=True, iwarp=True, inilev=inilev,
+                       terminal_output=terminal_output,
+                       **dict(qwarp_kwargs, **verb_quietness_kwargs)),
+            iterfield=['in_file', 'iniwarp', 'out_file'],
+            name='warp{}'.format(n_iter))
+        if weight is None:
+            qwarp.inputs.weight = nonlinear_weight_file
+        else:
+            workflow.connect(weight[0], weight[1], qwarp, 'weight')
+        workflow.connect(resample_heads, 'out_file', qwarp, 'in_file')
+        workflow.connect(common_head[0], common_head[1], qwarp, 'base_file')
+        workflow.connect(previous_warps[0], (previous_warps[1], _listify),
+                         qwarp, 'iniwarp')
+        workflow.connect(resample_heads,
+                         ('out_file', _suffixed_basenames,
+                          '_warped{}.nii.gz'.format(n_iter)),
+                         qwarp, 'out_file')
+        previous_warps = (qwarp, 'source_warp')
+        if 'maxlev' in qwarp_kwargs:
+            inilev = qwarp_kwargs['maxlev'] + 1
+        else:
+            _, tstat_warped_heads = _add_average(
+                workflow, qwarp, 'warped_{}iters_template'.format(n_iter),
+                terminal_output, verbosity_kwargs, output_name='warped_source')
+
+        # Compute the average of the warped images while accounting
+        # for systematic biases in the non-linear transforms
+        nwarp_adjust = pe.Node(
+            afni.NwarpAdjust(
+                out_file='warped_{0}_adjusted_mean.nii.gz'.format(n_iter),
+                terminal_output=terminal_output),
+            name='adjust_warps{}'.format(n_iter))
+        workflow.connect(qwarp, 'source_warp', nwarp_adjust, 'warps')
+        workflow.connect(resample_heads, 'out_file', nwarp_adjust, 'in_files')
+        common_head = (nwarp_adjust, 'out_file')
+
+    if nonlinear_minimal_patches:
+        template = (tstat_warped_heads, 'out_file')
+    else:
+        template = common_head
+
+    warp_apply = pe.MapNode(
+        afni.NwarpApply(terminal_output=terminal_output,
+                        **verb_quietness_kwargs),
+        iterfield=['in_file', 'warp', 'out_file'], name='apply_warp')
+    workflow.connect(resample_heads, 'out_file', warp_apply, 'in_file')
+    workflow.connect(previous_warps[0], previous_warps[1], warp_apply, 'warp')
+    workflow.connect(template[0], template[1], warp_apply, 'master')
+    workflow.connect(resample_heads,
+                     ('out_file', _suffixed_basenames,
+                      'affine_warp{}_catenated.nii.gz'.format(
+                          len(nonlinear_levels))),
+                     warp_apply, 'out_file')
+    workflow.connect(warp_apply, 'out_file', output_node, 'registered')
+    workflow.connect(previous_warps[0], previous_warps[1],
+                     output_node, 'transforms')
+    return workflow
+
+
+def run_pipeline(pipeline_name, anat_filenames, write_dir, brain_volume,
+                 n_jobs=1, **workflow_kwargs):
+    """Runs a given pipeline with nipype's execution engine. Independent
+    steps, such as the per-individual registrations, run concurrently and
+    an interrupted run resumes from the last completed nodes.
+
+    Parameters
+    ----------
+    pipeline_name : one of {'anats_to_common_rigid', 'anats_to_common_affine',
+        'anats_to_common_nonlinear'}
+        Pipeline name.
+
+    anat_filenames : list of str
+        Paths to the anatomical images.
+
+    write_dir : str
+        Path to the directory holding the workflow nodes outputs.
+
+    brain_volume : int
+        Volume of the brain in mm3 used for brain extraction.
+        Typically 400 for mouse and 1800 for rat.
+
+    n_jobs : int, optional
+        The number of processes used by nipype's MultiProc plugin. -1 means
+        all CPUs. If 1, the nodes are run serially.
+
+    workflow_kwargs : dict, optional
+        Extra parameters, passed to sammba.graphs.create_pipeline_workflow
+
+    Returns
+    -------
+    data : sklearn.datasets.base.Bunch
+        Dictionary-like object, the interest attributes are :
+
+        - `registered` : list of str.
+                         Paths to registered images.
+        - `transforms` : list of str.
+                         Paths to the transforms from the raw
+                         images to the registered images.
+    """
+    workflow = create_pipeline_workflow(pipeline_name,
+                                        anat_filenames=anat_filenames,
+                                        brain_volume=brain_volume,
+                                        **workflow_kwargs)
+    workflow.base_dir = os.path.abspath(write_dir)
+    if n_jobs == 1:
+        execution_graph = workflow.run(plugin='Linear')
+    else:
+        plugin_args = {}
+        if n_jobs > 1:
+            plugin_args['n_procs'] = n_jobs
+        execution_graph = workflow.run(plugin='MultiProc',
+                                       plugin_args=plugin_args)
+
+    output_node = [node for node in execution_graph.nodes()
+                   if node.name == 'outputnode'][0]
+    outputs = output_node.result.outputs
+    return Bunch(registered=outputs.registered,
+                 transforms=outputs.transforms)
+
+
+def create_pipeline_graph(pipeline_name, graph_file,
+                          graph_kind='hierarchical'):
+    """Creates pipeline graph for a given piepline.
+
+    Parameters
+    ----------
+    pipeline_name : one of {'anats_to_common_rigid', 'anats_to_common_affine',
+        'anats_to_common_nonlinear'}
+        Pipeline name.
+
+    graph_file : str.
+        Path to save the graph image to.
+
+    graph_kind : one of {'orig', 'hierarchical', 'flat', 'exec', 'colored'}, optional.
+        The kind of the graph, passed to
+        nipype.pipeline.workflows.Workflow().write_graph
+    """
+    workflow = create_pipeline_workflow(pipeline_name)
+    graph_kinds = ['orig', 'hierarchical', 'flat', 'exec', 'colored']
+    if graph_kind not in graph_kinds:
+        raise ValueError(
+            'Graph kind must be one of {0}, you entered {1}'.format(
+                graph_kinds, graph_kind))
 
     graph_file_root, graph_file_ext = os.path.splitext(graph_file)
     if graph_file_ext:
@@ -4,12 +4,13 @@
 # License: CeCILL-B
 
 import os
-import subprocess
 import itertools
 import warnings
+from collections import OrderedDict
 import numpy as np
 import nibabel
-from .utils import _rotate_affine
+from joblib import Parallel, delayed
+from .utils import _IMPLICIT_VRS, _read_enhanced_dicom, _rotate_affine
 
 def _is_dicom(filename):
     """
@@ -58,8 +59,8 @@ def dcm_to_nii(dcmdump_path, dicom_filename, save_directory, siap_fix=True,
 
     Parameters
     ----------
-    dcmdump_path : str
-        Path to the compiled dcmdump (see Note).
+    dcmdump_path : str or None
+        Unused, kept for backward compatibility.
 
     dicom_filename : str
         Path to the DICOM file (typically named EnIm1.dcm).
@@ -104,13 +105,10 @@ def dcm_to_nii(dcmdump_path, dicom_filename, save_directory, siap_fix=True,
 
     Notes
     -----
-    This is effectively a python wrapper to dcmdump, processing and passing
-    its output to nibabel and a text file.
-    Depends on access to a compiled version of dcmdump (part of OFFIS dcmtk;
-    http://dcmtk.org/dcmtk.php.en and
-    http://support.dcmtk.org/docs/dcmdump.html)
-    which does the initial parsing: extraction of the header/metadata as text
-    and the image data as a raw vector.
+    The header/metadata tags are read in-process by a minimal binary parser
+    of uncompressed little endian DICOM files, walking the per-frame and
+    shared functional groups sequences, and the pixel data are memory-mapped
+    from the DICOM file itself.
 
     Useful documents include DICOM spec C.7.6.2.1.1 and 10.7.1.3
     common.py of dicom2nifiti by Arne Brys, icometrix saved me when it comes to
@@ -124,21 +122,14 @@ def dcm_to_nii(dcmdump_path, dicom_filename, save_directory, siap_fix=True,
     """
 
     # regularise/standardise input paths
-    input_paths = [dcmdump_path, dicom_filename, save_directory]
-    input_paths = [os.path.abspath(input_path) for input_path in input_paths]
-    dcmdump_path, dicom_filename, save_directory = input_paths
-
-    # read dicom_filename header/metadata using dcmdump
-    # +L ensures long tags are fully printed
-    # -M prevents 'very long values' from being read in, which vastly improves 
-    # performance in at least one case (my windows 10 laptop). the same machine
-    # running the code within a WSSL bash shell was far faster; not sure where 
-    # the nt bottleneck is
-    # universal_newlines=TRUE should keep output format consistent across python 
-    # 2 and 3, plus posix and nt
-    dcmdump_output = subprocess.check_output([dcmdump_path, dicom_filename,
-                                              '+L', '-M'],
-                                             universal_newlines=True)
+    dicom_filename = os.path.abspath(dicom_filename)
+    save_directory = os.path.abspath(save_directory)
+
+    # read dicom_filename header/metadata, including the tags nested in the
+    # per-frame and shared functional groups sequences, and locate the pixel
+    # data without reading them
+    elements, pixel_data = _read_enhanced_dicom(dicom_filename,
+                                                set(_IMPLICIT_VRS))
 
     # fields that are likely to be empty or multiple are awkward to dynamically
     # declare, so do it here rather than in the parser loop below
@@ -160,99 +151,80 @@ def dcm_to_nii(dcmdump_path, dicom_filename, save_directory, siap_fix=True,
     DIVs = []
     frame_comments = []
 
-    # via subprocess, dcmdump produces numerous lines of string output.
-    # for some parameters such as SeriesDate, there should hopefully be only
-    # one line. for others, such as InStackPositionNumber, there may be
-    # several. three example lines are shown below:
-
-    # '(0008,0021) DA [20160219]                      #   8, 1 SeriesDate'
-    # '(0018,9079) FD 35                              #   8, 1 InversionTimes'
-    # '(0020,0032) DS [-9\\-7.417465618\\1.68366613]  #  26, 3 ImagePositionPatient'
-
-    # fields interpreted as strings are delimited with square brackets
-    # (incidentally, several numeric fields get interpreted as strings, I do
-    # not know why, and I assume it does not matter). in the loop below, each
-    # line is parsed to identify what field it represents and extract the value
-
-    for line in dcmdump_output.splitlines():
-        # pline = processed line. some lines have leading whitespace
-        pline = line.lstrip()
-        if len(pline) >= 11:
-            if pline[0] == '(' and pline[5] == ',' and pline[10] == ')':
-                tag = pline[0:11]
-                val = pline[:pline.rfind('#')].rstrip()[15:]
-                # remove [] that dcmdump delimits strings with
-                if val[0] == '[':
-                    val = val[1:-1]
-
-                vals = val.split('\\') # \\ should work on both posix and nt
-                # turn single value lists into single values
-                if type(vals) == list:
-                    if len(vals) == 1:
-                        vals = vals[0]
-                # assign output to variable names
-                if tag == '(0008,0021)':  # Series Date
-                    acqdate = vals
-                if tag == '(0008,0031)':  # Series Time
-                    acqtime = vals
-                if tag == '(0010,0020)':  # Patient ID​
-                    patID = vals
-                if tag == '(0018,0023)':  # MR Acquisition Type
-                    acqdims = vals
-                if tag == '(0018,0050)':  # Slice Thickness​
-                    thk = float(vals)
-                if tag == '(0018,0080)':  # Repetition Time
-                    TR = float(vals)
-                if tag == '(0018,1030)':  # Protocol Name
-                    protocol = vals
-                if tag == '(0018,5100)':  # Patient Position
-                    patpos = vals
-                if tag == '(0018,9005)':  # Pulse Sequence Name
-                    bruker_sequence = vals
-                if tag == '(0018,9075)':  # Diffusion Directionality​
-                    diffdir.append(vals)
-                if tag == '(0018,9079)':  # Inversion Times
-                    TIs.append(float(vals))
-                if tag == '(0018,9087)':  # Diffusion b-value
-                    bval.append(float(vals))
-                if tag == '(0018,9602)':  # Diffusion b-value XX
-                    bvalXX.append(float(vals))
-                if tag == '(0018,9603)':  # Diffusion b-value XY​
-                    bvalXY.append(float(vals))
-                if tag == '(0018,9604)':  # Diffusion b-value XZ
-                    bvalXZ.append(float(vals))
-                if tag == '(0018,9605)':  # Diffusion b-value YY
-                    bvalYY.append(float(vals))
-                if tag == '(0018,9606)':  # Diffusion b-value YZ
-                    bvalYZ.append(float(vals))
-                if tag == '(0018,9607)':  # Diffusion b-value Z
-                    bvalZZ.append(float(vals))
-                if tag == '(0020,0032)':  # Image Position (Patient)
-                    IPPs.append([float(i) for i in vals])
-                if tag == '(0020,0037)':  # Image Orientation (Patient)
-                    cosines = [float(i) for i in vals]
-                if tag == '(0020,9057)':  # In-Stack Position Number
-                    ISPnums.append(int(vals))
-                if tag == '(0020,9128)':  # Temporal Position Index​
-                    repno.append(int(vals))
-                if tag == '(0020,9157)':  # Dimension Index Values
-                    DIVs.append([int(i) for i in vals])
-                if tag == '(0020,9158)':  # Frame Comments
-                    frame_comments.append(vals)
-                if tag == '(0028,0008)':  # Number of Frames
-                    frames = int(vals)
-                if tag == '(0028,0010)':  # Rows
-                    rows = int(vals)
-                if tag == '(0028,0011)':  # Columns
-                    cols = int(vals)
-                if tag == '(0028,0030)':  # Pixel Spacing
-                    pixspac = [float(i) for i in vals]
-
-                # might be useful in the future
-                # (0028,0100)  # Bits Allocated
-                # (0028,0101)  # Bits Stored
-                # (0028,0102)  # High Bit
-                # (0028,0103)  # Pixel Representation
+    # each element is a tag and the list of its values, in file order. for
+    # some parameters such as SeriesDate, there should hopefully be only one
+    # element. for others, such as InStackPositionNumber, there may be
+    # several, one per frame
+    for tag, values in elements:
+        tag = '({0:04X},{1:04X})'.format(*tag)
+        # turn single value lists into single values
+        if len(values) == 1:
+            vals = values[0]
+        else:
+            vals = values
+        # assign output to variable names
+        if tag == '(0008,0021)':  # Series Date
+            acqdate = vals
+        if tag == '(0008,0031)':  # Series Time
+            acqtime = vals
+        if tag == '(0010,0020)':  # Patient ID​
+            patID = vals
+        if tag == '(0018,0023)':  # MR Acquisition Type
+            acqdims = vals
+        if tag == '(0018,0050)':  # Slice Thickness​
+            thk = float(vals)
+        if tag == '(0018,0080)':  # Repetition Time
+            TR = float(vals)
+        if tag == '(0018,1030)':  # Protocol Name
+            protocol = vals
+        if tag == '(0018,5100)':  # Patient Position
+            patpos = vals
+        if tag == '(0018,9005)':  # Pulse Sequence Name
+            bruker_sequence = vals
+        if tag == '(0018,9075)':  # Diffusion Directionality​
+            diffdir.append(vals)
+        if tag == '(0018,9079)':  # Inversion Times
+            TIs.append(float(vals))
+        if tag == '(0018,9087)':  # Diffusion b-value
+            bval.append(float(vals))
+        if tag == '(0018,9602)':  # Diffusion b-value XX
+            bvalXX.append(float(vals))
+        if tag == '(0018,9603)':  # Diffusion b-value XY​
+            bvalXY.append(float(vals))
+        if tag == '(0018,9604)':  # Diffusion b-value XZ
+            bvalXZ.append(float(vals))
+        if tag == '(0018,9605)':  # Diffusion b-value YY
+            bvalYY.append(float(vals))
+        if tag == '(0018,9606)':  # Diffusion b-value YZ
+            bvalYZ.append(float(vals))
+        if tag == '(0018,9607)':  # Diffusion b-value Z
+            bvalZZ.append(float(vals))
+        if tag == '(0020,0032)':  # Image Position (Patient)
+            IPPs.append([float(i) for i in values])
+        if tag == '(0020,0037)':  # Image Orientation (Patient)
+            cosines = [float(i) for i in values]
+        if tag == '(0020,9057)':  # In-Stack Position Number
+            ISPnums.append(int(vals))
+        if tag == '(0020,9128)':  # Temporal Position Index​
+            repno.append(int(vals))
+        if tag == '(0020,9157)':  # Dimension Index Values
+            DIVs.append([int(i) for i in values])
+        if tag == '(0020,9158)':  # Frame Comments
+            frame_comments.append(vals)
+        if tag == '(0028,0008)':  # Number of Frames
+            frames = int(vals)
+        if tag == '(0028,0010)':  # Rows
+            rows = int(vals)
+        if tag == '(0028,0011)':  # Columns
+            cols = int(vals)
+        if tag == '(0028,0030)':  # Pixel Spacing
+            pixspac = [float(i) for i in values]
+
+        # might be useful in the future
+        # (0028,0100)  # Bits Allocated
+        # (0028,0101)  # Bits Stored
+        # (0028,0102)  # High Bit
+        # (0028,0103)  # Pixel Representation
 
     # if they have length zero (or just unequal to ISPnums, though no idea how
     # that could be possible), populate vectors that will be included in ptbl
@@ -289,17 +261,12 @@ def dcm_to_nii(dcmdump_path, dicom_filename, save_directory, siap_fix=True,
 
     slices = max(ISPnums)  # maybe a bit dangerous
 
-    # use check_output rather than call to avoid stdout filling up the terminal
-    rawfile = os.path.join(save_directory, 'EnIm1.dcm.0.raw')
-    if os.path.exists(rawfile):
-        os.remove(rawfile)
-    sink = subprocess.check_output([dcmdump_path, dicom_filename, '+W',
-                                    save_directory])
-    rawarray = np.fromfile(rawfile, dtype=np.int16)
-    os.remove(rawfile)
-
-    # rawarray is actually just a vector, need to reshape into a run of frames
-    rawarray = np.reshape(rawarray, (frames, rows, cols))
+    if pixel_data is None:
+        raise ValueError('{0} has no pixel data'.format(dicom_filename))
+
+    # memory-map the pixel data element as a run of frames
+    rawarray = np.memmap(dicom_filename, dtype='<i2', mode='r',
+                         offset=pixel_data[0], shape=(frames, rows, cols))
     rawarray = np.reshape(rawarray, (int(frames / slices), slices, rows, cols))
     rawarray = np.transpose(rawarray, (3, 2, 1, 0))
 
@@ -391,15 +358,24 @@ def dcm_to_nii(dcmdump_path, dicom_filename, save_directory, siap_fix=True,
     return nii_filename
 
 
-def recursive_dcm_to_nii(dcmdump_path, session_directory, save_directory,
+def _dcm_to_nii_serially(dcmdump_path, dicom_filenames, save_directory,
                          **dcm_to_nii_kwargs):
+    """ Converts several DICOM files one after the other.
+    """
+    return [dcm_to_nii(dcmdump_path, dicom_filename, save_directory,
+                       **dcm_to_nii_kwargs)
+            for dicom_filename in dicom_filenames]
+
+
+def recursive_dcm_to_nii(dcmdump_path, session_directory, save_directory,
+                         n_jobs=1, **dcm_to_nii_kwargs):
     """ Traverses recursively subdirectories of a given session directory
     and converts all DICOM files to NIFTI files.
 
     Parameters
     ----------
-    dcmdump_path : str
-        Path to the compiled dcmdump (see Note)
+    dcmdump_path : str or None
+        Unused, kept for backward compatibility.
 
     session_directory : str
         Path to the top directory.
@@ -407,6 +383,13 @@ def recursive_dcm_to_nii(dcmdump_path, session_directory, save_directory,
     save_directory : str
         Path to the directory to save the extracteed NIFTI image.
 
+    n_jobs : int, optional
+        The number of processes converting files in parallel. -1 means all
+        CPUs. Files of the same Paravision experiment folder, such as several
+        reconstructions, are converted in the same process as they may be
+        given the same NIFTI filename. If the Paravision folder number is not
+        included in the NIFTI filenames, the files are converted serially.
+
     dcm_to_nii_kwargs : extra keyword arguments
         Extra keyword arguments are passed to sammba.io_conversions.dcm_to_nii
 
@@ -419,12 +402,32 @@ def recursive_dcm_to_nii(dcmdump_path, session_directory, save_directory,
     --------
     sammba.io_conversions.dcm_to_nii
     """
-    nii_filenames = []
+    dicom_filenames = []
     for root, dirs, files in os.walk(session_directory):
         for basename in files:
             if _is_dicom(basename):
-                nii_filename = dcm_to_nii(
-                    dcmdump_path, os.path.join(root, basename),
-                    save_directory, **dcm_to_nii_kwargs)
-                nii_filenames.append(nii_filename)
-    return nii_filenames
+                dicom_filenames.append(os.path.join(root, basename))
+
+    # without the Paravision folder number, files of different experiments
+    # may be given the same NIFTI filename
+    if n_jobs == 1 or not dcm_to_nii_kwargs.get(
+            'paravision_folder_in_filename', True):
+        return _dcm_to_nii_serially(dcmdump_path, dicom_filenames,
+                                    save_directory, **dcm_to_nii_kwargs)
+
+    # group the files by Paravision experiment folder, which is part of the
+    # NIFTI filename, keeping the walk order within each group
+    groups = OrderedDict()
+    for dicom_filename in dicom_filenames:
+        experiment = os.path.abspath(dicom_filename).split(os.sep)[-5]
+        groups.setdefault(experiment, []).append(dicom_filename)
+
+    groups_nii_filenames = Parallel(n_jobs=n_jobs)(
+        delayed(_dcm_to_nii_serially)(dcmdump_path, group_filenames,
+                                      save_directory, **dcm_to_nii_kwargs)
+        for group_filenames in groups.values())
+    converted = {}
+    for group_filenames, nii_filenames in zip(groups.values(),
+                                              groups_nii_filenames):
+        converted.update(zip(group_filenames, nii_filenames))
+    return [converted[dicom_filename] for dicom_filename in dicom_filenames]
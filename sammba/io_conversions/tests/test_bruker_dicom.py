@@ -0,0 +1,198 @@
+import os
+import struct
+import numpy as np
+import nibabel
+from nose import with_setup
+from nose.tools import assert_equal
+from nilearn.datasets.tests import test_utils as tst
+from nilearn._utils.testing import assert_raises_regex
+from sammba.io_conversions import bruker_dicom, utils
+
+
+def _element(tag, vr, value, explicit_vr):
+    if len(value) % 2:
+        value += b'\x00' if vr == b'UI' else b' '
+    header = struct.pack('<HH', *tag)
+    if not explicit_vr:
+        return header + struct.pack('<I', len(value)) + value
+    if vr in [b'OB', b'OW', b'SQ', b'UN']:
+        return header + vr + b'\x00\x00' + struct.pack('<I', len(value)) + \
+            value
+    return header + vr + struct.pack('<H', len(value)) + value
+
+
+def _sequence(tag, items, explicit_vr, undefined_length):
+    """ Encodes a sequence, with items of undefined length delimited by
+    item delimitation tags if undefined_length is True.
+    """
+    value = b''
+    for item in items:
+        item = b''.join(item)
+        if undefined_length:
+            value += struct.pack('<HHI', 0xFFFE, 0xE000, 0xFFFFFFFF) + \
+                item + struct.pack('<HHI', 0xFFFE, 0xE00D, 0)
+        else:
+            value += struct.pack('<HHI', 0xFFFE, 0xE000, len(item)) + item
+    if undefined_length:
+        value += struct.pack('<HHI', 0xFFFE, 0xE0DD, 0)
+        header = struct.pack('<HH', *tag)
+        if explicit_vr:
+            header += b'SQ\x00\x00'
+        return header + struct.pack('<I', 0xFFFFFFFF) + value
+    return _element(tag, b'SQ', value, explicit_vr)
+
+
+def _write_enhanced_dicom(dicom_filename, data, ti, explicit_vr=True,
+                          undefined_length=False):
+    """ Writes a minimal Bruker-like enhanced multiframe DICOM file of the
+    int16 data of shape (n_repetitions, n_slices, rows, columns).
+    """
+    n_repetitions, n_slices, rows, cols = data.shape
+
+    def element(tag, vr, value):
+        return _element(tag, vr, value, explicit_vr)
+
+    def sequence(tag, items):
+        return _sequence(tag, items, explicit_vr, undefined_length)
+
+    per_frame_items = []
+    for repetition in range(n_repetitions):
+        for n_slice in range(n_slices):
+            per_frame_items.append([
+                sequence((0x0018, 0x9112), [[
+                    element((0x0018, 0x9079), b'FD',
+                            struct.pack('<d', ti[repetition]))]]),
+                sequence((0x0020, 0x9111), [[
+                    element((0x0020, 0x9057), b'UL',
+                            struct.pack('<I', n_slice + 1)),
+                    element((0x0020, 0x9128), b'UL',
+                            struct.pack('<I', repetition + 1)),
+                    element((0x0020, 0x9157), b'UL',
+                            struct.pack('<II', repetition + 1, n_slice + 1)),
+                    element((0x0020, 0x9158), b'LT',
+                            b'Selective Inversion')]]),
+                sequence((0x0020, 0x9113), [[
+                    element((0x0020, 0x0032), b'DS',
+                            '-9\\-7.5\\{0}'.format(
+                                0.5 * n_slice).encode('ascii'))]])])
+
+    dataset = b''.join([
+        element((0x0008, 0x0021), b'DA', b'20160219'),
+        element((0x0008, 0x0031), b'TM', b'101010'),
+        element((0x0010, 0x0020), b'LO', b'mouse1'),
+        element((0x0018, 0x1030), b'LO', b'FAIR'),
+        element((0x0018, 0x5100), b'CS', b'HFS'),
+        element((0x0028, 0x0008), b'IS',
+                str(n_repetitions * n_slices).encode('ascii')),
+        element((0x0028, 0x0010), b'US', struct.pack('<H', rows)),
+        element((0x0028, 0x0011), b'US', struct.pack('<H', cols)),
+        sequence((0x5200, 0x9229), [[
+            sequence((0x0020, 0x9116), [[
+                element((0x0020, 0x0037), b'DS', b'1\\0\\0\\0\\1\\0')]]),
+            sequence((0x0028, 0x9110), [[
+                element((0x0018, 0x0050), b'DS', b'0.5'),
+                element((0x0028, 0x0030), b'DS', b'0.1\\0.2')]])]]),
+        sequence((0x5200, 0x9230), per_frame_items),
+        element((0x7FE0, 0x0010), b'OW', data.astype('<i2').tobytes())])
+
+    if explicit_vr:
+        transfer_syntax = b'1.2.840.10008.1.2.1'
+    else:
+        transfer_syntax = b'1.2.840.10008.1.2'
+    meta = _element((0x0002, 0x0010), b'UI', transfer_syntax, True)
+    meta = _element((0x0002, 0x0000), b'UL', struct.pack('<I', len(meta)),
+                    True) + meta
+    with open(dicom_filename, 'wb') as fileobj:
+        fileobj.write(b'\x00' * 128 + b'DICM' + meta + dataset)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_read_enhanced_dicom():
+    data = np.arange(2 * 3 * 4 * 5, dtype=np.int16).reshape((2, 3, 4, 5))
+    dicom_filename = os.path.join(tst.tmpdir, 'EnIm1.dcm')
+    for explicit_vr, undefined_length in [(True, False), (True, True),
+                                          (False, True), (False, False)]:
+        _write_enhanced_dicom(dicom_filename, data, [35., 100.],
+                              explicit_vr=explicit_vr,
+                              undefined_length=undefined_length)
+        elements, pixel_data = utils._read_enhanced_dicom(
+            dicom_filename, [(0x0018, 0x9079), (0x0020, 0x9157),
+                             (0x0028, 0x0030)])
+        assert_equal(elements[0], ((0x0028, 0x0030), ['0.1', '0.2']))
+        assert_equal([values for tag, values in elements
+                      if tag == (0x0018, 0x9079)], [[35.]] * 3 + [[100.]] * 3)
+        assert_equal(elements[2], ((0x0020, 0x9157), [1, 1]))
+        assert_equal(len(elements), 13)
+        assert_equal(pixel_data[1], data.nbytes)
+        np.testing.assert_array_equal(
+            np.memmap(dicom_filename, dtype='<i2', mode='r',
+                      offset=pixel_data[0], shape=data.shape), data)
+
+    with open(dicom_filename, 'wb') as fileobj:
+        fileobj.write(b'\x00' * 200)
+    assert_raises_regex(ValueError, 'is not a DICOM file',
+                        utils._read_enhanced_dicom, dicom_filename, [])
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_dcm_to_nii():
+    data = np.arange(2 * 3 * 4 * 5, dtype=np.int16).reshape((2, 3, 4, 5))
+    dicom_directory = os.path.join(tst.tmpdir, 'session', '7', 'pdata', '1',
+                                   'dicom')
+    os.makedirs(dicom_directory)
+    dicom_filename = os.path.join(dicom_directory, 'EnIm1.dcm')
+    _write_enhanced_dicom(dicom_filename, data, [35., 100.])
+    nii_filename = bruker_dicom.dcm_to_nii(None, dicom_filename, tst.tmpdir)
+    assert_equal(os.path.basename(nii_filename),
+                 'mouse1_20160219_101010_FAIR_fixedSIAP_bf7.nii.gz')
+    img = nibabel.load(nii_filename)
+    np.testing.assert_array_equal(img.get_data(),
+                                  data.transpose((3, 2, 1, 0)))
+    np.testing.assert_allclose(img.header.get_zooms()[:3], [0.2, 0.1, 0.5])
+    assert_equal(os.listdir(tst.tmpdir).count('EnIm1.dcm.0.raw'), 0)
+
+    ptbl = np.genfromtxt(nii_filename.replace('.nii.gz', '_ptbl.txt'),
+                         dtype=str, delimiter='\t')
+    np.testing.assert_array_equal(ptbl[:, 3].astype(float),
+                                  [35.] * 3 + [100.] * 3)
+    np.testing.assert_array_equal(ptbl[:, 1].astype(int), [1, 2, 3] * 2)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_recursive_dcm_to_nii():
+    session_directory = os.path.join(tst.tmpdir, 'session')
+    save_directory = os.path.join(tst.tmpdir, 'nifti')
+    os.makedirs(save_directory)
+    rng = np.random.RandomState(0)
+    for experiment, reconstruction in [('5', '1'), ('6', '1'), ('6', '2')]:
+        dicom_directory = os.path.join(session_directory, experiment,
+                                       'pdata', reconstruction, 'dicom')
+        os.makedirs(dicom_directory)
+        data = rng.randint(0, 1000, (2, 3, 4, 5)).astype(np.int16)
+        _write_enhanced_dicom(os.path.join(dicom_directory, 'EnIm1.dcm'),
+                              data, [35., 100.])
+
+    serial_filenames = bruker_dicom.recursive_dcm_to_nii(
+        None, session_directory, save_directory)
+    serial_data = [nibabel.load(nii_filename).get_data()
+                   for nii_filename in serial_filenames]
+    parallel_filenames = bruker_dicom.recursive_dcm_to_nii(
+        None, session_directory, save_directory, n_jobs=2)
+    assert_equal(parallel_filenames, serial_filenames)
+    for nii_filename, data in zip(parallel_filenames, serial_data):
+        np.testing.assert_array_equal(nibabel.load(nii_filename).get_data(),
+                                      data)
+
+    # Without the folder number, the files of all experiments share the same
+    # NIFTI filename and the last converted one must be kept
+    serial_filenames = bruker_dicom.recursive_dcm_to_nii(
+        None, session_directory, save_directory,
+        paravision_folder_in_filename=False)
+    assert_equal(len(set(serial_filenames)), 1)
+    serial_data = nibabel.load(serial_filenames[0]).get_data()
+    parallel_filenames = bruker_dicom.recursive_dcm_to_nii(
+        None, session_directory, save_directory, n_jobs=2,
+        paravision_folder_in_filename=False)
+    assert_equal(parallel_filenames, serial_filenames)
+    np.testing.assert_array_equal(
+        nibabel.load(parallel_filenames[0]).get_data(), serial_data)
@@ -1,6 +1,7 @@
 # Author: Nachiket Nadkarni, 2017
 # License: CeCILL-B
 
+import struct
 import numpy as np
 import math
 
@@ -51,3 +52,213 @@ def _rotate_affine(angle, axis):
     return matrix
 
 
+_DICOM_PREAMBLE_LENGTH = 128
+_ITEM = (0xFFFE, 0xE000)
+_ITEM_DELIMITATION = (0xFFFE, 0xE00D)
+_SEQUENCE_DELIMITATION = (0xFFFE, 0xE0DD)
+_PIXEL_DATA = (0x7FE0, 0x0010)
+_TRANSFER_SYNTAX = (0x0002, 0x0010)
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+_UNSUPPORTED_TRANSFER_SYNTAXES = ['1.2.840.10008.1.2.2',  # big endian
+                                  '1.2.840.10008.1.2.1.99']  # deflated
+
+# Explicit VRs whose length is stored on 4 bytes after 2 reserved bytes
+_LONG_LENGTH_VRS = [b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV',
+                    b'UC', b'UN', b'UR', b'UT', b'UV']
+_BINARY_VR_DTYPES = {b'FD': '<f8', b'FL': '<f4', b'SL': '<i4', b'SS': '<i2',
+                     b'SV': '<i8', b'UL': '<u4', b'US': '<u2', b'UV': '<u8'}
+
+# VRs of the tags read by sammba.io_conversions.dcm_to_nii, needed for
+# implicit VR files
+_IMPLICIT_VRS = {
+    (0x0008, 0x0021): b'DA',  # Series Date
+    (0x0008, 0x0031): b'TM',  # Series Time
+    (0x0010, 0x0020): b'LO',  # Patient ID
+    (0x0018, 0x0023): b'CS',  # MR Acquisition Type
+    (0x0018, 0x0050): b'DS',  # Slice Thickness
+    (0x0018, 0x0080): b'DS',  # Repetition Time
+    (0x0018, 0x1030): b'LO',  # Protocol Name
+    (0x0018, 0x5100): b'CS',  # Patient Position
+    (0x0018, 0x9005): b'SH',  # Pulse Sequence Name
+    (0x0018, 0x9075): b'CS',  # Diffusion Directionality
+    (0x0018, 0x9079): b'FD',  # Inversion Times
+    (0x0018, 0x9087): b'FD',  # Diffusion b-value
+    (0x0018, 0x9602): b'FD',  # Diffusion b-value XX
+    (0x0018, 0x9603): b'FD',  # Diffusion b-value XY
+    (0x0018, 0x9604): b'FD',  # Diffusion b-value XZ
+    (0x0018, 0x9605): b'FD',  # Diffusion b-value YY
+    (0x0018, 0x9606): b'FD',  # Diffusion b-value YZ
+    (0x0018, 0x9607): b'FD',  # Diffusion b-value ZZ
+    (0x0020, 0x0032): b'DS',  # Image Position (Patient)
+    (0x0020, 0x0037): b'DS',  # Image Orientation (Patient)
+    (0x0020, 0x9057): b'UL',  # In-Stack Position Number
+    (0x0020, 0x9128): b'UL',  # Temporal Position Index
+    (0x0020, 0x9157): b'UL',  # Dimension Index Values
+    (0x0020, 0x9158): b'LT',  # Frame Comments
+    (0x0028, 0x0008): b'IS',  # Number of Frames
+    (0x0028, 0x0010): b'US',  # Rows
+    (0x0028, 0x0011): b'US',  # Columns
+    (0x0028, 0x0030): b'DS',  # Pixel Spacing
+    (0x5200, 0x9229): b'SQ',  # Shared Functional Groups Sequence
+    (0x5200, 0x9230): b'SQ',  # Per-frame Functional Groups Sequence
+    (0x7FE0, 0x0010): b'OW',  # Pixel Data
+}
+
+
+def _read_element_header(fileobj, explicit_vr):
+    """ Reads the tag, VR and value length of the next data element, with
+    None as VR for item tags and for unknown tags of implicit VR files.
+    Returns None at the end of the file.
+    """
+    data = fileobj.read(8)
+    if len(data) < 8:
+        return None
+
+    tag = struct.unpack('<HH', data[:4])
+    if tag[0] == 0xFFFE or not explicit_vr:
+        return tag, _IMPLICIT_VRS.get(tag), struct.unpack('<I', data[4:])[0]
+
+    vr = data[4:6]
+    if vr in _LONG_LENGTH_VRS:
+        length = struct.unpack('<I', fileobj.read(4))[0]
+    else:
+        length = struct.unpack('<H', data[6:])[0]
+    return tag, vr, length
+
+
+def _decode_dicom_values(data, vr):
+    """ Decodes the bytes of a data element value into a list of numbers for
+    binary VRs or of strings otherwise.
+    """
+    if vr in _BINARY_VR_DTYPES:
+        return np.frombuffer(data, dtype=_BINARY_VR_DTYPES[vr]).tolist()
+
+    text = data.decode('latin-1').rstrip(' \x00')
+    return [value.strip() for value in text.split('\\')]
+
+
+def _starts_sequence(fileobj):
+    """ Checks whether the next bytes are an item tag, without moving.
+    """
+    position = fileobj.tell()
+    data = fileobj.read(4)
+    fileobj.seek(position)
+    return len(data) == 4 and struct.unpack('<HH', data) == _ITEM
+
+
+def _read_dicom_sequence(fileobj, explicit_vr, tags, elements, length):
+    """ Reads the items of a sequence, appending their elements in file
+    order.
+    """
+    end = None
+    if length != _UNDEFINED_LENGTH:
+        end = fileobj.tell() + length
+    while end is None or fileobj.tell() < end:
+        header = _read_element_header(fileobj, explicit_vr)
+        if header is None or header[0] == _SEQUENCE_DELIMITATION:
+            break
+        tag, _, item_length = header
+        if tag != _ITEM:
+            raise ValueError('Unexpected tag ({0:04X},{1:04X}) in a DICOM '
+                             'sequence'.format(*tag))
+        item_end = None
+        if item_length != _UNDEFINED_LENGTH:
+            item_end = fileobj.tell() + item_length
+        _read_dicom_dataset(fileobj, explicit_vr, tags, elements,
+                            end=item_end)
+
+
+def _read_dicom_dataset(fileobj, explicit_vr, tags, elements, end=None):
+    """ Reads the data elements of a dataset or of a sequence item, appending
+    the (tag, values) of the requested tags to `elements` in file order,
+    with nested sequences flattened. The values of the other elements are
+    skipped. Returns the offset and length of the pixel data, if any.
+    """
+    pixel_data = None
+    while end is None or fileobj.tell() < end:
+        header = _read_element_header(fileobj, explicit_vr)
+        if header is None or header[0] == _ITEM_DELIMITATION:
+            break
+        tag, vr, length = header
+        if tag == _PIXEL_DATA:
+            if length == _UNDEFINED_LENGTH:
+                raise ValueError('Encapsulated (compressed) DICOM pixel data '
+                                 'are not supported')
+            pixel_data = (fileobj.tell(), length)
+            fileobj.seek(length, 1)
+        elif vr == b'SQ' or (vr is None and (
+                length == _UNDEFINED_LENGTH or
+                (length > 0 and _starts_sequence(fileobj)))):
+            _read_dicom_sequence(fileobj, explicit_vr, tags, elements,
+                                 length)
+        elif vr == b'UN' and length == _UNDEFINED_LENGTH:
+            # Sequence of unknown VR, encoded as implicit VR little endian
+            _read_dicom_sequence(fileobj, False, tags, elements, length)
+        elif tag in tags:
+            elements.append((tag, _decode_dicom_values(fileobj.read(length),
+                                                       vr)))
+        else:
+            fileobj.seek(length, 1)
+
+    return pixel_data
+
+
+def _read_enhanced_dicom(dicom_filename, tags):
+    """ Reads the values of the given tags in a DICOM file, including those
+    nested in sequences such as the per-frame and shared functional groups of
+    enhanced multiframe files, and locates its pixel data without reading
+    them.
+
+    Parameters
+    ----------
+    dicom_filename : str
+        Path to the DICOM file.
+
+    tags : collection of tuples
+        The (group, element) of the tags to read.
+
+    Returns
+    -------
+    elements : list of tuples
+        The (tag, values) of each occurrence of the requested tags, in file
+        order. Values are lists of numbers for binary VRs and of strings
+        otherwise.
+
+    pixel_data : tuple of int or None
+        The offset of the pixel data in the file and their length in bytes.
+
+    Notes
+    -----
+    Only uncompressed little endian transfer syntaxes are supported.
+    """
+    with open(dicom_filename, 'rb') as fileobj:
+        fileobj.seek(_DICOM_PREAMBLE_LENGTH)
+        if fileobj.read(4) != b'DICM':
+            raise ValueError('{0} is not a DICOM file'.format(dicom_filename))
+
+        # The file meta information is always explicit VR little endian
+        meta_elements = []
+        while True:
+            position = fileobj.tell()
+            header = _read_element_header(fileobj, True)
+            if header is None or header[0][0] != 0x0002:
+                fileobj.seek(position)
+                break
+            tag, vr, length = header
+            meta_elements.append((tag, _decode_dicom_values(
+                fileobj.read(length), vr)))
+
+        transfer_syntax = dict(meta_elements).get(
+            _TRANSFER_SYNTAX, [_IMPLICIT_VR_LITTLE_ENDIAN])[0]
+        if transfer_syntax in _UNSUPPORTED_TRANSFER_SYNTAXES:
+            raise ValueError('DICOM transfer syntax {0} is not '
+                             'supported'.format(transfer_syntax))
+
+        elements = [element for element in meta_elements
+                    if element[0] in tags]
+        pixel_data = _read_dicom_dataset(
+            fileobj, transfer_syntax != _IMPLICIT_VR_LITTLE_ENDIAN, tags,
+            elements)
+
+    return elements, pixel_data
@@ -1,3 +1,8 @@
 from .perfusion_fair import (perf_fair_nii_proc, perf_fair_niiptbl_proc)
+from .relaxometry import (SignalModel, InversionRecoveryModel,
+                          ExponentialDecayModel, DiffusionModel, FAIRModel,
+                          fit_voxelwise)
 
-__all__ = ['perf_fair_nii_proc', 'perf_fair_niiptbl_proc']
+__all__ = ['perf_fair_nii_proc', 'perf_fair_niiptbl_proc', 'SignalModel',
+           'InversionRecoveryModel', 'ExponentialDecayModel',
+           'DiffusionModel', 'FAIRModel', 'fit_voxelwise']
@@ -8,9 +8,10 @@ Created on Sunday 4th March 2018
 import nibabel as nib
 import numpy as np
 from scipy.optimize import least_squares as ls
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count
 from functools import partial
-from .utils import _iterate_and_show_progress
+from .utils import (_apply_to_rows, _batch_least_squares, _fit_nii,
+                    _log_linear_fit, _read_ptbl)
 
 
 def _perf_fair_read_ptbl(nii_fname):
@@ -59,23 +60,10 @@ def _perf_fair_read_ptbl(nii_fname):
     and fc outputs are diagnostic in case something goes wrong.
     """
     
-    # the *_ptbl.txt file will have the same name as the perfusion file itself,
-    # but with _ptbl.txt at the end rather than just .nii.gz. arguably this
-    # function should directly take the text file name as input, but it is
-    # difficult to envisage a scenario where this would be needed. the
-    # *_ptbl.txt file has a specific format created by
-    # sammba.io_conversions.dcm_to_nii. if someone supplies their own file
-    # name, it would mean they changed the *_ptbl.txt name (why?) or they have
-    # their own formatted text file which this function would not be able to
-    # process
-    
-    bfx = nii_fname.split('_')[-1].split('.')[0] # bfx = bruker folder number
-    ptbl = np.recfromcsv(nii_fname.replace(bfx + '.nii.gz', bfx + '_ptbl.txt'),
-                         delimiter='\t')
-    ti_list = ptbl.ti[np.logical_and(ptbl.slice == 1,
-                                     ptbl.fc == 'Selective Inversion')].tolist()
-    long_ti_list = ptbl.ti[ptbl.slice == 1].tolist()
-    fc_list = ptbl.fc[ptbl.slice == 1].tolist()
+    ptbl = _read_ptbl(nii_fname)
+    ti_list = ptbl.ti[ptbl.fc == 'Selective Inversion'].tolist()
+    long_ti_list = ptbl.ti.tolist()
+    fc_list = ptbl.fc.tolist()
     picker_sel = [n for n,x in enumerate(fc_list) if x == 'Selective Inversion']
     picker_nonsel = [n for n,x in enumerate(fc_list) if x == 'Non-selective Inversion']
     return {'TI':ti_list, 'long_TI':long_ti_list, 'FC':fc_list,
@@ -83,24 +71,31 @@ def _perf_fair_read_ptbl(nii_fname):
 
 
 # the perfusion fluid-attenuated inversion-recovery function
-# the jacobian should be callable but I do not know enough maths to create it
 # pars = parameters
 def _fair_t1_func(pars, s0, ti):
     
     return pars[0] + np.absolute(pars[1] * (1 - 2 * np.exp(-ti / pars[2]))) - s0
 
 
-def _fair_t1_fit(s0, ti, t1_guess):
+# its analytic jacobian, with respect to bias, M0 and T1
+def _fair_t1_jac(pars, s0, ti):
+
+    _, jacobian = _fair_t1_func_batch(np.atleast_2d(pars), np.atleast_2d(s0),
+                                      ti)
+    return jacobian[0]
+
+
+def _fair_t1_fit(s0, ti, t1_guess, x0=None):
     """
     Fit the perfusion FAIR equation:
         
         signal = bias + abs(M0 * (1 - 2 * (exp(-TI/T1))))
         
     using scipy.optimize.least_squares (default Trust Region Reflective
-    algorithm). Bias, M0 and T1 are all estimated with a zero lower bound.
-    Starting values for bias (zero) and M0 (mean of input signals) are
-    calculated automatically; T1 has to be supplied, with the mean of TIs
-    being a good guess.
+    algorithm) with the analytic jacobian of the equation. Bias, M0 and T1
+    are all estimated with a zero lower bound. Starting values for bias
+    (zero) and M0 (mean of input signals) are calculated automatically; T1
+    has to be supplied, with the mean of TIs being a good guess.
     
     Parameters
     ----------
@@ -113,6 +108,10 @@ def _fair_t1_fit(s0, ti, t1_guess):
     t1_guess : int or float
         An initial starting value for T1. The mean of TIs is a good guess.
 
+    x0 : list or numpy array of 3 floats or None, optional
+        Starting values for bias, M0 and T1, for instance from the fit of
+        neighbouring signals. If given, t1_guess is not used.
+
     Returns
     -------
     class scipy.optimize.OptimizeResult    
@@ -130,12 +129,16 @@ def _fair_t1_fit(s0, ti, t1_guess):
     scipy.optimize.least_squares with method='trf' (default).
     """
 
-    return ls(_fair_t1_func, np.array([0, np.mean(s0), t1_guess]),
+    if x0 is None:
+        x0 = [0, np.mean(s0), t1_guess]
+
+    return ls(_fair_t1_func, np.array(x0, dtype=float), jac=_fair_t1_jac,
               bounds=([0, 0, 0], np.inf), args=(s0, np.array(ti)))
 
 
 def _perf_fair_fit(s0, t1_blood, ti, t1_guess, picker_sel, picker_nonsel,
-                   lambda_blood=0.9, multiplier=6000000, outtype='simple'):
+                   lambda_blood=0.9, multiplier=6000000, outtype='simple',
+                   x0=None):
     """
     Wrapper to execute fair_t1_fit on a real signal vector containing both
     selective and non-selective inversions. Also calculates rCBF and absolute
@@ -181,6 +184,10 @@ def _perf_fair_fit(s0, t1_blood, ti, t1_guess, picker_sel, picker_nonsel,
         Changes return type. If 'simple', return a list of parameter, rCBF and
         absolute CBF values. If 'complicated', return the two classes of
         scipy.optimize.OptimizeResult plus rCBF and CBF values.
+
+    x0 : list or numpy array of 6 floats or None, optional
+        Starting values for the selective inversion bias, M0 and T1 then the
+        non-selective ones. If None, they are computed by _fair_t1_fit.
     
     Returns
     -------
@@ -206,8 +213,13 @@ def _perf_fair_fit(s0, t1_blood, ti, t1_guess, picker_sel, picker_nonsel,
     s0_sel = np.array(s0)[np.array(picker_sel)]
     s0_nonsel = np.array(s0)[np.array(picker_nonsel)]
 
-    r_sel = _fair_t1_fit(s0_sel, ti, t1_guess)
-    r_nonsel = _fair_t1_fit(s0_nonsel, ti, t1_guess)
+    if x0 is None:
+        x0_sel, x0_nonsel = None, None
+    else:
+        x0_sel, x0_nonsel = x0[:3], x0[3:]
+
+    r_sel = _fair_t1_fit(s0_sel, ti, t1_guess, x0=x0_sel)
+    r_nonsel = _fair_t1_fit(s0_nonsel, ti, t1_guess, x0=x0_nonsel)
     
     if r_sel.success and r_nonsel.success:
         
@@ -234,11 +246,309 @@ def _perf_fair_fit(s0, t1_blood, ti, t1_guess, picker_sel, picker_nonsel,
                     'rCBF nan', 'CBF nan']
 
 
+def _fair_t1_func_batch(pars, all_s0, ti):
+    """
+    Residuals of the perfusion FAIR equation and their analytic Jacobian, for
+    many signal vectors at once.
+
+    Parameters
+    ----------
+    pars : 2D numpy array of float
+        Bias, M0 and T1 of each signal vector, of shape (n_vectors, 3).
+
+    all_s0 : 2D numpy array of float
+        The aquired signals, of shape (n_vectors, len(ti)).
+
+    ti : numpy array of float
+        The inversion times.
+
+    Returns
+    -------
+    Tuple of the residuals, of shape (n_vectors, len(ti)), and of their
+    Jacobian with respect to bias, M0 and T1, of shape (n_vectors, len(ti), 3).
+    """
+    bias = pars[:, :1]
+    m0 = pars[:, 1:2]
+    t1 = pars[:, 2:]
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        ti_ratio = ti / t1
+        decay = np.exp(-ti_ratio)
+        inversion = 1 - 2 * decay
+        sign = np.sign(m0 * inversion)
+        residuals = bias + np.absolute(m0 * inversion) - all_s0
+
+        jacobian = np.empty(residuals.shape + (3,))
+        jacobian[..., 0] = 1
+        jacobian[..., 1] = sign * inversion
+        # d/dT1 of exp(-TI/T1) vanishes when the exponential underflows
+        jacobian[..., 2] = np.where(decay > 0,
+                                    -2 * sign * m0 * decay * ti_ratio / t1, 0)
+
+    return residuals, jacobian
+
+
+def _fair_t1_fit_batch(all_s0, ti, t1_guess, x0=None, **kwargs):
+    """
+    Fit the perfusion FAIR equation to many signal vectors at once, with
+    vectorized Levenberg-Marquardt iterations and the same zero lower bounds
+    and starting values as _fair_t1_fit.
+
+    Parameters
+    ----------
+    all_s0 : 2D numpy array of int or float
+        The aquired signals, one vector per row.
+
+    ti : list of int or float
+        The inversion times. Must have the same length as the rows of all_s0.
+
+    t1_guess : int or float
+        An initial starting value for T1. The mean of TIs is a good guess.
+
+    x0 : 2D numpy array of float or None, optional
+        Starting values for bias, M0 and T1 of each signal vector, of shape
+        (len(all_s0), 3). If given, t1_guess is not used.
+
+    kwargs : dict, optional
+        Additional keyword arguments passed to
+        sammba.modality_processors.utils._batch_least_squares.
+
+    Returns
+    -------
+    Tuple of the estimated bias, M0 and T1, of shape (len(all_s0), 3), and of
+    the boolean success of each fit.
+    """
+    all_s0 = np.asarray(all_s0, dtype=float)
+    if x0 is None:
+        x0 = np.zeros((all_s0.shape[0], 3))
+        x0[:, 1] = np.mean(all_s0, axis=1)
+        x0[:, 2] = t1_guess
+    return _batch_least_squares(_fair_t1_func_batch, x0, all_s0,
+                                args=(np.array(ti, dtype=float),),
+                                lower_bounds=[0, 0, 0], **kwargs)
+
+
+def _fair_t1_linear_fit_signs(all_s0, ti, sign, n_iter):
+    """
+    Alternated log-linear and linear least squares estimation of the bias,
+    M0 and T1 of many signal vectors, given the sign of the longitudinal
+    magnetization at each TI (see _fair_t1_linear_fit_batch).
+    """
+    bias = np.zeros(len(all_s0))
+    m0 = np.max(sign * all_s0, axis=1)
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        for _ in range(n_iter):
+            magnetization = sign * (all_s0 - bias[:, np.newaxis])
+            _, slope = _log_linear_fit(ti, m0[:, np.newaxis] - magnetization)
+            decay = np.exp(ti * slope[:, np.newaxis])
+            # signal = bias + sign * (M0 - A * decay), linear in bias, M0, A,
+            # whose normal equations only need sums as sign ** 2 = 1
+            signed_decay = sign * decay
+            normal = np.empty((len(all_s0), 3, 3))
+            normal[:, 0, 0] = normal[:, 1, 1] = len(ti)
+            normal[:, 0, 1] = normal[:, 1, 0] = np.sum(sign, axis=1)
+            normal[:, 0, 2] = normal[:, 2, 0] = -np.sum(signed_decay, axis=1)
+            normal[:, 1, 2] = normal[:, 2, 1] = -np.sum(decay, axis=1)
+            normal[:, 2, 2] = np.sum(decay ** 2, axis=1)
+            rhs = np.column_stack((np.sum(all_s0, axis=1),
+                                   np.sum(sign * all_s0, axis=1),
+                                   -np.sum(signed_decay * all_s0, axis=1)))
+            failed = ~(np.all(np.isfinite(normal), axis=(1, 2)) &
+                       np.all(np.isfinite(rhs), axis=1))
+            normal[failed] = np.eye(3)
+            rhs[failed] = 0
+            # Small ridge, so that degenerate designs remain solvable
+            normal += 1e-10 * np.trace(normal, axis1=1, axis2=2)[
+                :, np.newaxis, np.newaxis] * np.eye(3)
+            solution = np.linalg.solve(normal, rhs[..., np.newaxis])[..., 0]
+            solution[failed] = np.nan
+            bias, m0 = solution[:, 0], solution[:, 1]
+        t1 = -1. / slope
+
+    estimates = np.column_stack((np.maximum(bias, 0), m0, t1))
+    estimates[~(np.isfinite(bias) & np.isfinite(t1) & (t1 > 0) &
+                (m0 > 0))] = np.nan
+    return estimates
+
+
+def _fair_t1_linear_fit_batch(all_s0, ti, n_iter=50):
+    """
+    Closed-form estimates of the perfusion FAIR equation parameters for many
+    signal vectors at once, without nonlinear solver. The signals acquired
+    before the null point are assigned a negative longitudinal magnetization
+    M0 - A * exp(-TI/T1). T1 is then estimated by log-linear least squares
+    on M0 - magnetization, alternating with the linear least squares
+    estimation of the bias, M0 and A for the current T1, starting from a
+    zero bias and the maximal signal as M0. As the null point may lie on
+    either side of the minimal signal, both signs are tried for it and the
+    estimates with the smallest residuals are kept.
+
+    Parameters
+    ----------
+    all_s0 : 2D numpy array of int or float
+        The aquired signals, one vector per row.
+
+    ti : list of int or float
+        The inversion times. Must have the same length as the rows of all_s0.
+
+    n_iter : int, optional
+        Number of alternated estimations of T1 and of the other parameters.
+
+    Returns
+    -------
+    2D numpy array of shape (len(all_s0), 3), with the bias, M0 and T1 of each
+    signal vector. Negative biases are set to zero. Failed estimations
+    produce NaNs.
+    """
+    all_s0 = np.asarray(all_s0, dtype=float)
+    ti = np.asarray(ti, dtype=float)
+    null_index = np.argmin(all_s0, axis=1)[:, np.newaxis]
+    ti_index = np.arange(len(ti))
+    estimates = None
+    for sign in [np.where(ti_index < null_index, -1., 1.),
+                 np.where(ti_index <= null_index, -1., 1.)]:
+        sign_estimates = _fair_t1_linear_fit_signs(all_s0, ti, sign, n_iter)
+        residuals, _ = _fair_t1_func_batch(sign_estimates, all_s0, ti)
+        sum_squares = np.sum(residuals ** 2, axis=1)
+        if estimates is None:
+            estimates, best_sum_squares = sign_estimates, sum_squares
+        else:
+            better = (sum_squares < best_sum_squares) | np.isnan(
+                best_sum_squares)
+            estimates[better] = sign_estimates[better]
+
+    return estimates
+
+
+def _perf_fair_fit_batch(all_s0, t1_blood, ti, t1_guess, picker_sel,
+                         picker_nonsel, lambda_blood=0.9, multiplier=6000000,
+                         chunk_size=10000, all_x0=None):
+    """
+    Batched equivalent of _perf_fair_fit with outtype='simple', fitting
+    the selective and non-selective inversions of many signal vectors at once.
+
+    Parameters
+    ----------
+    all_s0 : 2D numpy array of int or float
+        The aquired signals. The first dimension is the number of s0 vectors,
+        the second dimension the length of all of them.
+
+    t1_blood : int or float
+        T1 of blood in ms at the acquisition field strength.
+
+    ti : list of int or float
+        The inversion times.
+
+    t1_guess : int or float
+        An initial starting value for T1. The mean of TIs is a good guess.
+
+    picker_sel : list or numpy array of int
+        Vector indicating positions of selectively inverted signals in s0.
+
+    picker_nonsel : list or numpy array of int
+        Vector indicating positions of non-selectively inverted signals in s0.
+
+    lambda_blood : float, optional
+        The assumed blood tissue partition coefficient of water in ml per g.
+
+    multiplier : int or float, optional
+        Converts the absolute CBF from ml per g per ms to the desired units.
+
+    chunk_size : int, optional
+        Number of signal vectors fitted together, to bound memory usage.
+
+    all_x0 : 2D numpy array of float or None, optional
+        Starting values of each vector, of shape (all_s0.shape[0], 6), for
+        the selective inversion bias, M0 and T1 then the non-selective ones.
+
+    Returns
+    -------
+    2D numpy array of shape (all_s0.shape[0], 8), with for each vector the
+    selective inversion bias, M0 and T1, non-selective inversion bias, M0 and
+    T1, plus rCBF and CBF. Failed fits produce zeroes.
+    """
+    all_s0 = np.asarray(all_s0, dtype=float)
+    picker_sel = np.array(picker_sel)
+    picker_nonsel = np.array(picker_nonsel)
+    results = np.zeros((all_s0.shape[0], 8))
+    for start in range(0, all_s0.shape[0], chunk_size):
+        s0 = all_s0[start:start + chunk_size]
+        if all_x0 is None:
+            x0_sel, x0_nonsel = None, None
+        else:
+            x0 = all_x0[start:start + chunk_size]
+            x0_sel, x0_nonsel = x0[:, :3], x0[:, 3:]
+        x_sel, success_sel = _fair_t1_fit_batch(s0[:, picker_sel], ti,
+                                                t1_guess, x0=x0_sel)
+        x_nonsel, success_nonsel = _fair_t1_fit_batch(s0[:, picker_nonsel],
+                                                      ti, t1_guess,
+                                                      x0=x0_nonsel)
+        rCBF, CBF = _fair_blood_flows(x_sel[:, 2], x_nonsel[:, 2], t1_blood,
+                                      lambda_blood, multiplier)
+        chunk_results = np.column_stack((x_sel, x_nonsel, rCBF, CBF))
+        chunk_results[~(success_sel & success_nonsel)] = 0
+        results[start:start + chunk_size] = chunk_results
+
+    return results
+
+
+def _fair_blood_flows(t1_sel, t1_nonsel, t1_blood, lambda_blood=0.9,
+                      multiplier=6000000):
+    """
+    Returns the rCBF and CBF derived from the selective and non-selective
+    inversion T1s, as _perf_fair_fit does.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rCBF = 100 * (t1_nonsel - t1_sel) / t1_nonsel
+        CBF = multiplier * lambda_blood * (
+            (t1_nonsel / t1_blood) * ((1 / t1_sel) - (1 / t1_nonsel)))
+    return rCBF, CBF
+
+
+def _perf_fair_linear_fit(all_s0, t1_blood, ti, picker_sel, picker_nonsel,
+                          lambda_blood=0.9, multiplier=6000000):
+    """
+    Closed-form approximation of _perf_fair_fit_batch, estimating the
+    selective and non-selective inversion parameters with
+    _fair_t1_linear_fit_batch instead of the nonlinear solver.
+
+    Returns
+    -------
+    2D numpy array of shape (all_s0.shape[0], 8) (see _perf_fair_fit_batch).
+    Failed estimations produce zeroes.
+    """
+    all_s0 = np.asarray(all_s0, dtype=float)
+    x_sel = _fair_t1_linear_fit_batch(all_s0[:, picker_sel], ti)
+    x_nonsel = _fair_t1_linear_fit_batch(all_s0[:, picker_nonsel], ti)
+    rCBF, CBF = _fair_blood_flows(x_sel[:, 2], x_nonsel[:, 2], t1_blood,
+                                  lambda_blood, multiplier)
+    results = np.column_stack((x_sel, x_nonsel, rCBF, CBF))
+    results[~np.all(np.isfinite(results), axis=1)] = 0
+    return results
+
+
+def _perf_fair_fit_rows(all_s0, t1_blood, ti, t1_guess, picker_sel,
+                        picker_nonsel, all_x0=None, **kwargs):
+    """
+    Wrapper to execute _perf_fair_fit (outtype='simple') on each row of
+    all_s0, possibly starting from the matching row of all_x0, returning a
+    2D numpy array of shape (all_s0.shape[0], 8).
+    """
+    if all_x0 is None:
+        all_x0 = [None] * len(all_s0)
+    return np.array([_perf_fair_fit(s0, t1_blood, ti, t1_guess, picker_sel,
+                                    picker_nonsel, x0=x0, **kwargs)
+                     for s0, x0 in zip(all_s0, all_x0)],
+                    dtype=float).reshape((-1, 8))
+
+
 def _perf_fair_fit_mp(all_s0, t1_blood, ti, t1_guess, picker_sel,
-                      picker_nonsel, ncpu=cpu_count() - 1, **kwargs):
+                      picker_nonsel, ncpu=cpu_count() - 1, chunk_size=None,
+                      method='trf', all_x0=None, **kwargs):
     """
     Wrapper to execute perf_fair_fitter (outtype='simple') in parallel on
-    multiple signal vectors, tracking execution with a progress bar.
+    multiple signal vectors, tracking execution with a progress bar. The
+    signal vectors are distributed to the processes by blocks, through
+    shared memory.
 
     Parameters
     ----------
@@ -273,31 +583,134 @@ def _perf_fair_fit_mp(all_s0, t1_blood, ti, t1_guess, picker_sel,
         Number of processes to launch in parallel. Defaults to using all but
         one of the available CPUs.
 
+    chunk_size : int or None, optional
+        Number of signal vectors sent at once to a process. If None, 100
+        vectors are sent for the 'trf' method and 5000 for the 'batch' one.
+
+    method : {'trf', 'batch'}, optional
+        If 'trf', each vector is fitted with _perf_fair_fit. If 'batch',
+        blocks of vectors are fitted at once with _perf_fair_fit_batch.
+
+    all_x0 : 2D numpy array of float or None, optional
+        Starting values of each vector, of shape (all_s0.shape[0], 6), for
+        the selective inversion bias, M0 and T1 then the non-selective ones.
+
     kwargs : dict, optional
-        Additional keyword arguments passed to perf_fair_fitter.
+        Additional keyword arguments passed to _perf_fair_fit or
+        _perf_fair_fit_batch.
 
     Returns
     -------
-    List of all_s0.shape[0] lists, each of 8 floats (see _perf_fair_fit).
+    2D numpy array of shape (all_s0.shape[0], 8) (see _perf_fair_fit).
     """
-    
-    # inspiration provided by:
-    # https://stackoverflow.com/q/5442910
-    # https://stackoverflow.com/a/45276885
-    
-    # cannot use a with statement in python 2.7; may cause problems
-    pool = Pool(processes=ncpu)
-    pool_iterator = pool.imap(partial(_perf_fair_fit, t1_blood=t1_blood,
-                                      ti=ti, t1_guess=t1_guess,
-                                      picker_sel=picker_sel,
-                                            picker_nonsel=picker_nonsel,
-                                            **kwargs),
-                                    all_s0)
-    return _iterate_and_show_progress(pool_iterator, len(all_s0))
+    if method == 'batch':
+        fit_rows = _perf_fair_fit_batch
+        default_chunk_size = 5000
+    else:
+        fit_rows = _perf_fair_fit_rows
+        default_chunk_size = 100
+    if chunk_size is None:
+        chunk_size = default_chunk_size
+    if all_x0 is None:
+        extra_data = None
+    else:
+        extra_data = {'all_x0': np.asarray(all_x0, dtype=float)}
+
+    # The fitting parameters are sent once to each process
+    return _apply_to_rows(partial(fit_rows, t1_blood=t1_blood, ti=ti,
+                                  t1_guess=t1_guess, picker_sel=picker_sel,
+                                  picker_nonsel=picker_nonsel, **kwargs),
+                          np.asarray(all_s0, dtype=float), 8,
+                          extra_data=extra_data, n_processes=ncpu,
+                          chunk_size=chunk_size)
+
+
+def _coarse_fair_x0(in_mat, mask, t1_blood, ti, t1_guess, picker_sel,
+                    picker_nonsel, factor=2, **kwargs):
+    """
+    Computes starting values for the fit of each masked voxel from the fit
+    of the image downsampled in-plane by the given factor, whose voxels are
+    the mean of the masked voxels they cover. Voxels whose coarse fit failed
+    start from the default values.
+    """
+    in_mat = np.asarray(in_mat, dtype=float)
+    in_shape = in_mat.shape[:2]
+    padding = [(0, -n % factor) for n in in_shape] + [(0, 0)]
+    weights = np.pad(mask.astype(float), padding, mode='constant')
+    data = np.pad(in_mat * mask[..., np.newaxis], padding + [(0, 0)],
+                  mode='constant')
+    nx, ny, nz = weights.shape[0] // factor, weights.shape[1] // factor, \
+        weights.shape[2]
+    weights = weights.reshape((nx, factor, ny, factor, nz)).sum(axis=(1, 3))
+    data = data.reshape((nx, factor, ny, factor, nz, -1)).sum(axis=(1, 3))
+    coarse_mask = weights > 0
+    coarse_s0 = data[coarse_mask] / weights[coarse_mask][:, np.newaxis]
+    coarse_x0 = np.zeros(weights.shape + (6,))
+    coarse_x0[coarse_mask] = _perf_fair_fit_mp(
+        coarse_s0, t1_blood, ti, t1_guess, picker_sel, picker_nonsel,
+        **kwargs)[:, :6]
+    x0 = coarse_x0.repeat(factor, axis=0).repeat(factor, axis=1)
+    x0 = x0[:in_shape[0], :in_shape[1]][mask]
+    return _fill_default_fair_x0(x0, in_mat[mask], t1_guess, picker_sel,
+                                 picker_nonsel)
+
+
+def _fill_default_fair_x0(x0, all_s0, t1_guess, picker_sel, picker_nonsel):
+    """
+    Replaces the starting values of the selective or non-selective inversion
+    parameters with a zero or undefined T1 by the default starting values.
+    """
+    x0 = np.array(x0, dtype=float)
+    for n, picker in enumerate([picker_sel, picker_nonsel]):
+        failed = ~(x0[:, 3 * n + 2] > 0)
+        x0[failed, 3 * n] = 0
+        x0[failed, 3 * n + 1] = np.mean(all_s0[failed][:, picker], axis=1)
+        x0[failed, 3 * n + 2] = t1_guess
+
+    return x0
+
+
+def _perf_fair_fit_volume(in_mat, mask, t1_blood, ti, t1_guess, picker_sel,
+                          picker_nonsel, warm_start=None, method='trf',
+                          **kwargs):
+    """
+    Fits the masked voxels of a 4D array, returning a 4D array of the eight
+    output parameters, with zeros outside the mask.
+    """
+    out_mat = np.zeros(in_mat.shape[:-1] + (8,))
+    all_s0 = np.asarray(in_mat[mask], dtype=float)
+    if len(all_s0) == 0:
+        return out_mat
+
+    if method == 'linear':
+        fit_kwargs = dict([(name, kwargs[name])
+                           for name in ['lambda_blood', 'multiplier']
+                           if name in kwargs])
+        out_mat[mask] = _perf_fair_linear_fit(all_s0, t1_blood, ti,
+                                              picker_sel, picker_nonsel,
+                                              **fit_kwargs)
+        return out_mat
+
+    kwargs['method'] = method
+    all_x0 = None
+    if warm_start == 'linear':
+        all_x0 = _fill_default_fair_x0(
+            _perf_fair_linear_fit(all_s0, t1_blood, ti, picker_sel,
+                                  picker_nonsel)[:, :6],
+            all_s0, t1_guess, picker_sel, picker_nonsel)
+    elif warm_start == 'coarse':
+        all_x0 = _coarse_fair_x0(in_mat, mask, t1_blood, ti, t1_guess,
+                                 picker_sel, picker_nonsel, **kwargs)
+    out_mat[mask] = _perf_fair_fit_mp(all_s0, t1_blood, ti, t1_guess,
+                                      picker_sel, picker_nonsel,
+                                      all_x0=all_x0, **kwargs)
+    return out_mat
 
 
 def perf_fair_nii_proc(nii_in_fname, t1_blood, ti, t1_guess, picker_sel,
-                       picker_nonsel, nii_out_fname=None, **kwargs):
+                       picker_nonsel, nii_out_fname=None, method='trf',
+                       mask_img=None, warm_start=None, slab_size=None,
+                       **kwargs):
     """
     Wrapper to execute perf_fair_fitter_mp on a NIfTI-1 image.
 
@@ -332,6 +745,38 @@ def perf_fair_nii_proc(nii_in_fname, t1_blood, ti, t1_guess, picker_sel,
         Output file path. If none, will be the same as the input file path,
         but suffixed with _proc.
 
+    mask_img : Niimg-like object, 'auto' or None, optional
+        Mask of the voxels to fit, with the same shape and affine as the
+        input. Voxels outside the mask are not fitted and are set to zero in
+        the output. If 'auto', the mask is computed with
+        nilearn.masking.compute_epi_mask, which thresholds the mean signal
+        to exclude the background. If None, all voxels are fitted.
+
+    method : {'trf', 'batch', 'linear'}, optional
+        If 'trf', each voxel is fitted separately with
+        scipy.optimize.least_squares. If 'batch', blocks of voxels are fitted
+        at once with vectorized Levenberg-Marquardt iterations, which is much
+        faster and matches the 'trf' fits within numerical tolerance. In both
+        cases, blocks of voxels are processed in parallel. If 'linear', the
+        parameters are only approximated by closed-form log-linear least
+        squares estimates, computed for all voxels at once, which is the
+        fastest but less accurate for noisy signals.
+
+    warm_start : {'coarse', 'linear'} or None, optional
+        If 'coarse', the image is first fitted at half its in-plane
+        resolution, and each voxel fit starts from the parameters of the
+        coarse voxel covering it instead of the default starting values,
+        which reduces the number of iterations. If 'linear', each voxel fit
+        starts from its closed-form log-linear estimates. Not used with the
+        'linear' method.
+
+    slab_size : int or None, optional
+        If given, the input is read and fitted by slabs of slab_size slices
+        along the third axis, through the array proxy of the image, and the
+        outputs are written to a memory-mapped temporary file within the
+        output directory, so that only one slab is held in memory. If None,
+        the whole image is loaded.
+
     kwargs : dict, optional
         Additional keyword arguments passed to _perf_fair_fit_mp.
 
@@ -344,18 +789,22 @@ def perf_fair_nii_proc(nii_in_fname, t1_blood, ti, t1_guess, picker_sel,
     Failed fits produce zero-valued voxels.
     """
 
-    nii_in = nib.load(nii_in_fname)
-    in_mat = nii_in.get_data()
-    all_s0 = in_mat.reshape((np.product(in_mat.shape[:-1]), in_mat.shape[-1]))
-    r = _perf_fair_fit_mp(all_s0, t1_blood, ti, t1_guess, picker_sel,
-                          picker_nonsel, **kwargs)
-    r = np.array(r)
-    img = nib.Nifti1Image(np.reshape(r, in_mat.shape[:-1] + (r.shape[1],)),
-                          nii_in.get_affine())
-    
+    if method not in ['trf', 'batch', 'linear']:
+        raise ValueError("method must be one of ['trf', 'batch', 'linear'], "
+                         "you entered {0}".format(method))
+    if warm_start not in [None, 'coarse', 'linear']:
+        raise ValueError("warm_start must be one of [None, 'coarse', "
+                         "'linear'], you entered {0}".format(warm_start))
+
     if nii_out_fname is None:
         nii_out_fname = nii_in_fname.replace('.nii.gz', '_proc.nii.gz')
-    return img.to_filename(nii_out_fname)
+
+    fit_volume = partial(_perf_fair_fit_volume, t1_blood=t1_blood, ti=ti,
+                         t1_guess=t1_guess, picker_sel=picker_sel,
+                         picker_nonsel=picker_nonsel, warm_start=warm_start,
+                         method=method, **kwargs)
+    return _fit_nii(nib.load(nii_in_fname), fit_volume, 8, nii_out_fname,
+                    mask_img=mask_img, slab_size=slab_size)
 
 
 def perf_fair_niiptbl_proc(nii_in_fname, t1_blood, **kwargs):
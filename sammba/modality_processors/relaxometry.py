@@ -0,0 +1,446 @@
+"""
+Voxelwise fitting of signal models, such as relaxation or diffusion decays,
+to 4D images with one volume per acquisition.
+"""
+import abc
+from multiprocessing import cpu_count
+from functools import partial
+import numpy as np
+import nibabel as nib
+from .utils import (_apply_to_rows, _batch_least_squares, _fit_nii,
+                    _log_linear_fit, _read_ptbl)
+from .perfusion_fair import (_fair_t1_func_batch, _fair_t1_linear_fit_batch,
+                             _perf_fair_fit_batch, _perf_fair_linear_fit,
+                             _perf_fair_read_ptbl)
+
+
+class SignalModel(abc.ABCMeta('_ABC', (object,), {})):
+    """ Base class of the signal models fitted voxelwise by
+    sammba.modality_processors.fit_voxelwise.
+
+    A model is fitted to many signal vectors at once by vectorized
+    Levenberg-Marquardt iterations. Subclasses define the parameters and
+    their lower bounds, the residuals and their Jacobian, and the starting
+    values, and may override `fit` to derive more outputs. Closed-form
+    estimates, used as starting values or as approximate fits, can be defined
+    too.
+
+    Attributes
+    ----------
+    `n_volumes` : int
+        Number of acquisitions, that is of volumes of the fitted images.
+
+    `output_names` : list of str
+        Names of the fitted outputs.
+
+    `lower_bounds` : list of float or None
+        Lower bounds of the parameters.
+    """
+    n_volumes = None
+    output_names = []
+    lower_bounds = None
+
+    @classmethod
+    def from_ptbl(cls, nii_fname, **kwargs):
+        """ Creates the model with the acquisition parameters read from the
+        *_ptbl.txt file written by sammba.io_conversions.dcm_to_nii next to
+        the *.nii.gz file.
+        """
+        raise ValueError('The acquisition parameters of {0} are not stored in '
+                         'the _ptbl.txt files'.format(cls.__name__))
+
+    @abc.abstractmethod
+    def residuals(self, pars, signals):
+        """ Returns the residuals of the model, of shape
+        (n_vectors, n_volumes), and their Jacobian with respect to the
+        parameters, of shape (n_vectors, n_volumes, n_parameters).
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def initial_parameters(self, signals):
+        """ Returns the starting parameters of each signal vector, of shape
+        (n_vectors, n_parameters).
+        """
+        raise NotImplementedError
+
+    def linear_estimates(self, signals):
+        """ Returns closed-form estimates of the parameters of each signal
+        vector, of shape (n_vectors, n_parameters), with NaNs for failed
+        estimations.
+        """
+        raise ValueError('{0} has no closed-form estimates'.format(
+            self.__class__.__name__))
+
+    def _initial_parameters(self, signals, default_parameters):
+        """ Returns the closed-form estimates, replaced by the given default
+        parameters where they failed.
+        """
+        x0 = self.linear_estimates(signals)
+        failed = ~np.all(np.isfinite(x0), axis=1)
+        x0[failed] = default_parameters[failed]
+        return x0
+
+    def fit(self, signals):
+        """ Fits the model to signal vectors.
+
+        Parameters
+        ----------
+        signals : 2D numpy array of float
+            The acquired signals, of shape (n_vectors, n_volumes).
+
+        Returns
+        -------
+        2D numpy array of shape (n_vectors, len(output_names)). Failed fits
+        produce zeroes.
+        """
+        signals = np.asarray(signals, dtype=float)
+        x, success = _batch_least_squares(self.residuals,
+                                          self.initial_parameters(signals),
+                                          signals,
+                                          lower_bounds=self.lower_bounds)
+        x[~(success & np.all(np.isfinite(x), axis=1))] = 0
+        return x
+
+    def fit_linear(self, signals):
+        """ Approximates the fit of the model to signal vectors by the
+        closed-form estimates of its parameters, without nonlinear solver.
+
+        Parameters
+        ----------
+        signals : 2D numpy array of float
+            The acquired signals, of shape (n_vectors, n_volumes).
+
+        Returns
+        -------
+        2D numpy array of shape (n_vectors, len(output_names)). Failed
+        estimations produce zeroes.
+        """
+        x = self.linear_estimates(np.asarray(signals, dtype=float))
+        x[~np.all(np.isfinite(x), axis=1)] = 0
+        return x
+
+
+class InversionRecoveryModel(SignalModel):
+    """ Magnitude inversion recovery model:
+
+        signal = bias + abs(M0 * (1 - 2 * exp(-TI / T1)))
+
+    Parameters
+    ----------
+    ti : list of int or float
+        The inversion times, one per volume.
+
+    t1_guess : int, float or None, optional
+        Starting value for T1. If None, the mean of TIs is used.
+    """
+    output_names = ['bias', 'M0', 'T1']
+    lower_bounds = [0, 0, 0]
+
+    def __init__(self, ti, t1_guess=None):
+        self.ti = np.asarray(ti, dtype=float)
+        self.t1_guess = t1_guess
+        self.n_volumes = len(self.ti)
+
+    @classmethod
+    def from_ptbl(cls, nii_fname, **kwargs):
+        return cls(_read_ptbl(nii_fname).ti.astype(float), **kwargs)
+
+    def residuals(self, pars, signals):
+        return _fair_t1_func_batch(pars, signals, self.ti)
+
+    def linear_estimates(self, signals):
+        return _fair_t1_linear_fit_batch(signals, self.ti)
+
+    def initial_parameters(self, signals):
+        t1_guess = self.t1_guess
+        if t1_guess is None:
+            t1_guess = np.mean(self.ti)
+        x0 = np.zeros((signals.shape[0], 3))
+        x0[:, 1] = np.mean(signals, axis=1)
+        x0[:, 2] = t1_guess
+        return self._initial_parameters(signals, x0)
+
+
+class ExponentialDecayModel(SignalModel):
+    """ Monoexponential relaxation decay, for multi-echo T2 or T2* mapping:
+
+        signal = M0 * exp(-TE / T2)
+
+    Parameters
+    ----------
+    echo_times : list of int or float
+        The echo times, one per volume.
+
+    time_constant_name : str, optional
+        Name of the fitted time constant, such as 'T2' or 'T2*'.
+    """
+    lower_bounds = [0, 0]
+
+    def __init__(self, echo_times, time_constant_name='T2'):
+        self.echo_times = np.asarray(echo_times, dtype=float)
+        self.time_constant_name = time_constant_name
+        self.n_volumes = len(self.echo_times)
+        self.output_names = ['M0', time_constant_name]
+
+    def residuals(self, pars, signals):
+        m0 = pars[:, :1]
+        t2 = pars[:, 1:]
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            te_ratio = self.echo_times / t2
+            decay = np.exp(-te_ratio)
+            residuals = m0 * decay - signals
+            jacobian = np.empty(residuals.shape + (2,))
+            jacobian[..., 0] = decay
+            # d/dT2 of exp(-TE/T2) vanishes when the exponential underflows
+            jacobian[..., 1] = np.where(decay > 0,
+                                        m0 * decay * te_ratio / t2, 0)
+
+        return residuals, jacobian
+
+    def linear_estimates(self, signals):
+        intercept, slope = _log_linear_fit(self.echo_times, signals)
+        with np.errstate(divide='ignore'):
+            estimates = np.column_stack((np.exp(intercept), -1. / slope))
+        estimates[~(slope < 0)] = np.nan
+        return estimates
+
+    def initial_parameters(self, signals):
+        x0 = np.empty((signals.shape[0], 2))
+        x0[:, 0] = np.max(signals, axis=1)
+        x0[:, 1] = np.mean(self.echo_times)
+        return self._initial_parameters(signals, x0)
+
+
+class DiffusionModel(SignalModel):
+    """ Monoexponential diffusion decay, for apparent diffusion coefficient
+    (ADC) mapping:
+
+        signal = S0 * exp(-b * ADC)
+
+    Parameters
+    ----------
+    bvals : list of int or float
+        The diffusion b-values, one per volume.
+    """
+    output_names = ['S0', 'ADC']
+    lower_bounds = [0, 0]
+
+    def __init__(self, bvals):
+        self.bvals = np.asarray(bvals, dtype=float)
+        if not np.any(self.bvals > 0):
+            raise ValueError('At least one b-value must be positive, you '
+                             'entered {0}'.format(bvals))
+        self.n_volumes = len(self.bvals)
+
+    @classmethod
+    def from_ptbl(cls, nii_fname, **kwargs):
+        return cls(_read_ptbl(nii_fname).bval.astype(float), **kwargs)
+
+    def residuals(self, pars, signals):
+        s0 = pars[:, :1]
+        adc = pars[:, 1:]
+        with np.errstate(over='ignore', invalid='ignore'):
+            decay = np.exp(-self.bvals * adc)
+            residuals = s0 * decay - signals
+            jacobian = np.empty(residuals.shape + (2,))
+            jacobian[..., 0] = decay
+            jacobian[..., 1] = -self.bvals * s0 * decay
+
+        return residuals, jacobian
+
+    def linear_estimates(self, signals):
+        intercept, slope = _log_linear_fit(self.bvals, signals)
+        estimates = np.column_stack((np.exp(intercept), -slope))
+        estimates[~(slope <= 0)] = np.nan
+        return estimates
+
+    def initial_parameters(self, signals):
+        x0 = np.empty((signals.shape[0], 2))
+        x0[:, 0] = np.max(signals, axis=1)
+        x0[:, 1] = 1. / np.mean(self.bvals[self.bvals > 0])
+        return self._initial_parameters(signals, x0)
+
+
+class FAIRModel(SignalModel):
+    """ Perfusion FAIR model, fitting inversion recovery curves to the
+    selectively and non-selectively inverted signals and deriving the
+    relative and absolute cerebral blood flows from their T1s. See
+    sammba.modality_processors.perf_fair_nii_proc.
+
+    Parameters
+    ----------
+    ti : list of int or float
+        The inversion times.
+
+    picker_sel : list of int
+        Positions of the selectively inverted volumes.
+
+    picker_nonsel : list of int
+        Positions of the non-selectively inverted volumes.
+
+    t1_blood : int or float
+        T1 of blood in ms at the acquisition field strength.
+
+    t1_guess : int, float or None, optional
+        Starting value for T1. If None, the mean of TIs is used.
+
+    lambda_blood : float, optional
+        Blood-brain partition coefficient.
+
+    multiplier : int or float, optional
+        Unit conversion factor of the CBF.
+    """
+    output_names = ['bias_sel', 'M0_sel', 'T1_sel', 'bias_nonsel',
+                    'M0_nonsel', 'T1_nonsel', 'rCBF', 'CBF']
+    lower_bounds = [0, 0, 0, 0, 0, 0]
+
+    def __init__(self, ti, picker_sel, picker_nonsel, t1_blood, t1_guess=None,
+                 lambda_blood=0.9, multiplier=6000000):
+        self.ti = np.asarray(ti, dtype=float)
+        self.picker_sel = picker_sel
+        self.picker_nonsel = picker_nonsel
+        self.t1_blood = t1_blood
+        self.t1_guess = t1_guess
+        self.lambda_blood = lambda_blood
+        self.multiplier = multiplier
+        self.n_volumes = len(picker_sel) + len(picker_nonsel)
+
+    @classmethod
+    def from_ptbl(cls, nii_fname, **kwargs):
+        ptbl_dict = _perf_fair_read_ptbl(nii_fname)
+        return cls(ptbl_dict['TI'], ptbl_dict['picker_sel'],
+                   ptbl_dict['picker_nonsel'], **kwargs)
+
+    def residuals(self, pars, signals):
+        """ Returns the residuals of the selective then non-selective
+        inversion recovery curves, and their block diagonal Jacobian with
+        respect to the bias, M0 and T1 of both curves.
+        """
+        residuals_sel, jacobian_sel = _fair_t1_func_batch(
+            pars[:, :3], signals[:, self.picker_sel], self.ti)
+        residuals_nonsel, jacobian_nonsel = _fair_t1_func_batch(
+            pars[:, 3:], signals[:, self.picker_nonsel], self.ti)
+        n_sel = residuals_sel.shape[1]
+        jacobian = np.zeros((signals.shape[0], self.n_volumes, 6))
+        jacobian[:, :n_sel, :3] = jacobian_sel
+        jacobian[:, n_sel:, 3:] = jacobian_nonsel
+        return np.hstack((residuals_sel, residuals_nonsel)), jacobian
+
+    def initial_parameters(self, signals):
+        t1_guess = self.t1_guess
+        if t1_guess is None:
+            t1_guess = np.mean(self.ti)
+        x0 = np.zeros((signals.shape[0], 6))
+        x0[:, 1] = np.mean(signals[:, self.picker_sel], axis=1)
+        x0[:, 2] = t1_guess
+        x0[:, 4] = np.mean(signals[:, self.picker_nonsel], axis=1)
+        x0[:, 5] = t1_guess
+        return x0
+
+    def fit(self, signals):
+        signals = np.asarray(signals, dtype=float)
+        return _perf_fair_fit_batch(signals, self.t1_blood, self.ti, None,
+                                    self.picker_sel, self.picker_nonsel,
+                                    lambda_blood=self.lambda_blood,
+                                    multiplier=self.multiplier,
+                                    all_x0=self.initial_parameters(signals))
+
+    def fit_linear(self, signals):
+        return _perf_fair_linear_fit(signals, self.t1_blood, self.ti,
+                                     self.picker_sel, self.picker_nonsel,
+                                     lambda_blood=self.lambda_blood,
+                                     multiplier=self.multiplier)
+
+
+def _fit_model_volume(in_mat, mask, model, method='nonlinear', ncpu=1,
+                      chunk_size=5000, verbose=True):
+    """ Fits a model to the masked voxels of a 4D array.
+    """
+    n_outputs = len(model.output_names)
+    out_mat = np.zeros(in_mat.shape[:-1] + (n_outputs,))
+    all_signals = np.asarray(in_mat[mask], dtype=float)
+    if len(all_signals) == 0:
+        return out_mat
+
+    if method == 'linear':
+        out_mat[mask] = model.fit_linear(all_signals)
+    else:
+        out_mat[mask] = _apply_to_rows(model.fit, all_signals, n_outputs,
+                                       n_processes=ncpu,
+                                       chunk_size=chunk_size,
+                                       verbose=verbose)
+    return out_mat
+
+
+def fit_voxelwise(nii_in_fname, model, nii_out_fname=None, mask_img=None,
+                  method='nonlinear', ncpu=cpu_count() - 1, chunk_size=5000,
+                  slab_size=None, verbose=True):
+    """ Fits a signal model to each voxel of a 4D image.
+
+    Parameters
+    ----------
+    nii_in_fname : str
+        Input file path, with one volume per acquisition.
+
+    model : sammba.modality_processors.SignalModel
+        The signal model, such as InversionRecoveryModel,
+        ExponentialDecayModel, DiffusionModel or FAIRModel. The acquisition
+        parameters can be read from the *_ptbl.txt file written by
+        sammba.io_conversions.dcm_to_nii with the model from_ptbl method.
+
+    nii_out_fname : str or None, optional
+        Output file path. If None, will be the same as the input file path,
+        but suffixed with _proc.
+
+    mask_img : Niimg-like object, 'auto' or None, optional
+        Mask of the voxels to fit, with the same shape and affine as the
+        input. Voxels outside the mask are set to zero in the output. If
+        'auto', the mask is computed with nilearn.masking.compute_epi_mask.
+        If None, all voxels are fitted.
+
+    method : {'nonlinear', 'linear'}, optional
+        If 'nonlinear', the model is fitted by nonlinear least squares,
+        starting from its closed-form estimates when available. If 'linear',
+        only the closed-form estimates, computed for all voxels at once, are
+        saved. They are approximate but much faster for the models whose
+        nonlinear fits need many iterations.
+
+    ncpu : int, optional
+        Number of processes to launch in parallel.
+
+    chunk_size : int, optional
+        Number of voxels fitted together by each process.
+
+    slab_size : int or None, optional
+        If given, the input is read and fitted by slabs of slab_size slices
+        along the third axis and the outputs are memory-mapped, so that only
+        one slab is held in memory. If None, the whole image is loaded.
+
+    verbose : bool, optional
+        If True, the progress is displayed.
+
+    Returns
+    -------
+    NIfTI-1 file saved to nii_out_fname, with one image per output of the
+    model, in the order of model.output_names. Failed fits produce
+    zero-valued voxels.
+    """
+    if method not in ['nonlinear', 'linear']:
+        raise ValueError("method must be one of ['nonlinear', 'linear'], you "
+                         "entered {0}".format(method))
+
+    nii_in = nib.load(nii_in_fname)
+    if len(nii_in.shape) != 4 or nii_in.shape[-1] != model.n_volumes:
+        raise ValueError('{0} expects 4D images with {1} volumes, {2} has '
+                         'shape {3}'.format(model.__class__.__name__,
+                                            model.n_volumes, nii_in_fname,
+                                            nii_in.shape))
+
+    if nii_out_fname is None:
+        nii_out_fname = nii_in_fname.replace('.nii.gz', '_proc.nii.gz')
+
+    fit_volume = partial(_fit_model_volume, model=model, method=method,
+                         ncpu=ncpu, chunk_size=chunk_size, verbose=verbose)
+    return _fit_nii(nii_in, fit_volume, len(model.output_names),
+                    nii_out_fname, mask_img=mask_img, slab_size=slab_size)
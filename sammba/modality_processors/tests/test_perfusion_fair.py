@@ -0,0 +1,231 @@
+import os
+import numpy as np
+import nibabel
+from nose import with_setup
+from nose.tools import assert_equal, assert_true
+from nilearn.datasets.tests import test_utils as tst
+from nilearn._utils.testing import assert_raises_regex
+from sammba.modality_processors import perfusion_fair
+
+
+def _simulate_fair_signals(n_voxels, noise_std=2., random_state=0):
+    rng = np.random.RandomState(random_state)
+    ti = np.array([35., 100., 200., 400., 700., 1000., 1500., 2000., 3000.,
+                   4000., 6000.])
+    t1_sel = rng.uniform(1200, 2500, n_voxels)
+    t1_nonsel = t1_sel * rng.uniform(1.02, 1.3, n_voxels)
+    m0 = rng.uniform(500, 1500, n_voxels)
+    bias = rng.uniform(0, 30, n_voxels)
+    picker_sel = list(range(0, 2 * len(ti), 2))
+    picker_nonsel = list(range(1, 2 * len(ti), 2))
+    all_s0 = np.empty((n_voxels, 2 * len(ti)))
+    for picker, t1 in [(picker_sel, t1_sel), (picker_nonsel, t1_nonsel)]:
+        all_s0[:, picker] = bias[:, np.newaxis] + np.abs(
+            m0[:, np.newaxis] * (1 - 2 * np.exp(-ti / t1[:, np.newaxis])))
+        all_s0[:, picker] += rng.normal(0, noise_std, (n_voxels, len(ti)))
+    return all_s0, ti, picker_sel, picker_nonsel
+
+
+def test_fair_t1_func_batch():
+    all_s0, ti, picker_sel, _ = _simulate_fair_signals(5)
+    all_s0 = all_s0[:, picker_sel]
+    pars = np.array([[3., 800., 1500.]] * 5)
+    residuals, jacobian = perfusion_fair._fair_t1_func_batch(pars, all_s0, ti)
+    np.testing.assert_array_almost_equal(
+        residuals[0], perfusion_fair._fair_t1_func(pars[0], all_s0[0], ti))
+
+    # Compare to finite differences
+    for n in range(3):
+        step = np.zeros(3)
+        step[n] = 1e-6 * pars[0, n]
+        shifted_residuals, _ = perfusion_fair._fair_t1_func_batch(
+            pars + step, all_s0, ti)
+        np.testing.assert_allclose(
+            (shifted_residuals - residuals) / step[n], jacobian[..., n],
+            rtol=1e-4, atol=1e-6)
+
+
+def test_perf_fair_fit_batch():
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(50)
+    t1_guess = np.mean(ti)
+    batch_results = perfusion_fair._perf_fair_fit_batch(
+        all_s0, 2800, ti, t1_guess, picker_sel, picker_nonsel, chunk_size=20)
+    assert_equal(batch_results.shape, (50, 8))
+    trf_results = np.array([
+        perfusion_fair._perf_fair_fit(s0, 2800, ti, t1_guess, picker_sel,
+                                      picker_nonsel) for s0 in all_s0])
+    # Check T1 values and blood flows match the per voxel fits
+    np.testing.assert_allclose(batch_results[:, [2, 5, 6, 7]],
+                               trf_results[:, [2, 5, 6, 7]], rtol=1e-3)
+
+    # Check failed fits produce zeros
+    all_s0[0] = np.nan
+    batch_results = perfusion_fair._perf_fair_fit_batch(
+        all_s0[:2], 2800, ti, t1_guess, picker_sel, picker_nonsel)
+    np.testing.assert_array_equal(batch_results[0], np.zeros(8))
+    assert_true(np.all(batch_results[1] != 0))
+
+
+def test_fair_t1_linear_fit_batch():
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(
+        30, noise_std=0)
+    all_s0 = all_s0[:, picker_sel]
+    x, _ = perfusion_fair._fair_t1_fit_batch(all_s0, ti, np.mean(ti))
+    # Check noiseless signals are recovered
+    np.testing.assert_allclose(
+        perfusion_fair._fair_t1_linear_fit_batch(all_s0, ti), x, rtol=1e-3,
+        atol=1e-2)
+
+    # Check failed estimations produce NaNs
+    all_s0[0] = np.nan
+    all_s0[1] = 100
+    estimates = perfusion_fair._fair_t1_linear_fit_batch(all_s0[:3], ti)
+    assert_true(np.all(np.isnan(estimates[:2])))
+    assert_true(np.all(np.isfinite(estimates[2])))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_perf_fair_nii_proc_mask():
+    shape = (16, 16, 8)
+    brain = np.zeros(shape, dtype=bool)
+    brain[3:13, 3:13, 1:7] = True
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(
+        brain.sum())
+    in_mat = np.zeros(shape + (all_s0.shape[1],))
+    in_mat[brain] = all_s0
+    in_file = os.path.join(tst.tmpdir, 'perf.nii.gz')
+    nibabel.Nifti1Image(in_mat, np.eye(4)).to_filename(in_file)
+    mask_img = nibabel.Nifti1Image(brain.astype(np.int8), np.eye(4))
+
+    out_file = os.path.join(tst.tmpdir, 'perf_proc.nii.gz')
+    expected = perfusion_fair._perf_fair_fit_batch(
+        all_s0, 2800, ti, np.mean(ti), picker_sel, picker_nonsel)
+    perfusion_fair.perf_fair_nii_proc(in_file, 2800, ti, np.mean(ti),
+                                      picker_sel, picker_nonsel,
+                                      nii_out_fname=out_file,
+                                      method='batch', mask_img=mask_img)
+    out_mat = nibabel.load(out_file).get_data()
+    assert_equal(out_mat.shape, shape + (8,))
+    np.testing.assert_array_equal(out_mat[~brain], 0)
+    np.testing.assert_allclose(out_mat[brain], expected)
+
+    # Check the automatic mask excludes the background
+    perfusion_fair.perf_fair_nii_proc(in_file, 2800, ti, np.mean(ti),
+                                      picker_sel, picker_nonsel,
+                                      nii_out_fname=out_file,
+                                      method='batch', mask_img='auto')
+    out_mat = nibabel.load(out_file).get_data()
+    np.testing.assert_array_equal(out_mat[~brain], 0)
+    assert_true(np.any(out_mat[brain, 2] > 0))
+
+    mask_img = nibabel.Nifti1Image(brain[..., :2].astype(np.int8), np.eye(4))
+    assert_raises_regex(ValueError,
+                        'mask_img must have the same shape and affine',
+                        perfusion_fair.perf_fair_nii_proc, in_file, 2800, ti,
+                        np.mean(ti), picker_sel, picker_nonsel,
+                        nii_out_fname=out_file, mask_img=mask_img)
+
+
+def test_perf_fair_fit_mp():
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(30)
+    t1_guess = np.mean(ti)
+    expected = np.array([
+        perfusion_fair._perf_fair_fit(s0, 2800, ti, t1_guess, picker_sel,
+                                      picker_nonsel) for s0 in all_s0])
+    for ncpu in [1, 2]:
+        results = perfusion_fair._perf_fair_fit_mp(
+            all_s0, 2800, ti, t1_guess, picker_sel, picker_nonsel,
+            ncpu=ncpu, chunk_size=7)
+        np.testing.assert_array_equal(results, expected)
+        results = perfusion_fair._perf_fair_fit_mp(
+            all_s0, 2800, ti, t1_guess, picker_sel, picker_nonsel,
+            ncpu=ncpu, chunk_size=7, method='batch')
+        np.testing.assert_allclose(results[:, [2, 5]], expected[:, [2, 5]],
+                                   rtol=1e-3)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_perf_fair_warm_start():
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(20)
+    t1_guess = np.mean(ti)
+    expected = np.array([
+        perfusion_fair._perf_fair_fit(s0, 2800, ti, t1_guess, picker_sel,
+                                      picker_nonsel) for s0 in all_s0])
+
+    # Check starting from the solution keeps it
+    results = perfusion_fair._perf_fair_fit_mp(
+        all_s0, 2800, ti, t1_guess, picker_sel, picker_nonsel, ncpu=1,
+        all_x0=expected[:, :6])
+    np.testing.assert_allclose(results, expected, rtol=1e-5, atol=1e-5)
+    results = perfusion_fair._perf_fair_fit_mp(
+        all_s0, 2800, ti, t1_guess, picker_sel, picker_nonsel, ncpu=1,
+        method='batch', all_x0=expected[:, :6])
+    np.testing.assert_allclose(results, expected, rtol=1e-3, atol=1e-3)
+
+    shape = (5, 4, 1)
+    in_file = os.path.join(tst.tmpdir, 'perf_warm.nii.gz')
+    nibabel.Nifti1Image(all_s0.reshape(shape + (-1,)),
+                        np.eye(4)).to_filename(in_file)
+    out_file = os.path.join(tst.tmpdir, 'perf_warm_proc.nii.gz')
+    for method in ['trf', 'batch']:
+        perfusion_fair.perf_fair_nii_proc(in_file, 2800, ti, t1_guess,
+                                          picker_sel, picker_nonsel,
+                                          nii_out_fname=out_file,
+                                          method=method, warm_start='coarse',
+                                          ncpu=1)
+        out_mat = nibabel.load(out_file).get_data()
+        np.testing.assert_allclose(out_mat.reshape((-1, 8))[:, [2, 5]],
+                                   expected[:, [2, 5]], rtol=1e-3)
+
+    # Check the linear estimates approximate the fits or start them
+    perfusion_fair.perf_fair_nii_proc(in_file, 2800, ti, t1_guess,
+                                      picker_sel, picker_nonsel,
+                                      nii_out_fname=out_file,
+                                      method='linear', ncpu=1)
+    out_mat = nibabel.load(out_file).get_data()
+    np.testing.assert_allclose(out_mat.reshape((-1, 8))[:, [2, 5]],
+                               expected[:, [2, 5]], rtol=5e-2)
+    perfusion_fair.perf_fair_nii_proc(in_file, 2800, ti, t1_guess,
+                                      picker_sel, picker_nonsel,
+                                      nii_out_fname=out_file, method='batch',
+                                      warm_start='linear', ncpu=1)
+    out_mat = nibabel.load(out_file).get_data()
+    np.testing.assert_allclose(out_mat.reshape((-1, 8))[:, [2, 5]],
+                               expected[:, [2, 5]], rtol=1e-3)
+
+    assert_raises_regex(ValueError, 'warm_start must be one of',
+                        perfusion_fair.perf_fair_nii_proc, in_file, 2800, ti,
+                        t1_guess, picker_sel, picker_nonsel,
+                        nii_out_fname=out_file, warm_start='neighbours')
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_perf_fair_nii_proc_slabs():
+    shape = (12, 12, 5)
+    brain = np.zeros(shape, dtype=bool)
+    brain[2:10, 2:10] = True
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(
+        brain.sum())
+    in_mat = np.zeros(shape + (all_s0.shape[1],))
+    in_mat[brain] = all_s0
+    in_file = os.path.join(tst.tmpdir, 'perf_slabs.nii')
+    nibabel.Nifti1Image(in_mat, np.eye(4)).to_filename(in_file)
+    out_file = os.path.join(tst.tmpdir, 'perf_slabs_proc.nii.gz')
+    slabs_out_file = os.path.join(tst.tmpdir, 'perf_slabs_proc2.nii.gz')
+    for mask_img, warm_start in [(None, None), ('auto', 'coarse')]:
+        perfusion_fair.perf_fair_nii_proc(
+            in_file, 2800, ti, np.mean(ti), picker_sel, picker_nonsel,
+            nii_out_fname=out_file, method='batch', mask_img=mask_img,
+            warm_start=warm_start, ncpu=1)
+        perfusion_fair.perf_fair_nii_proc(
+            in_file, 2800, ti, np.mean(ti), picker_sel, picker_nonsel,
+            nii_out_fname=slabs_out_file, method='batch', mask_img=mask_img,
+            warm_start=warm_start, slab_size=2, ncpu=1)
+        np.testing.assert_array_equal(
+            nibabel.load(slabs_out_file).get_data(),
+            nibabel.load(out_file).get_data())
+
+    assert_raises_regex(ValueError, 'slab_size must be a positive integer',
+                        perfusion_fair.perf_fair_nii_proc, in_file, 2800, ti,
+                        np.mean(ti), picker_sel, picker_nonsel,
+                        nii_out_fname=slabs_out_file, slab_size=0)
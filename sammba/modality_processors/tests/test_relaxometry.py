@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import nibabel
+from nose import with_setup
+from nose.tools import assert_equal
+from nilearn.datasets.tests import test_utils as tst
+from nilearn._utils.testing import assert_raises_regex
+from sammba.modality_processors import relaxometry
+from sammba.modality_processors.tests.test_perfusion_fair import \
+    _simulate_fair_signals
+
+
+def _write_ptbl(nii_fname, ti, bvals, fc):
+    names = ['repno', 'slice', 'diffdir', 'TI', 'bval', 'bvalXX', 'bvalXY',
+             'bvalXZ', 'bvalYY', 'bvalYZ', 'bvalZZ', 'slicepos', 'FC', 'DIV0']
+    rows = []
+    for n_slice in [1, 2]:
+        for n, (ti_value, bval, comment) in enumerate(zip(ti, bvals, fc)):
+            rows.append([n + 1, n_slice, 'NA', ti_value, bval] +
+                        ['NA'] * 6 + ['[0.0, 0.0, 0.0]', comment, n + 1])
+    np.savetxt(nii_fname.replace('.nii.gz', '_ptbl.txt'),
+               np.array(rows, dtype=str), fmt='%s', delimiter='\t',
+               header='\t'.join(names))
+
+
+def test_signal_model():
+    # Models must define their residuals and starting values
+    class IncompleteModel(relaxometry.SignalModel):
+        def residuals(self, pars, signals):
+            return signals, None
+
+    assert_raises_regex(TypeError, 'abstract', IncompleteModel)
+
+
+def test_models_fit():
+    rng = np.random.RandomState(0)
+    n_vectors = 40
+    m0 = rng.uniform(500, 1500, (n_vectors, 1))
+
+    # Multi-echo T2 decay
+    echo_times = np.arange(10., 130., 10.)
+    t2 = rng.uniform(20, 80, (n_vectors, 1))
+    model = relaxometry.ExponentialDecayModel(echo_times)
+    assert_equal(model.output_names, ['M0', 'T2'])
+    residuals, jacobian = model.residuals(np.hstack((m0, t2)),
+                                          np.zeros((n_vectors, 12)))
+    step = 1e-6 * t2
+    shifted_residuals, _ = model.residuals(np.hstack((m0, t2 + step)),
+                                           np.zeros((n_vectors, 12)))
+    np.testing.assert_allclose((shifted_residuals - residuals) / step,
+                               jacobian[..., 1], rtol=1e-4, atol=1e-6)
+    signals = m0 * np.exp(-echo_times / t2)
+    np.testing.assert_allclose(model.fit(signals), np.hstack((m0, t2)),
+                               rtol=1e-5)
+    np.testing.assert_allclose(model.fit_linear(signals),
+                               np.hstack((m0, t2)), rtol=1e-5)
+
+    # Diffusion decay
+    bvals = np.array([0., 100., 300., 600., 1000., 1500.])
+    adc = rng.uniform(5e-4, 2e-3, (n_vectors, 1))
+    model = relaxometry.DiffusionModel(bvals)
+    signals = m0 * np.exp(-bvals * adc)
+    np.testing.assert_allclose(model.fit(signals), np.hstack((m0, adc)),
+                               rtol=1e-5)
+    np.testing.assert_allclose(model.fit_linear(signals),
+                               np.hstack((m0, adc)), rtol=1e-5)
+    assert_raises_regex(ValueError, 'At least one b-value must be positive',
+                        relaxometry.DiffusionModel, [0, 0])
+
+    # Inversion recovery
+    ti = np.array([35., 100., 200., 400., 700., 1000., 1500., 2000., 3000.,
+                   4000., 6000.])
+    t1 = rng.uniform(1200, 2500, (n_vectors, 1))
+    model = relaxometry.InversionRecoveryModel(ti)
+    signals = 10 + np.abs(m0 * (1 - 2 * np.exp(-ti / t1)))
+    np.testing.assert_allclose(model.fit(signals)[:, 1:], np.hstack((m0, t1)),
+                               rtol=1e-5)
+    np.testing.assert_allclose(model.fit_linear(signals)[:, 1:],
+                               np.hstack((m0, t1)), rtol=1e-3)
+
+    # Failed fits produce zeros
+    signals[0] = np.nan
+    np.testing.assert_array_equal(model.fit(signals[:2])[0], np.zeros(3))
+    np.testing.assert_array_equal(model.fit_linear(signals[:2])[0],
+                                  np.zeros(3))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_fit_voxelwise():
+    shape = (4, 5, 2)
+    rng = np.random.RandomState(0)
+    bvals = np.array([0., 200., 500., 1000.])
+    adc = rng.uniform(5e-4, 2e-3, shape)
+    in_mat = 1000 * np.exp(-bvals * adc[..., np.newaxis])
+    in_file = os.path.join(tst.tmpdir, 'dwi_bf7.nii.gz')
+    nibabel.Nifti1Image(in_mat, np.eye(4)).to_filename(in_file)
+    _write_ptbl(in_file, ['NA'] * 4, bvals, ['NA'] * 4)
+
+    model = relaxometry.DiffusionModel.from_ptbl(in_file)
+    np.testing.assert_array_equal(model.bvals, bvals)
+    out_file = os.path.join(tst.tmpdir, 'dwi_bf7_adc.nii.gz')
+    for slab_size, method in [(None, 'nonlinear'), (1, 'nonlinear'),
+                              (None, 'linear')]:
+        relaxometry.fit_voxelwise(in_file, model, nii_out_fname=out_file,
+                                  method=method, ncpu=1, slab_size=slab_size)
+        out_mat = nibabel.load(out_file).get_data()
+        assert_equal(out_mat.shape, shape + (2,))
+        np.testing.assert_allclose(out_mat[..., 1], adc, rtol=1e-5)
+
+    assert_raises_regex(ValueError, 'method must be one of',
+                        relaxometry.fit_voxelwise, in_file, model,
+                        method='loglinear')
+
+    assert_raises_regex(ValueError, 'expects 4D images with 3 volumes',
+                        relaxometry.fit_voxelwise, in_file,
+                        relaxometry.DiffusionModel(bvals[1:]))
+    assert_raises_regex(ValueError, 'are not stored in the _ptbl.txt',
+                        relaxometry.ExponentialDecayModel.from_ptbl, in_file)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_fair_model():
+    all_s0, ti, picker_sel, picker_nonsel = _simulate_fair_signals(10)
+    model = relaxometry.FAIRModel(ti, picker_sel, picker_nonsel, 2800)
+    assert_equal(model.n_volumes, all_s0.shape[1])
+    assert_equal(len(model.output_names), 8)
+    out_mat = relaxometry._fit_model_volume(all_s0[:, np.newaxis], np.ones(
+        (10, 1), dtype=bool), model, chunk_size=3, verbose=False)
+    np.testing.assert_array_equal(
+        out_mat[:, 0],
+        relaxometry._perf_fair_fit_batch(all_s0, 2800, ti, np.mean(ti),
+                                         picker_sel, picker_nonsel))
+
+    # The generic fit of both inversion recovery curves gives the same T1s
+    signals = all_s0.astype(float)
+    x = relaxometry.SignalModel.fit(model, signals)
+    np.testing.assert_allclose(x[:, [2, 5]], out_mat[:, 0, [2, 5]],
+                               rtol=1e-3)
+
+    in_file = os.path.join(tst.tmpdir, 'perf_bf3.nii.gz')
+    _write_ptbl(in_file, np.repeat(ti, 2), ['NA'] * 2 * len(ti),
+                ['Selective Inversion', 'Non-selective Inversion'] * len(ti))
+    model = relaxometry.FAIRModel.from_ptbl(in_file, t1_blood=2800)
+    np.testing.assert_array_equal(model.ti, ti)
+    assert_equal(model.picker_sel, picker_sel)
+    assert_equal(model.picker_nonsel, picker_nonsel)
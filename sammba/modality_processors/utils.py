@@ -1,30 +1,410 @@
+import os
 import sys
 import time
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pool, RawArray
+import numpy as np
+import nibabel as nib
+from nilearn._utils.compat import _basestring
+from nilearn._utils.niimg_conversions import check_niimg_3d
 from nilearn.datasets.utils import _format_time
+from nilearn.masking import compute_epi_mask
 
+# Arrays shared with the worker processes, set by _init_shared_rows
+_shared_rows = {}
 
-def _iterate_and_show_progress(iterator, total_number):
+
+def _write_progress(n_so_far, total_number, t0):
+    total_percent = float(n_so_far) / total_number
+    dt = time.time() - t0
+    computation_rate = n_so_far / max(1e-8, float(dt))
+    # Minimum rate of 0.01 elements/s, to avoid dividing by zero.
+    time_remaining = (total_number - n_so_far) / max(0.01, computation_rate)
+
+    # Trailing whitespace is to erase extra char when message length
+    # varies
+    sys.stderr.write(
+        "\rComputed %d of %d (%.1f%%, %s remaining)  "
+        % (n_so_far, total_number, total_percent * 100,
+           _format_time(time_remaining)))
+
+
+@contextmanager
+def _process_pool(n_processes, initializer=None, initargs=()):
+    """ Pool of worker processes, closed and joined on exit and terminated
+    if an error occurs.
+    """
+    pool = Pool(processes=n_processes, initializer=initializer,
+                initargs=initargs)
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _to_shared(array):
+    buffer = RawArray('d', int(np.prod(array.shape)))
+    np.frombuffer(buffer).reshape(array.shape)[...] = array
+    return buffer, array.shape
+
+
+def _from_shared(buffer, shape):
+    return np.frombuffer(buffer).reshape(shape)
+
+
+def _init_shared_rows(function, shared_data, shared_extra_data,
+                      shared_output):
+    _shared_rows['function'] = function
+    _shared_rows['data'] = _from_shared(*shared_data)
+    _shared_rows['extra_data'] = dict(
+        [(name, _from_shared(*shared))
+         for name, shared in shared_extra_data.items()])
+    _shared_rows['output'] = _from_shared(*shared_output)
+
+
+def _apply_to_shared_rows(bounds):
+    start, stop = bounds
+    extra_blocks = dict([(name, array[start:stop]) for name, array
+                         in _shared_rows['extra_data'].items()])
+    _shared_rows['output'][start:stop] = _shared_rows['function'](
+        _shared_rows['data'][start:stop], **extra_blocks)
+    return stop - start
+
+
+def _apply_to_rows(function, data, n_outputs, extra_data=None, n_processes=1,
+                   chunk_size=100, verbose=True):
+    """ Applies a function to blocks of rows of a 2D array, possibly in
+    parallel. With several processes, the input and output arrays are shared
+    with the workers, which only receive the bounds of the blocks to process
+    and write their results directly into the output.
+
+    Parameters
+    ----------
+    function : callable
+        Called with a block of rows of data, of shape (n_rows, n_columns), it
+        returns an array of shape (n_rows, n_outputs). Must be picklable to
+        be used with several processes.
+
+    data : 2D numpy array
+        The input rows, for instance one signal vector per voxel.
+
+    n_outputs : int
+        Number of outputs per row.
+
+    extra_data : dict or None, optional
+        Other 2D arrays with as many rows as data, such as initial
+        parameters. The matching blocks of rows are passed to the function as
+        keyword arguments.
+
+    n_processes : int, optional
+        Number of processes to launch in parallel. If 1, the blocks are
+        processed within the current process.
+
+    chunk_size : int, optional
+        Number of rows of each block.
+
+    verbose : bool, optional
+        If True, the progress is displayed.
+
+    Returns
+    -------
+    2D numpy array of float, of shape (data.shape[0], n_outputs).
+    """
+    if extra_data is None:
+        extra_data = {}
+    n_rows = data.shape[0]
+    chunks = [(start, min(start + chunk_size, n_rows))
+              for start in range(0, n_rows, chunk_size)]
     t0 = time.time()
-    iterator_elements = []
-    initial_n = 0
-    for n_so_far in range(total_number):
-        iterator_elements.append(iterator.next())
-
-        # Estimate remaining download time
-        total_percent = float(n_so_far) / total_number
-    
-        current_download_size = n_so_far - initial_n
-        n_remaining = total_number - n_so_far
-        dt = time.time() - t0
-        computation_rate = current_download_size / max(1e-8, float(dt))
-        # Minimum rate of 0.01 bytes/s, to avoid dividing by zero.
-        time_remaining = n_remaining / max(0.01, computation_rate)
-    
-        # Trailing whitespace is to erase extra char when message length
-        # varies
-        sys.stderr.write(
-            "\rComputed %d of %d (%.1f%%, %s remaining)"
-            % (n_so_far, total_number, total_percent * 100,
-            _format_time(time_remaining)))
-        initial_n += 1
-    return iterator_elements
\ No newline at end of file
+    n_so_far = 0
+    if n_processes <= 1:
+        output = np.zeros((n_rows, n_outputs))
+        for start, stop in chunks:
+            extra_blocks = dict([(name, array[start:stop])
+                                 for name, array in extra_data.items()])
+            output[start:stop] = function(data[start:stop], **extra_blocks)
+            n_so_far += stop - start
+            if verbose:
+                _write_progress(n_so_far, n_rows, t0)
+        return output
+
+    shared_output = _to_shared(np.zeros((n_rows, n_outputs)))
+    initargs = (function, _to_shared(data),
+                dict([(name, _to_shared(array))
+                      for name, array in extra_data.items()]),
+                shared_output)
+    with _process_pool(n_processes, initializer=_init_shared_rows,
+                       initargs=initargs) as pool:
+        for n_rows_done in pool.imap_unordered(_apply_to_shared_rows, chunks):
+            n_so_far += n_rows_done
+            if verbose:
+                _write_progress(n_so_far, n_rows, t0)
+
+    return _from_shared(*shared_output)
+
+
+def _batch_least_squares(func, x0, data, args=(), lower_bounds=None,
+                         max_iter=200, ftol=1e-8, xtol=1e-8):
+    """ Solves many small bounded nonlinear least squares problems at once,
+    with Levenberg-Marquardt iterations vectorized across the problems and
+    steps projected onto the lower bounds.
+
+    Parameters
+    ----------
+    func : callable
+        Returns the residuals, of shape (n_problems, n_observations), and
+        their Jacobian, of shape (n_problems, n_observations, n_parameters),
+        when called as func(x, data, *args) with x of shape
+        (n_problems, n_parameters) and the matching rows of data.
+
+    x0 : numpy.ndarray of shape (n_problems, n_parameters)
+        Initial parameters.
+
+    data : numpy.ndarray of shape (n_problems, n_observations)
+        The observations, for instance one signal vector per voxel.
+
+    args : tuple, optional
+        Additional arguments passed to func.
+
+    lower_bounds : array-like of shape (n_parameters,) or None, optional
+        Lower bounds of the parameters. If None, parameters are unbounded.
+
+    max_iter : int, optional
+        Maximal number of iterations. Problems not converged by then are
+        considered failed.
+
+    ftol : float, optional
+        Tolerance on the relative decrease of the cost.
+
+    xtol : float, optional
+        Tolerance on the relative change of the parameters.
+
+    Returns
+    -------
+    x : numpy.ndarray of shape (n_problems, n_parameters)
+        The estimated parameters.
+
+    success : numpy.ndarray of bool, shape (n_problems,)
+        Whether each problem converged.
+    """
+    x = np.array(x0, dtype=float)
+    data = np.asarray(data, dtype=float)
+    n_problems, n_parameters = x.shape
+    if lower_bounds is not None:
+        lower_bounds = np.asarray(lower_bounds, dtype=float)
+        x = np.maximum(x, lower_bounds)
+
+    residuals, jacobian = func(x, data, *args)
+    cost = .5 * np.sum(residuals ** 2, axis=1)
+    damping = np.full(n_problems, 1e-3)
+    success = np.zeros(n_problems, dtype=bool)
+    active = np.isfinite(cost)
+    diagonal = np.arange(n_parameters)
+    for _ in range(max_iter):
+        indices = np.flatnonzero(active)
+        if indices.size == 0:
+            break
+
+        # Damped normal equations, one small system per problem
+        active_jacobian = jacobian[indices]
+        hessian = np.einsum('nki,nkj->nij', active_jacobian, active_jacobian)
+        gradient = np.einsum('nki,nk->ni', active_jacobian,
+                             residuals[indices])
+        scaling = hessian[:, diagonal, diagonal]
+        hessian[:, diagonal, diagonal] += damping[indices, np.newaxis] * (
+            scaling + 1e-12 * np.max(scaling, axis=1)[:, np.newaxis]) + 1e-300
+        if lower_bounds is not None:
+            # Parameters at their bound, pushed against it, are kept fixed
+            blocked = (x[indices] <= lower_bounds) & (gradient > 0)
+            hessian[blocked[:, :, np.newaxis] |
+                    blocked[:, np.newaxis, :]] = 0
+            hessian[:, diagonal, diagonal] += blocked
+            gradient[blocked] = 0
+        step = -np.linalg.solve(hessian, gradient[..., np.newaxis])[..., 0]
+
+        new_x = x[indices] + step
+        if lower_bounds is not None:
+            new_x = np.maximum(new_x, lower_bounds)
+        new_residuals, new_jacobian = func(new_x, data[indices], *args)
+        new_cost = .5 * np.sum(new_residuals ** 2, axis=1)
+
+        improved = np.isfinite(new_cost) & (new_cost < cost[indices])
+        small_decrease = cost[indices] - new_cost <= ftol * cost[indices]
+        small_step = np.all(np.abs(new_x - x[indices]) <=
+                            xtol * (xtol + np.abs(x[indices])), axis=1)
+
+        accepted = indices[improved]
+        x[accepted] = new_x[improved]
+        residuals[accepted] = new_residuals[improved]
+        jacobian[accepted] = new_jacobian[improved]
+        cost[accepted] = new_cost[improved]
+        damping[accepted] = np.maximum(damping[accepted] / 10., 1e-12)
+        damping[indices[~improved]] *= 10.
+
+        # Stop at a negligible improvement of a barely damped step, or when no
+        # damping can decrease the cost anymore
+        small_decrease &= damping[indices] <= 1e-2
+        converged = (improved & (small_decrease | small_step)) | \
+            (cost[indices] == 0) | (damping[indices] > 1e16)
+        success[indices[converged]] = True
+        active[indices[converged]] = False
+
+    return x, success
+
+
+def _read_ptbl(nii_fname):
+    """ Reads the acquisition parameters table saved as *_ptbl.txt by
+    sammba.io_conversions.dcm_to_nii next to the *.nii.gz file, keeping the
+    rows of the first slice, which are in the order of the volumes.
+    """
+    # the *_ptbl.txt file will have the same name as the *.nii.gz file
+    # itself, but with _ptbl.txt at the end rather than just .nii.gz. the
+    # *_ptbl.txt file has a specific format created by
+    # sammba.io_conversions.dcm_to_nii, which other converters do not follow
+    bfx = nii_fname.split('_')[-1].split('.')[0]  # bruker folder number
+    ptbl = np.recfromcsv(nii_fname.replace(bfx + '.nii.gz',
+                                           bfx + '_ptbl.txt'),
+                         delimiter='\t', encoding=None)
+    return ptbl[ptbl.slice == 1]
+
+
+def _iter_slabs(nii_in, slab_size):
+    """ Yields the bounds and the data of consecutive slabs of slab_size
+    slices, read one at a time through the array proxy of the image.
+    """
+    n_slices = nii_in.shape[2]
+    for start in range(0, n_slices, slab_size):
+        stop = min(start + slab_size, n_slices)
+        yield start, stop, np.asarray(nii_in.dataobj[:, :, start:stop],
+                                      dtype=float)
+
+
+def _get_mask(nii_in, mask_img, slab_size=None):
+    """ Returns the boolean array of the voxels of a 4D image to fit. If
+    slab_size is given, the image is read slab by slab.
+    """
+    if mask_img is None:
+        return np.ones(nii_in.shape[:-1], dtype=bool)
+
+    if isinstance(mask_img, _basestring) and mask_img == 'auto':
+        # Histogram based intensity threshold of the mean signal
+        if slab_size is None:
+            mask_img = compute_epi_mask(nii_in)
+        else:
+            mean_mat = np.zeros(nii_in.shape[:-1])
+            for start, stop, slab in _iter_slabs(nii_in, slab_size):
+                mean_mat[:, :, start:stop] = slab.mean(axis=-1)
+            mask_img = compute_epi_mask(nib.Nifti1Image(mean_mat,
+                                                        nii_in.affine))
+    else:
+        mask_img = check_niimg_3d(mask_img)
+        if mask_img.shape != nii_in.shape[:-1] or \
+                not np.allclose(mask_img.affine, nii_in.affine):
+            raise ValueError('mask_img must have the same shape and affine '
+                             'as the image {0}'.format(
+                                 nii_in.get_filename()))
+
+    return mask_img.get_data() != 0
+
+
+def _fit_nii(nii_in, fit_volume, n_outputs, nii_out_fname, mask_img=None,
+             slab_size=None):
+    """ Fits the voxels of a 4D image and saves the fitted parameters as a
+    4D image.
+
+    Parameters
+    ----------
+    nii_in : nibabel.Nifti1Image
+        The 4D image, with one volume per acquisition.
+
+    fit_volume : callable
+        Called as fit_volume(in_mat, mask) with a 4D array and the 3D boolean
+        array of the voxels to fit, it returns a 4D array of the n_outputs
+        parameters, with zeros outside the mask.
+
+    n_outputs : int
+        Number of output parameters per voxel.
+
+    nii_out_fname : str
+        Output file path.
+
+    mask_img : Niimg-like object, 'auto' or None, optional
+        Mask of the voxels to fit, with the same shape and affine as the
+        input. If 'auto', the mask is computed with
+        nilearn.masking.compute_epi_mask. If None, all voxels are fitted.
+
+    slab_size : int or None, optional
+        If given, the input is read and fitted by slabs of slab_size slices
+        along the third axis, through the array proxy of the image, and the
+        outputs are written to a memory-mapped temporary file within the
+        output directory, so that only one slab is held in memory. If None,
+        the whole image is loaded.
+    """
+    if slab_size is not None and slab_size < 1:
+        raise ValueError('slab_size must be a positive integer, you entered '
+                         '{0}'.format(slab_size))
+
+    mask = _get_mask(nii_in, mask_img, slab_size=slab_size)
+    if slab_size is None:
+        out_mat = fit_volume(nii_in.get_data(), mask)
+        img = nib.Nifti1Image(out_mat, nii_in.affine)
+        return img.to_filename(nii_out_fname)
+
+    out_dir = os.path.dirname(os.path.abspath(nii_out_fname))
+    with tempfile.TemporaryFile(dir=out_dir) as out_fp:
+        out_mat = np.memmap(out_fp, dtype=float, mode='w+',
+                            shape=nii_in.shape[:-1] + (n_outputs,))
+        for start, stop, slab in _iter_slabs(nii_in, slab_size):
+            out_mat[:, :, start:stop] = fit_volume(slab,
+                                                   mask[:, :, start:stop])
+        out_mat.flush()
+        # The memory-mapped outputs are written out by chunks
+        img = nib.Nifti1Image(out_mat, nii_in.affine)
+        return img.to_filename(nii_out_fname)
+
+
+def _log_linear_fit(x, signals):
+    """ Fits log(signal) = intercept + slope * x to many signal vectors at
+    once, by linear least squares weighted by the squared signals to
+    compensate for the amplification of the noise of low signals by the
+    logarithm. Non-positive signals are ignored.
+
+    Parameters
+    ----------
+    x : numpy array of float
+        The acquisition parameter of each signal, such as echo times or
+        b-values.
+
+    signals : 2D numpy array of float
+        The acquired signals, of shape (n_vectors, len(x)).
+
+    Returns
+    -------
+    intercept, slope : numpy arrays of float, of shape (n_vectors,)
+        NaN where less than two distinct x have positive signals.
+    """
+    x = np.asarray(x, dtype=float)
+    signals = np.asarray(signals, dtype=float)
+    positive = signals > 0
+    weights = np.where(positive, signals, 0) ** 2
+    log_signals = np.log(np.where(positive, signals, 1))
+    sum_w = np.sum(weights, axis=1)
+    sum_wx = np.sum(weights * x, axis=1)
+    sum_wxx = np.sum(weights * x ** 2, axis=1)
+    sum_wy = np.sum(weights * log_signals, axis=1)
+    sum_wxy = np.sum(weights * x * log_signals, axis=1)
+    determinant = sum_w * sum_wxx - sum_wx ** 2
+    # The determinant is zero up to rounding errors for a single distinct x
+    singular = determinant <= 1e-12 * sum_w * sum_wxx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(singular, np.nan,
+                         (sum_w * sum_wxy - sum_wx * sum_wy) / determinant)
+        intercept = (sum_wy - slope * sum_wx) / sum_w
+
+    return intercept, slope
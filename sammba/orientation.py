@@ -1,10 +1,10 @@
 import os
+import io
+import gzip
 import shutil
-import tempfile
 import numpy as np
 import nibabel
 from nilearn import image
-from nipype.caching import Memory
 from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces import afni
 
@@ -79,69 +79,124 @@ def _reset_affines(in_file, out_file, overwrite=False, axes_to_permute=None,
     nibabel.Nifti1Image(img.get_data(), sform, header).to_filename(out_file)
 
 
+_OBLIQUITY_FIELDS = ['qform_code', 'sform_code', 'quatern_b', 'quatern_c',
+                     'quatern_d', 'qoffset_x', 'qoffset_y', 'qoffset_z',
+                     'srow_x', 'srow_y', 'srow_z']
+
+# NIfTI extension code of the AFNI attributes
+_AFNI_ECODE = 4
+
+
+def _copy_obliquity_fields(header, reference_header):
+    """ Copies the qform and sform related fields and the voxels sizes from
+    the reference header.
+    """
+    for key in _OBLIQUITY_FIELDS:
+        header[key] = reference_header[key]
+    header['pixdim'][:4] = reference_header['pixdim'][:4]
+
+
+def _rewrite_nifti_header(fileobj, reference_header):
+    """ Rewrites in place the geometry of an opened uncompressed NIfTI file.
+    The voxels data are left untouched. AFNI extensions, which hold the
+    previous geometry, are marked to be ignored.
+    """
+    header = nibabel.Nifti1Header.from_fileobj(fileobj, check=False)
+    _copy_obliquity_fields(header, reference_header)
+    fileobj.seek(0)
+    fileobj.write(header.binaryblock)
+
+    int_dtype = np.dtype(header.endianness + 'i4')
+    vox_offset = int(header['vox_offset'])
+    fileobj.seek(348)
+    extender = fileobj.read(4)
+    if not extender or extender[0] == 0:
+        return
+
+    offset = 352
+    while offset + 8 <= vox_offset:
+        fileobj.seek(offset)
+        esize, ecode = np.frombuffer(fileobj.read(8), dtype=int_dtype)
+        if esize < 8:
+            break
+        if ecode == _AFNI_ECODE:
+            fileobj.seek(offset + 4)
+            fileobj.write(np.array(0, dtype=int_dtype).tobytes())
+        offset += int(esize)
+
+
 def fix_obliquity(to_fix_filename, reference_filename, caching=False,
                   caching_dir=None, overwrite=False,
-                  verbose=True, environ=None):
-    if caching_dir is None:
-        caching_dir = os.getcwd()
-    if caching:
-        memory = Memory(caching_dir)
+                  verbose=True, environ=None, in_place=False):
+    """ Copies the possibly oblique orientation of a reference image to an
+    image with the same grid. This is the equivalent of copying AFNI
+    attribute IJK_TO_DICOM_REAL with 3drefit -atrcopy, done on the NIfTI
+    header without calling AFNI.
 
-    if verbose:
-        terminal_output = 'allatonce'
-    else:
-        terminal_output = 'none'
+    Parameters
+    ----------
+    to_fix_filename : str
+        Path to the image to fix.
 
-    if environ is None:
-        if caching:
-            environ = {}
-        else:
-            environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    reference_filename : str
+        Path to the image with the orientation to copy.
+
+    caching : bool, optional
+        If True, an existing output newer than both inputs is not written
+        again.
+
+    caching_dir : str or None, optional
+        Unused, kept for backward compatibility.
+
+    overwrite : bool, optional
+        Unused, kept for backward compatibility.
 
-    if caching:
-        copy = memory.cache(afni.Copy)
-        refit = memory.cache(afni.Refit)
-        copy.interface().set_default_terminal_output(terminal_output)
-        refit.interface().set_default_terminal_output(terminal_output)
+    verbose : bool, optional
+        Unused, kept for backward compatibility.
+
+    environ : dict or None, optional
+        Unused, kept for backward compatibility.
+
+    in_place : bool, optional
+        If True, the header of `to_fix_filename` is rewritten in place.
+        Only uncompressed NIfTI files are accepted.
+
+    Returns
+    -------
+    fixed_filename : str
+        Path to the fixed image, `to_fix_filename` with suffix '_oblique' or
+        `to_fix_filename` itself if `in_place` is True.
+    """
+    output_type = _get_afni_output_type(to_fix_filename)
+    reference_header = nibabel.load(reference_filename).header
+    if in_place:
+        if output_type != 'NIFTI':
+            raise ValueError('Only uncompressed NIfTI files can be fixed in '
+                             'place, you provided {}'.format(to_fix_filename))
+        with open(to_fix_filename, 'r+b') as fileobj:
+            _rewrite_nifti_header(fileobj, reference_header)
+        return to_fix_filename
+
+    fixed_filename = fname_presuffix(to_fix_filename, suffix='_oblique')
+    if caching and os.path.isfile(fixed_filename):
+        fixed_mtime = os.path.getmtime(fixed_filename)
+        if (fixed_mtime >= os.path.getmtime(to_fix_filename) and
+                fixed_mtime >= os.path.getmtime(reference_filename)):
+            return fixed_filename
+
+    if output_type == 'NIFTI':
+        # Only copy the voxels data bytes
+        shutil.copyfile(to_fix_filename, fixed_filename)
+        with open(fixed_filename, 'r+b') as fileobj:
+            _rewrite_nifti_header(fileobj, reference_header)
     else:
-        copy = afni.Copy(terminal_output=terminal_output).run
-        refit = afni.Refit(terminal_output=terminal_output).run
-
-    tmp_folder = os.path.join(caching_dir, 'tmp')
-    if not os.path.isdir(tmp_folder):
-        os.makedirs(tmp_folder)
-
-    reference_basename = os.path.basename(reference_filename)
-    orig_reference_filename = fname_presuffix(os.path.join(
-        tmp_folder, reference_basename), suffix='+orig.BRIK',
-        use_ext=False)
-    out_copy_oblique = copy(in_file=reference_filename,
-                            out_file=orig_reference_filename,
-                            environ=environ)
-    orig_reference_filename = out_copy_oblique.outputs.out_file
-
-    to_fix_basename = os.path.basename(to_fix_filename)
-    orig_to_fix_filename = fname_presuffix(os.path.join(
-        tmp_folder, to_fix_basename), suffix='+orig.BRIK',
-        use_ext=False)
-    out_copy = copy(in_file=to_fix_filename,
-                    out_file=orig_to_fix_filename,
-                    environ=environ)
-    orig_to_fix_filename = out_copy.outputs.out_file
-
-    out_refit = refit(in_file=orig_to_fix_filename,
-                      atrcopy=(orig_reference_filename,
-                               'IJK_TO_DICOM_REAL'))
-
-    out_copy = copy(in_file=out_refit.outputs.out_file,
-                    out_file=fname_presuffix(to_fix_filename,
-                                             suffix='_oblique'),
-                    environ=environ)
-
-    if not caching:
-        shutil.rmtree(tmp_folder)
-
-    return out_copy.outputs.out_file
+        with gzip.open(to_fix_filename, 'rb') as fileobj:
+            nifti_bytes = io.BytesIO(fileobj.read())
+        _rewrite_nifti_header(nifti_bytes, reference_header)
+        with gzip.open(fixed_filename, 'wb', compresslevel=1) as fileobj:
+            fileobj.write(nifti_bytes.getvalue())
+
+    return fixed_filename
 
 
 def _check_same_obliquity(img_filename1, img_filename2):
@@ -1,8 +1,34 @@
 import os
 import nibabel
-from nipype.caching import Memory
 from nipype.interfaces import afni, ants, fsl
 from nipype.utils.filemanip import fname_presuffix
+from ..caching import _get_memory
+
+# Unifize defaults, as documented by AFNI 3dUnifize
+_UNIFIZE_DEFAULT_KWARGS = {'cl_frac': .1}
+
+# Unifize options which do not change the computed image
+_UNIFIZE_OUTPUT_KWARGS = ['quiet', 'environ', 'terminal_output', 'outputtype',
+                          'out_file']
+
+
+def _get_unifize_config(unifize_kwargs):
+    config = dict(_UNIFIZE_DEFAULT_KWARGS)
+    if unifize_kwargs is not None:
+        config.update(unifize_kwargs)
+    for key in _UNIFIZE_OUTPUT_KWARGS:
+        config.pop(key, None)
+    return config
+
+
+def _equivalent_unifize_kwargs(unifize_kwargs1, unifize_kwargs2):
+    """ Checks whether two sets of keyword arguments of
+    nipype.interfaces.afni.Unifize produce the same image, that is if they
+    only differ by default values or by output and verbosity options.
+    """
+    return _get_unifize_config(unifize_kwargs1) == \
+        _get_unifize_config(unifize_kwargs2)
+
 
 def _compute_n4_max_shrink(in_file):
     """ Computes the maximal allowed shrink factor for ANTS
@@ -34,7 +60,7 @@ def ants_n4(in_file, write_dir=None, caching=False,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         bias_correct = memory.cache(ants.N4BiasFieldCorrection)
         copy = memory.cache(afni.Copy)
         copy_geom = memory.cache(fsl.CopyGeom)
@@ -80,7 +106,7 @@ def afni_unifize(in_file, write_dir=None, out_file=None, caching=False,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         copy_geom = memory.cache(fsl.CopyGeom)
         unifize = memory.cache(afni.Unifize)
         copy = memory.cache(afni.Copy)
@@ -1,6 +1,6 @@
 import os
 from nose import with_setup
-from nose.tools import assert_true
+from nose.tools import assert_true, assert_false
 import nibabel
 from nilearn.datasets.tests import test_utils as tst
 from sammba.preprocessing import bias_correction
@@ -26,3 +26,15 @@ def test_afni_unifize():
                                                  verbose=False)
     assert_true(_check_same_fov(nibabel.load(unbiased_file),
                                 nibabel.load(in_file)))
+
+
+def test_equivalent_unifize_kwargs():
+    assert_true(bias_correction._equivalent_unifize_kwargs({}, None))
+    assert_true(bias_correction._equivalent_unifize_kwargs(
+        {'quiet': True}, {'cl_frac': .1, 'outputtype': 'NIFTI_GZ'}))
+    assert_false(bias_correction._equivalent_unifize_kwargs(
+        {'cl_frac': .2}, {}))
+    assert_false(bias_correction._equivalent_unifize_kwargs(
+        {'cl_frac': .3}, {}))
+    assert_false(bias_correction._equivalent_unifize_kwargs(
+        {'urad': 18.3}, {'quiet': True}))
@@ -1,12 +1,14 @@
 import os
-import fnmatch
-import glob
+import gzip
+import shutil
+import numpy as np
 import nibabel
-from nipype.caching import Memory
-from nipype.interfaces import afni, fsl
+from nipype.interfaces import afni
 from nipype.utils.filemanip import fname_presuffix
-from nipype.interfaces.fsl.base import Info
+from ..caching import _get_memory, _shared_write_dir
 from ..orientation import fix_obliquity
+from .utils import (_parallel_apply, _compose_affine_transforms,
+                    _write_affine_transform)
 
 
 def _delete_orientation(in_file, write_dir=None, min_zoom=.1, caching=False,
@@ -20,7 +22,7 @@ def _delete_orientation(in_file, write_dir=None, min_zoom=.1, caching=False,
         terminal_output = 'none'
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         copy = memory.cache(afni.Copy)
         refit = memory.cache(afni.Refit)
         center_mass = memory.cache(afni.CenterMass)
@@ -59,7 +61,7 @@ def _rigid_body_register(moving_head_file, reference_head_file,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         allineate = memory.cache(afni.Allineate)
         allineate2 = memory.cache(afni.Allineate)
         catmatvec = memory.cache(afni.CatMatvec)
@@ -127,7 +129,7 @@ def _warp(to_warp_file, reference_file, write_dir=None, caching=False,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         warp = memory.cache(afni.Warp)
     else:
         warp = afni.Warp().run
@@ -176,7 +178,7 @@ def _reorient(unifized_anat_file, unbiased_modality_file, write_dir,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         catmatvec = memory.cache(afni.CatMatvec)
     else:
         catmatvec = afni.CatMatvec().run
@@ -231,7 +233,7 @@ def _rigid_body_register_and_reorient(unifized_anat_file,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         catmatvec = memory.cache(afni.CatMatvec)
     else:
         catmatvec = afni.CatMatvec().run
@@ -272,45 +274,223 @@ def _rigid_body_register_and_reorient(unifized_anat_file,
     return registered_anat_oblique_file, transform_file
 
 
-def _get_fsl_slice_output_files(out_base_name, output_type):
-    ext = Info.output_type_to_ext(output_type)
-    suffix = '_slice_*' + ext
-    exact_pattern = '_slice_[0-9][0-9][0-9][0-9]' + ext
-    fname_template = os.path.abspath(
-        out_base_name + suffix)
-    fname_exact_pattern = os.path.abspath(
-        out_base_name + exact_pattern)
-    sliced_files = fnmatch.filter(sorted(glob.glob(fname_template)),
-                                  fname_exact_pattern)
+def _is_up_to_date(out_file, in_file):
+    return (os.path.isfile(out_file) and
+            os.path.getmtime(out_file) >= os.path.getmtime(in_file))
+
+
+def _slice_img(in_file, out_base_name, overwrite=True):
+    """ Splits an image along its third axis and saves each slice as an
+    uncompressed NIfTI file, with the affine of the slice position.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the 3D or 4D image to slice.
+
+    out_base_name : str
+        Base name of the output files. Slice k is saved to
+        `<out_base_name>_slice_<k>.nii`, with k padded to 4 digits.
+
+    overwrite : bool, optional
+        If False, the slices files newer than `in_file` are not written
+        again, so that their timestamp is kept.
+
+    Returns
+    -------
+    sliced_files : list of str
+        Paths to the slices files, ordered along the third axis.
+    """
+    img = nibabel.load(in_file)
+    sliced_files = ['{0}_slice_{1:04d}.nii'.format(out_base_name, k)
+                    for k in range(img.shape[2])]
+    if not overwrite and all([_is_up_to_date(sliced_file, in_file)
+                              for sliced_file in sliced_files]):
+        return sliced_files
+
+    data = img.get_data()
+    header = img.header.copy()
+    affine = img.affine
+    for k, sliced_file in enumerate(sliced_files):
+        slice_affine = affine.copy()
+        slice_affine[:3, 3] = affine[:3, :3].dot([0, 0, k]) + affine[:3, 3]
+        slice_img = nibabel.Nifti1Image(data[:, :, k:k + 1], slice_affine,
+                                        header)
+        slice_img.to_filename(sliced_file)
+
     return sliced_files
 
 
+def _merge_slices(sliced_files, merged_file):
+    """ Stacks single slice images along their third axis. The header of the
+    first slice is used for the merged image.
+
+    Parameters
+    ----------
+    sliced_files : list of str
+        Paths to the slices files, ordered along the third axis.
+
+    merged_file : str
+        Path to the output image.
+
+    Returns
+    -------
+    merged_file : str
+        Path to the merged image.
+    """
+    first_img = nibabel.load(sliced_files[0])
+    data = np.concatenate([nibabel.load(sliced_file).get_data()
+                           for sliced_file in sliced_files], axis=2)
+    merged_img = nibabel.Nifti1Image(data, first_img.affine,
+                                     first_img.header)
+    merged_img.to_filename(merged_file)
+    return merged_file
+
+
+def _qwarp_slice(sliced_to_qwarp_file, sliced_reference_file, voxel_size,
+                 resampled_voxel_size, resample, qwarp, per_slice_dir,
+                 caching=False, verbose=True, environ=None):
+    """ Non-linearly registers one slice to the corresponding reference slice,
+    then resamples it back to the initial resolution and restores its
+    obliquity.
+
+    Returns
+    -------
+    (oblique_slice, warp_file, output_files)
+        `warp_file` is None for slices without signal. `output_files` lists
+        the intermediate files that can be removed.
+    """
+    # The inverse warp frequently fails, Resampling can help it work better
+    resampled_files = []
+    for sliced_file in [sliced_reference_file, sliced_to_qwarp_file]:
+        out_resample = resample(
+            in_file=sliced_file,
+            voxel_size=resampled_voxel_size,
+            out_file=fname_presuffix(sliced_file, suffix='_resampled'),
+            environ=environ)
+        resampled_files.append(out_resample.outputs.out_file)
+
+    resampled_sliced_reference_file, resampled_sliced_to_qwarp_file = \
+        resampled_files
+    output_files = [resampled_sliced_reference_file,
+                    resampled_sliced_to_qwarp_file]
+
+    to_qwarp_data = nibabel.load(resampled_sliced_to_qwarp_file).get_data()
+    ref_data = nibabel.load(resampled_sliced_reference_file).get_data()
+    if to_qwarp_data.max() == 0 or ref_data.max() == 0:
+        # deal with slices where there is no signal
+        warped_slice = resampled_sliced_to_qwarp_file
+        warp_file = None
+    else:
+        warped_slice = fname_presuffix(resampled_sliced_to_qwarp_file,
+                                       suffix='_qwarped')
+        out_qwarp = qwarp(
+            in_file=resampled_sliced_to_qwarp_file,
+            base_file=resampled_sliced_reference_file,
+            noneg=True,
+            blur=[0],
+            nmi=True,
+            noXdis=True,
+            allineate=True,
+            allineate_opts='-parfix 1 0 -parfix 2 0 -parfix 3 0 '
+                           '-parfix 4 0 -parfix 5 0 -parfix 6 0 '
+                           '-parfix 7 0 -parfix 9 0 '
+                           '-parfix 10 0 -parfix 12 0',
+            out_file=warped_slice,
+            environ=environ,
+            verb=verbose)
+        # XXX fix qwarp bug : out_qwarp.outputs.warped_source extension is
+        # +tlrc.HEAD if base_file and in_file are of different extensions
+        warp_file = out_qwarp.outputs.source_warp
+        # There are files geenrated by the allineate option
+        output_files.extend([
+            warped_slice,
+            fname_presuffix(out_qwarp.outputs.warped_source,
+                            suffix='_Allin.nii', use_ext=False),
+            fname_presuffix(out_qwarp.outputs.warped_source,
+                            suffix='_Allin.aff12.1D', use_ext=False)])
+
+    # Resample the slice back to the initial resolution
+    out_resample = resample(in_file=warped_slice,
+                            voxel_size=voxel_size,
+                            out_file=fname_presuffix(warped_slice,
+                                                     suffix='_resampled'),
+                            environ=environ)
+
+    # fix the obliquity
+    oblique_slice = fix_obliquity(out_resample.outputs.out_file,
+                                  sliced_reference_file,
+                                  verbose=verbose,
+                                  caching=caching,
+                                  caching_dir=per_slice_dir,
+                                  environ=environ,
+                                  in_place=not caching)
+    output_files.append(oblique_slice)
+
+    return oblique_slice, warp_file, output_files
+
+
+def _warp_apply_slice(sliced_apply_to_file, warp_file, warp_apply,
+                      per_slice_dir, caching=False, verbose=True,
+                      environ=None):
+    """ Applies a precomputed warp to one slice and restores its obliquity.
+
+    Returns
+    -------
+    (oblique_slice, output_files)
+        `output_files` lists the intermediate files that can be removed.
+    """
+    if warp_file is None:
+        warped_apply_to_slice = sliced_apply_to_file
+        output_files = []
+    else:
+        out_warp_apply = warp_apply(in_file=sliced_apply_to_file,
+                                    master=sliced_apply_to_file,
+                                    warp=warp_file,
+                                    out_file=fname_presuffix(
+                                        sliced_apply_to_file,
+                                        suffix='_qwarped'),
+                                    environ=environ)
+        warped_apply_to_slice = out_warp_apply.outputs.out_file
+        output_files = [sliced_apply_to_file]
+
+    # The warped slice is an intermediate file, its header can be fixed in
+    # place
+    oblique_slice = fix_obliquity(warped_apply_to_slice,
+                                  sliced_apply_to_file,
+                                  verbose=verbose,
+                                  caching=caching,
+                                  caching_dir=per_slice_dir,
+                                  environ=environ,
+                                  in_place=not caching and
+                                  warp_file is not None)
+    output_files.append(oblique_slice)
+    return oblique_slice, output_files
+
+
 def _per_slice_qwarp(to_qwarp_file, reference_file,
                      voxel_size_x, voxel_size_y, apply_to_file=None,
                      write_dir=None,
                      caching=False,
-                     verbose=True, terminal_output='allatonce', environ=None):
+                     verbose=True, terminal_output='allatonce', environ=None,
+                     n_jobs=1):
     if write_dir is None:
-        write_dir = os.path.dirname(to_qwarp_file),
+        write_dir = os.path.dirname(to_qwarp_file)
 
     if environ is None:
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         resample = memory.cache(afni.Resample)
-        slicer = memory.cache(fsl.Slice)
         warp_apply = memory.cache(afni.NwarpApply)
         qwarp = memory.cache(afni.Qwarp)
-        merge = memory.cache(fsl.Merge)
-        for step in [resample, slicer, warp_apply, qwarp, merge]:
+        for step in [resample, warp_apply, qwarp]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
         resample = afni.Resample(terminal_output=terminal_output).run
-        slicer = fsl.Slice(terminal_output=terminal_output).run
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         qwarp = afni.Qwarp(terminal_output=terminal_output).run
-        merge = fsl.Merge(terminal_output=terminal_output).run
 
     # Slice anatomical image
     reference_img = nibabel.load(reference_file)
@@ -318,196 +498,91 @@ def _per_slice_qwarp(to_qwarp_file, reference_file,
     if not os.path.isdir(per_slice_dir):
         os.makedirs(per_slice_dir)
 
-    out_slicer = slicer(in_file=reference_file,
-                        out_base_name=fname_presuffix(reference_file,
-                                                      newpath=per_slice_dir,
-                                                      use_ext=False))
-    # XXX: workaround for nipype globbing to find slicer outputs
-    # Use out_slicer.outputs.out_files once fixed
-    sliced_reference_files = _get_fsl_slice_output_files(
-        out_slicer.inputs['out_base_name'], out_slicer.inputs['output_type'])
+    sliced_reference_files = _slice_img(
+        reference_file,
+        fname_presuffix(reference_file, newpath=per_slice_dir,
+                        use_ext=False),
+        overwrite=not caching)
 
     # Slice mean functional
-    out_slicer = slicer(in_file=to_qwarp_file,
-                        out_base_name=fname_presuffix(to_qwarp_file,
-                                                      newpath=per_slice_dir,
-                                                      use_ext=False))
-    sliced_to_qwarp_files = _get_fsl_slice_output_files(
-        out_slicer.inputs['out_base_name'], out_slicer.inputs['output_type'])
-
-    # Below line is to deal with slices where there is no signal (for example
-    # rostral end of some anatomicals)
+    sliced_to_qwarp_files = _slice_img(
+        to_qwarp_file,
+        fname_presuffix(to_qwarp_file, newpath=per_slice_dir, use_ext=False),
+        overwrite=not caching)
 
-    # The inverse warp frequently fails, Resampling can help it work better
+    # single slice non-linear functional to anatomical registration, the
+    # slices are processed independently
     # XXX why specifically .1 in voxel_size ?
     voxel_size_z = reference_img.header.get_zooms()[2]
-    resampled_sliced_reference_files = []
-    for sliced_reference_file in sliced_reference_files:
-        out_resample = resample(
-            in_file=sliced_reference_file,
-            voxel_size=(voxel_size_x, voxel_size_y, voxel_size_z),
-            out_file=fname_presuffix(sliced_reference_file,
-                                     suffix='_resampled'),
-            environ=environ)
-        resampled_sliced_reference_files.append(out_resample.outputs.out_file)
-
-    resampled_sliced_to_qwarp_files = []
-    for sliced_to_qwarp_file in sliced_to_qwarp_files:
-        out_resample = resample(
-            in_file=sliced_to_qwarp_file,
-            voxel_size=(voxel_size_x, voxel_size_y, voxel_size_z),
-            out_file=fname_presuffix(sliced_to_qwarp_file,
-                                     suffix='_resampled'),
-            environ=environ)
-        resampled_sliced_to_qwarp_files.append(
-            out_resample.outputs.out_file)
-
-    # single slice non-linear functional to anatomical registration
-    warped_slices = []
-    warp_files = []
-    output_files = []
-    resampled_sliced_to_qwarp_files_to_remove = []
-    for (resampled_sliced_to_qwarp_file,
-         resampled_sliced_reference_file) in zip(
-            resampled_sliced_to_qwarp_files,
-            resampled_sliced_reference_files):
-        warped_slice = fname_presuffix(resampled_sliced_to_qwarp_file,
-                                       suffix='_qwarped')
-        to_qwarp_data = nibabel.load(resampled_sliced_to_qwarp_file).get_data()
-        ref_data = nibabel.load(resampled_sliced_reference_file).get_data()
-
-        if to_qwarp_data.max() == 0 or ref_data.max() == 0:
-            # deal with slices where there is no signal
-            warped_slices.append(resampled_sliced_to_qwarp_file)
-            warp_files.append(None)
-        else:
-            resampled_sliced_to_qwarp_files_to_remove.append(resampled_sliced_to_qwarp_file)
-            out_qwarp = qwarp(
-                in_file=resampled_sliced_to_qwarp_file,
-                base_file=resampled_sliced_reference_file,
-                noneg=True,
-                blur=[0],
-                nmi=True,
-                noXdis=True,
-                allineate=True,
-                allineate_opts='-parfix 1 0 -parfix 2 0 -parfix 3 0 '
-                               '-parfix 4 0 -parfix 5 0 -parfix 6 0 '
-                               '-parfix 7 0 -parfix 9 0 '
-                               '-parfix 10 0 -parfix 12 0',
-                out_file=warped_slice,
-                environ=environ,
-                verb=verbose)
-            # XXX fix qwarp bug : out_qwarp.outputs.warped_source extension is
-            # +tlrc.HEAD if base_file and in_file are of different extensions
-            warped_slices.append(warped_slice)
-            warp_files.append(out_qwarp.outputs.source_warp)
-            # There are files geenrated by the allineate option
-            output_files.extend([
-                fname_presuffix(out_qwarp.outputs.warped_source,
-                                suffix='_Allin.nii', use_ext=False),
-                fname_presuffix(out_qwarp.outputs.warped_source,
-                                suffix='_Allin.aff12.1D', use_ext=False)])
-
-    # Resample the mean volume back to the initial resolution,
     voxel_size = nibabel.load(to_qwarp_file).header.get_zooms()[:3]
-    resampled_warped_slices = []
-    for warped_slice in warped_slices:
-        out_resample = resample(in_file=warped_slice,
-                                voxel_size=voxel_size,
-                                out_file=fname_presuffix(warped_slice,
-                                                         suffix='_resampled'),
-                                environ=environ)
-        resampled_warped_slices.append(out_resample.outputs.out_file)
-
-    # fix the obliquity
+    slices_outputs = _parallel_apply(
+        _qwarp_slice,
+        [dict(sliced_to_qwarp_file=sliced_to_qwarp_file,
+              sliced_reference_file=sliced_reference_file,
+              voxel_size=voxel_size,
+              resampled_voxel_size=(voxel_size_x, voxel_size_y,
+                                    voxel_size_z),
+              resample=resample, qwarp=qwarp, per_slice_dir=per_slice_dir,
+              caching=caching, verbose=verbose, environ=environ)
+         for (sliced_to_qwarp_file, sliced_reference_file) in zip(
+            sliced_to_qwarp_files, sliced_reference_files)],
+        n_jobs=n_jobs)
     oblique_resampled_warped_slices = []
-    for (sliced_reference_file, resampled_warped_slice) in zip(
-            sliced_reference_files, resampled_warped_slices):
-        oblique_slice = fix_obliquity(resampled_warped_slice,
-                                      sliced_reference_file,
-                                      verbose=verbose,
-                                      caching=caching,
-                                      caching_dir=per_slice_dir,
-                                      environ=environ)
+    warp_files = []
+    output_files = []
+    for (oblique_slice, warp_file, slice_output_files) in slices_outputs:
         oblique_resampled_warped_slices.append(oblique_slice)
+        warp_files.append(warp_file)
+        output_files.extend(slice_output_files)
 
-    out_merge_func = merge(
-        in_files=oblique_resampled_warped_slices,
-        dimension='z',
-        merged_file=fname_presuffix(to_qwarp_file, suffix='_perslice',
-                                    newpath=write_dir),
-        environ=environ)
+    merged_file = _merge_slices(
+        oblique_resampled_warped_slices,
+        fname_presuffix(to_qwarp_file, suffix='_perslice',
+                        newpath=write_dir))
 
     # Fix the obliquity
-    oblique_merged = fix_obliquity(out_merge_func.outputs.merged_file,
+    oblique_merged = fix_obliquity(merged_file,
                                    reference_file,
                                    verbose=verbose,
                                    caching=caching, caching_dir=per_slice_dir,
                                    environ=environ)
 
     # Collect the outputs
-    output_files.extend(sliced_reference_files +
-                        sliced_to_qwarp_files +
-                        resampled_sliced_reference_files +
-                        resampled_sliced_to_qwarp_files_to_remove +
-                        warped_slices + oblique_resampled_warped_slices)
+    output_files.extend(sliced_reference_files + sliced_to_qwarp_files)
 
     # Apply the precomputed warp slice by slice
     if apply_to_file is not None:
         # slice functional
-        out_slicer = slicer(in_file=apply_to_file,
-                            out_base_name=fname_presuffix(apply_to_file,
-                                                          newpath=per_slice_dir,
-                                                          use_ext=False))
-        sliced_apply_to_files = _get_fsl_slice_output_files(
-                out_slicer.inputs['out_base_name'],
-                out_slicer.inputs['output_type'])
-        warped_apply_to_slices = []
-        sliced_apply_to_files_to_remove = []
-        for (sliced_apply_to_file, warp_file) in zip(
-                sliced_apply_to_files, warp_files):
-            if warp_file is None:
-                warped_apply_to_slices.append(sliced_apply_to_file)
-            else:
-                sliced_apply_to_files_to_remove.append(sliced_apply_to_file)
-                out_warp_apply = warp_apply(in_file=sliced_apply_to_file,
-                                            master=sliced_apply_to_file,
-                                            warp=warp_file,
-                                            out_file=fname_presuffix(
-                                                sliced_apply_to_file,
-                                                suffix='_qwarped'),
-                                            environ=environ)
-                warped_apply_to_slices.append(out_warp_apply.outputs.out_file)
-
-        # Fix the obliquity
+        sliced_apply_to_files = _slice_img(
+            apply_to_file,
+            fname_presuffix(apply_to_file, newpath=per_slice_dir,
+                            use_ext=False),
+            overwrite=not caching)
+        slices_outputs = _parallel_apply(
+            _warp_apply_slice,
+            [dict(sliced_apply_to_file=sliced_apply_to_file,
+                  warp_file=warp_file, warp_apply=warp_apply,
+                  per_slice_dir=per_slice_dir, caching=caching,
+                  verbose=verbose, environ=environ)
+             for (sliced_apply_to_file, warp_file) in zip(
+                sliced_apply_to_files, warp_files)],
+            n_jobs=n_jobs)
         oblique_warped_apply_to_slices = []
-        for (sliced_apply_to_file, warped_apply_to_slice) in zip(
-                sliced_apply_to_files, warped_apply_to_slices):
-            oblique_slice = fix_obliquity(warped_apply_to_slice,
-                                          sliced_apply_to_file,
-                                          verbose=verbose,
-                                          caching=caching,
-                                          caching_dir=per_slice_dir,
-                                          environ=environ)
+        for (oblique_slice, slice_output_files) in slices_outputs:
             oblique_warped_apply_to_slices.append(oblique_slice)
+            output_files.extend(slice_output_files)
 
         # Finally, merge all slices !
-        out_merge_apply_to = merge(
-            in_files=oblique_warped_apply_to_slices,
-            dimension='z',
-            merged_file=fname_presuffix(apply_to_file, suffix='_perslice',
-                                        newpath=write_dir),
-            environ=environ)
+        merged_apply_to_file = _merge_slices(
+            oblique_warped_apply_to_slices,
+            fname_presuffix(apply_to_file, suffix='_perslice',
+                            newpath=write_dir))
 
         # Fix the obliquity
         merged_apply_to_file = fix_obliquity(
-            out_merge_apply_to.outputs.merged_file, apply_to_file,
+            merged_apply_to_file, apply_to_file,
             verbose=verbose, caching=caching,
             caching_dir=per_slice_dir, environ=environ)
-
-        # Update the outputs
-        output_files.extend(sliced_apply_to_files_to_remove +
-                            oblique_warped_apply_to_slices)
     else:
         merged_apply_to_file = None
 
@@ -524,30 +599,26 @@ def _apply_perslice_warp(apply_to_file, warp_files,
                          write_dir=None,
                          caching=False,
                          verbose=True, terminal_output='allatonce',
-                         environ=None):
+                         environ=None, n_jobs=1):
 
     # Apply the precomputed warp slice by slice
     if write_dir is None:
-        write_dir = os.path.dirname(apply_to_file),
+        write_dir = os.path.dirname(apply_to_file)
 
     if environ is None:
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         resample = memory.cache(afni.Resample)
-        slicer = memory.cache(fsl.Slice)
         warp_apply = memory.cache(afni.NwarpApply)
         qwarp = memory.cache(afni.Qwarp)
-        merge = memory.cache(fsl.Merge)
-        for step in [resample, slicer, warp_apply, qwarp, merge]:
+        for step in [resample, warp_apply, qwarp]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
         resample = afni.Resample(terminal_output=terminal_output).run
-        slicer = fsl.Slice(terminal_output=terminal_output).run
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         qwarp = afni.Qwarp(terminal_output=terminal_output).run
-        merge = fsl.Merge(terminal_output=terminal_output).run
 
     apply_to_img = nibabel.load(apply_to_file)
     n_slices = apply_to_img.header.get_data_shape()[2]
@@ -562,61 +633,37 @@ def _apply_perslice_warp(apply_to_file, warp_files,
         os.makedirs(per_slice_dir)
 
     # slice functional
-    sliced_apply_to_files = []
-    out_slicer = slicer(in_file=apply_to_file,
-                        out_base_name=fname_presuffix(apply_to_file,
-                                                      newpath=per_slice_dir,
-                                                      use_ext=False))
-    sliced_apply_to_files = _get_fsl_slice_output_files(
-        out_slicer.inputs['out_base_name'], out_slicer.inputs['output_type'])
-
-    warped_apply_to_slices = []
-    sliced_apply_to_files_to_remove = []
-    for (sliced_apply_to_file, warp_file) in zip(
-            sliced_apply_to_files, warp_files):
-        if warp_file is None:
-            warped_apply_to_slices.append(sliced_apply_to_file)
-        else:
-            sliced_apply_to_files_to_remove.append(sliced_apply_to_file)
-            out_warp_apply = warp_apply(in_file=sliced_apply_to_file,
-                                        master=sliced_apply_to_file,
-                                        warp=warp_file,
-                                        out_file=fname_presuffix(
-                                            sliced_apply_to_file,
-                                            suffix='_qwarped'),
-                                        environ=environ)
-            warped_apply_to_slices.append(out_warp_apply.outputs.out_file)
-
-    # Fix the obliquity
+    sliced_apply_to_files = _slice_img(
+        apply_to_file,
+        fname_presuffix(apply_to_file, newpath=per_slice_dir, use_ext=False),
+        overwrite=not caching)
+
+    slices_outputs = _parallel_apply(
+        _warp_apply_slice,
+        [dict(sliced_apply_to_file=sliced_apply_to_file,
+              warp_file=warp_file, warp_apply=warp_apply,
+              per_slice_dir=per_slice_dir, caching=caching,
+              verbose=verbose, environ=environ)
+         for (sliced_apply_to_file, warp_file) in zip(
+            sliced_apply_to_files, warp_files)],
+        n_jobs=n_jobs)
     oblique_warped_apply_to_slices = []
-    for (sliced_apply_to_file, warped_apply_to_slice) in zip(
-            sliced_apply_to_files, warped_apply_to_slices):
-        oblique_slice = fix_obliquity(warped_apply_to_slice,
-                                      sliced_apply_to_file,
-                                      verbose=verbose,
-                                      caching=caching,
-                                      caching_dir=per_slice_dir,
-                                      environ=environ)
+    for (oblique_slice, slice_output_files) in slices_outputs:
         oblique_warped_apply_to_slices.append(oblique_slice)
+        output_files.extend(slice_output_files)
 
     # Finally, merge all slices !
-    out_merge_apply_to = merge(
-        in_files=oblique_warped_apply_to_slices,
-        dimension='z',
-        merged_file=fname_presuffix(apply_to_file, suffix='_perslice',
-                                    newpath=write_dir),
-        environ=environ)
+    merged_apply_to_file = _merge_slices(
+        oblique_warped_apply_to_slices,
+        fname_presuffix(apply_to_file, suffix='_perslice',
+                        newpath=write_dir))
 
     # Fix the obliquity
     merged_apply_to_file = fix_obliquity(
-        out_merge_apply_to.outputs.merged_file, apply_to_file,
+        merged_apply_to_file, apply_to_file,
         verbose=verbose, caching=caching,
         caching_dir=per_slice_dir, environ=environ)
 
-    # Update the outputs
-    output_files.extend(sliced_apply_to_files_to_remove +
-                        oblique_warped_apply_to_slices)
-
     if not caching:
         for out_file in output_files:
             os.remove(out_file)
@@ -668,7 +715,7 @@ def _transform_to_template(to_register_filename, template_filename, write_dir,
         terminal_output = 'none'
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         warp_apply = memory.cache(afni.NwarpApply)
         resample = memory.cache(afni.Resample)
         warp_apply.interface().set_default_terminal_output(terminal_output)
@@ -678,17 +725,19 @@ def _transform_to_template(to_register_filename, template_filename, write_dir,
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         environ['AFNI_DECONFLICT'] = 'OVERWRITE'
 
-    current_dir = os.getcwd()
-    os.chdir(write_dir)
     normalized_filename = fname_presuffix(to_register_filename,
                                           suffix='_normalized')
 
     if voxel_size is None:
         resampled_template_filename = template_filename
     else:
-        out_resample = resample(in_file=template_filename,
-                                voxel_size=voxel_size,
-                                outputtype='NIFTI_GZ')
+        out_resample = resample(
+            in_file=template_filename,
+            voxel_size=voxel_size,
+            out_file=fname_presuffix(template_filename,
+                                     suffix='_resample.nii.gz', use_ext=False,
+                                     newpath=os.path.abspath(write_dir)),
+            outputtype='NIFTI_GZ')
         resampled_template_filename = out_resample.outputs.out_file
 
     transforms = [anat_to_template_warp_filename,
@@ -701,10 +750,197 @@ def _transform_to_template(to_register_filename, template_filename, write_dir,
                    master=resampled_template_filename,
                    warp=warp,
                    out_file=normalized_filename)
-    os.chdir(current_dir)
     return normalized_filename
 
 
+def _transform_steps(write_dir, caching=False, terminal_output='allatonce'):
+    """ Returns the resampling and transforms application steps, possibly
+    cached.
+    """
+    if caching:
+        memory = _get_memory(write_dir)
+        resample = memory.cache(afni.Resample)
+        allineate = memory.cache(afni.Allineate)
+        warp_apply = memory.cache(afni.NwarpApply)
+        nwarp_cat = memory.cache(afni.NwarpCat)
+        for step in [resample, allineate, warp_apply, nwarp_cat]:
+            step.interface().set_default_terminal_output(terminal_output)
+    else:
+        resample = afni.Resample(terminal_output=terminal_output).run
+        allineate = afni.Allineate(terminal_output=terminal_output).run
+        warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
+        nwarp_cat = afni.NwarpCat(terminal_output=terminal_output).run
+
+    return resample, allineate, warp_apply, nwarp_cat
+
+
+def _resample_target(target_filename, write_dir, resample, voxel_size=None,
+                     caching=False, environ=None):
+    if voxel_size is None:
+        return target_filename
+
+    if caching:
+        write_dir = _shared_write_dir([target_filename], write_dir,
+                                      voxel_size=voxel_size)
+
+    out_resample = resample(in_file=target_filename,
+                            voxel_size=voxel_size,
+                            out_file=fname_presuffix(target_filename,
+                                                     suffix='_resampled',
+                                                     newpath=write_dir),
+                            environ=environ)
+    return out_resample.outputs.out_file
+
+
+def _get_transformed_filename(to_register_filename, target_filename,
+                              write_dir):
+    target_basename = os.path.basename(target_filename)
+    target_basename = os.path.splitext(target_basename)[0]
+    target_basename = os.path.splitext(target_basename)[0]
+    return fname_presuffix(to_register_filename,
+                           suffix='_to_' + target_basename,
+                           newpath=write_dir)
+
+
+def _compose_transforms(transforms, write_dir, nwarp_cat,
+                        transforms_kind='nonlinear', inverse=False,
+                        out_basename=None, environ=None):
+    """ Composes a chain of transforms into a single transform file.
+
+    Parameters
+    ----------
+    transforms : list of str
+        List of transforms in order of 3dNWarpApply application.
+
+    write_dir : str
+        Directory to save the composed transform to. The composed transform
+        is named after the last transform of the chain, which lies in the
+        source space.
+
+    nwarp_cat : callable
+        The 3dNwarpCat step, used for nonlinear chains.
+
+    transforms_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
+        The kind of the transforms. Affine chains are composed with NumPy.
+
+    inverse : bool, optional
+        If True, the composed transform is inverted.
+
+    out_basename : str or None, optional
+        Name of the composed transform, without suffix nor extension. If
+        None, the name of the last transform of the chain is used. Chains
+        sharing their last transform must be given distinct names.
+
+    Returns
+    -------
+    composed_transform : str
+        Path to the composed transform, an .aff12.1D file or a warp
+        dataset.
+    """
+    if len(transforms) == 1 and not inverse:
+        return transforms[0]
+
+    if out_basename is None:
+        source_transform = os.path.basename(transforms[-1])
+        for extension in ['.aff12.1D', '.1D', '.nii.gz', '.nii']:
+            if source_transform.endswith(extension):
+                source_transform = source_transform[:-len(extension)]
+                break
+    else:
+        source_transform = out_basename
+
+    suffix = '_composed'
+    if inverse:
+        suffix += '_INV'
+
+    if transforms_kind != 'nonlinear':
+        return _write_affine_transform(
+            _compose_affine_transforms(transforms, inverse=inverse),
+            os.path.join(write_dir,
+                         source_transform + suffix + '.aff12.1D'))
+
+    out_nwarp_cat = nwarp_cat(
+        in_files=transforms,
+        inv_warp=inverse,
+        out_file=os.path.join(write_dir,
+                              source_transform + suffix + '.nii.gz'),
+        environ=environ)
+    return out_nwarp_cat.outputs.out_file
+
+
+def _resample_with_transform(to_register_filename, target_filename,
+                             transform, transformed_filename, allineate,
+                             warp_apply, transforms_kind='nonlinear',
+                             interpolation=None, inverse=False,
+                             caching=False, verbose=True, environ=None):
+    """ Resamples an image with a single transform, which can be a chain of
+    warps for 3dNwarpApply, then copies the target obliquity.
+
+    Returns
+    -------
+    transformed_filename : str
+        Path to the transformed image, with suffix '_oblique'.
+    """
+    oblique_filename = fname_presuffix(transformed_filename,
+                                       suffix='_oblique')
+    if caching:
+        resampled_filename = transformed_filename
+    else:
+        # Resample directly to the final path, uncompressed so that the
+        # obliquity can be fixed in place before a single compression
+        resampled_filename = oblique_filename
+        if resampled_filename.endswith('.gz'):
+            resampled_filename = resampled_filename[:-3]
+
+    if transforms_kind != 'nonlinear':
+        if interpolation is None:
+            _ = allineate(
+                in_file=to_register_filename,
+                master=target_filename,
+                in_matrix=transform,
+                out_file=resampled_filename,
+                environ=environ)
+        else:
+            _ = allineate(
+                in_file=to_register_filename,
+                master=target_filename,
+                in_matrix=transform,
+                final_interpolation=interpolation,
+                out_file=resampled_filename,
+                environ=environ)
+    else:
+        if interpolation is None:
+            _ = warp_apply(in_file=to_register_filename,
+                           master=target_filename,
+                           warp=transform,
+                           inv_warp=inverse,
+                           out_file=resampled_filename,
+                           environ=environ)
+        else:
+            _ = warp_apply(in_file=to_register_filename,
+                           master=target_filename,
+                           warp=transform,
+                           inv_warp=inverse,
+                           interp=interpolation,
+                           out_file=resampled_filename,
+                           environ=environ)
+
+    # XXX obliquity information is lost if resampling is done
+    if caching:
+        return fix_obliquity(resampled_filename, target_filename,
+                             verbose=verbose, caching=caching,
+                             environ=environ)
+
+    fix_obliquity(resampled_filename, target_filename, in_place=True)
+    if resampled_filename != oblique_filename:
+        with open(resampled_filename, 'rb') as f_in:
+            with gzip.open(oblique_filename, 'wb', compresslevel=1) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.remove(resampled_filename)
+
+    return oblique_filename
+
+
 def _apply_transforms(to_register_filename, target_filename,
                       write_dir,
                       transforms,
@@ -757,94 +993,119 @@ def _apply_transforms(to_register_filename, target_filename,
     else:
         terminal_output = 'none'
 
-    if caching:
-        memory = Memory(write_dir)
-        catmatvec = memory.cache(afni.CatMatvec)
-        allineate = memory.cache(afni.Allineate)
-        warp_apply = memory.cache(afni.NwarpApply)
-        resample = memory.cache(afni.Resample)        
-        for step in [resample, allineate, warp_apply]:
-            step.interface().set_default_terminal_output(terminal_output)
-    else:
-        resample = afni.Resample(terminal_output=terminal_output).run
-        catmatvec = afni.CatMatvec().run
-        allineate = afni.Allineate(terminal_output=terminal_output).run
-        warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
+    resample, allineate, warp_apply, _ = _transform_steps(
+        write_dir, caching=caching, terminal_output=terminal_output)
 
     if transformed_filename is None:
-        target_basename = os.path.basename(target_filename)
-        target_basename = os.path.splitext(target_basename)[0]
-        target_basename = os.path.splitext(target_basename)[0]
-        transformed_filename = fname_presuffix(
-            to_register_filename, suffix='_to_' + target_basename,
-            newpath=write_dir)
-
-    if voxel_size is None:
-        resampled_target_filename = target_filename
-    else:
-        out_resample = resample(in_file=target_filename,
-                                voxel_size=voxel_size,
-                                out_file=fname_presuffix(target_filename,
-                                                         suffix='_resampled',
-                                                         newpath=write_dir),
-                                environ=environ)
-        resampled_target_filename = out_resample.outputs.out_file
-    if transforms_kind is not 'nonlinear':
-        affine_transform_filename = fname_presuffix(transformed_filename,
-                                                    suffix='.aff12.1D',
-                                                    use_ext=False)
-        out_catmatvec = catmatvec(in_file=[(transform, 'ONELINE')
-                                           for transform in transforms],
-                                  oneline=True,
-                                  out_file=affine_transform_filename,
-                                  environ=environ)
+        transformed_filename = _get_transformed_filename(
+            to_register_filename, target_filename, write_dir)
+
+    resampled_target_filename = _resample_target(
+        target_filename, write_dir, resample, voxel_size=voxel_size,
+        caching=caching, environ=environ)
+    if transforms_kind != 'nonlinear':
+        # Compose the affine transforms, without calling AFNI
         if inverse:
-            affine_transform_filename = fname_presuffix(transformed_filename,
-                                                        suffix='_INV.aff12.1D',
-                                                        use_ext=False)
-            _ = catmatvec(in_file=[(out_catmatvec.outputs.out_file, 'I')],
-                          oneline=True,
-                          out_file=affine_transform_filename,
-                          environ=environ)
-        if interpolation is None:
-            _ = allineate(
-                in_file=to_register_filename,
-                master=resampled_target_filename,
-                in_matrix=affine_transform_filename,
-                out_file=transformed_filename,
-                environ=environ)
+            suffix = '_INV.aff12.1D'
         else:
-            _ = allineate(
-                in_file=to_register_filename,
-                master=resampled_target_filename,
-                in_matrix=affine_transform_filename,
-                final_interpolation=interpolation,
-                out_file=transformed_filename,
-                environ=environ)
+            suffix = '.aff12.1D'
+        transform = _write_affine_transform(
+            _compose_affine_transforms(transforms, inverse=inverse),
+            fname_presuffix(transformed_filename, suffix=suffix,
+                            use_ext=False))
     else:
-        warp = "'"
-        warp += " ".join(transforms)
-        warp += "'"
-        if interpolation is None:
-            _ = warp_apply(in_file=to_register_filename,
-                           master=resampled_target_filename,
-                           warp=warp,
-                           inv_warp=inverse,
-                           out_file=transformed_filename,
-                           environ=environ)
-        else:
-            _ = warp_apply(in_file=to_register_filename,
-                           master=resampled_target_filename,
-                           warp=warp,
-                           inv_warp=inverse,
-                           interp=interpolation,
-                           out_file=transformed_filename,
-                           environ=environ)
+        # 3dNwarpApply composes the chain on the fly
+        transform = "'"
+        transform += " ".join(transforms)
+        transform += "'"
+
+    return _resample_with_transform(
+        to_register_filename, resampled_target_filename, transform,
+        transformed_filename, allineate, warp_apply,
+        transforms_kind=transforms_kind, interpolation=interpolation,
+        inverse=inverse and transforms_kind == 'nonlinear',
+        caching=caching, verbose=verbose, environ=environ)
+
+
+def _apply_transforms_to_many(to_register_filenames, target_filename,
+                              write_dir, transforms,
+                              transforms_kind='nonlinear',
+                              interpolation=None, voxel_size=None,
+                              inverse=False, composed_basename=None,
+                              caching=False, verbose=True, n_jobs=1):
+    """ Applies the same successive transforms to several images. The
+    transforms are composed once, then the images are resampled in
+    parallel.
 
-    # XXX obliquity information is lost if resampling is done
-    transformed_filename = fix_obliquity(transformed_filename,
-                                         resampled_target_filename,
-                                         verbose=verbose, caching=caching,
-                                         caching_dir=write_dir,
-                                         environ=environ)
-    return transformed_filename
\ No newline at end of file
+    Parameters
+    ----------
+    to_register_filenames : list of str
+        Paths to the source files to register.
+
+    target_filename : str
+        Reference file to register to.
+
+    transforms : list
+        List of transforms in order of 3dNWarpApply application: first must
+        one must be in the target space and last one must be in
+        the source space.
+
+    transforms_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
+        The kind of the transforms.
+
+    interpolation : one of {'nearestneighbour', 'linear', 'cubic', 'quintic',
+                            'wsinc5'} or None, optional
+        Interpolation type. If None, AFNI defaults are used.
+
+    voxel_size : 3-tuple of floats, optional
+        Voxel size of the registered images, in mm.
+
+    inverse : bool, optional
+        If True, the transforms composition is inverted.
+
+    composed_basename : str or None, optional
+        Name of the composed transform, passed to _compose_transforms.
+
+    caching : bool, optional
+        Wether or not to use caching.
+
+    verbose : bool, optional
+        If True, all steps are verbose. Note that caching implies some
+        verbosity in any case.
+
+    n_jobs : int, optional
+        The number of images to resample in parallel. -1 means all CPUs.
+
+    Returns
+    -------
+    transformed_filenames : list of str
+        Paths to the registered images, in the same order as the inputs.
+    """
+    environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    if verbose:
+        terminal_output = 'allatonce'
+    else:
+        terminal_output = 'none'
+
+    resample, allineate, warp_apply, nwarp_cat = _transform_steps(
+        write_dir, caching=caching, terminal_output=terminal_output)
+
+    resampled_target_filename = _resample_target(
+        target_filename, write_dir, resample, voxel_size=voxel_size,
+        caching=caching, environ=environ)
+    composed_transform = _compose_transforms(
+        transforms, write_dir, nwarp_cat, transforms_kind=transforms_kind,
+        inverse=inverse, out_basename=composed_basename, environ=environ)
+
+    return _parallel_apply(
+        _resample_with_transform,
+        [dict(to_register_filename=to_register_filename,
+              target_filename=resampled_target_filename,
+              transform=composed_transform,
+              transformed_filename=_get_transformed_filename(
+                  to_register_filename, target_filename, write_dir),
+              allineate=allineate, warp_apply=warp_apply,
+              transforms_kind=transforms_kind, interpolation=interpolation,
+              caching=caching, verbose=verbose, environ=environ)
+         for to_register_filename in to_register_filenames],
+        n_jobs=n_jobs)
@@ -42,17 +42,22 @@ class Coregistrator(BaseRegistrator):
         Only values between 0.1 and 0.9 are accepted. Smaller fractions tend to
         make the mask larger. If None, no unifization is done for brain mask
         computation.
+
+    n_jobs : int, optional
+        The number of CPUs to use for the per-slice registration of EPI
+        modalities. -1 means all CPUs.
     """
     def __init__(self, brain_volume=None,
                  output_dir=None, caching=False,
                  verbose=True, use_rats_tool=True,
-                 clipping_fraction=.2):
+                 clipping_fraction=.2, n_jobs=1):
         self.brain_volume = brain_volume
         self.output_dir = output_dir
         self.use_rats_tool = use_rats_tool
         self.caching = caching
         self.verbose = verbose
         self.clipping_fraction = clipping_fraction
+        self.n_jobs = n_jobs
 
     def _check_inputs(self):
         if self.clipping_fraction is not None:
@@ -204,13 +209,15 @@ class Coregistrator(BaseRegistrator):
                 epi_brain_file=modality_brain_file,
                 reorient_only=reorient_only,
                 caching=self.caching,
-                verbose=self.verbose)
+                verbose=self.verbose,
+                n_jobs=self.n_jobs)
             setattr(self, '_{}_undistort_warps'.format(modality),
                     coregistration.coreg_warps_)
             if modality == 'func':
                 self.undistorted_func_ = _apply_perslice_warp(
                     allineated_file, self._func_undistort_warps, .1, .1,
-                    write_dir=self.output_dir, caching=self.caching)
+                    write_dir=self.output_dir, caching=self.caching,
+                    n_jobs=self.n_jobs)
             elif modality == 'perf':
                 self.undistorted_perf_ = coregistration.coreg_epi_
         else:
@@ -232,7 +239,8 @@ class Coregistrator(BaseRegistrator):
         if modality == 'func':
             self.undistorted_func_ = _apply_perslice_warp(
                 allineated_file, self._func_undistort_warps, .1, .1,
-                write_dir=self.output_dir, caching=self.caching)
+                write_dir=self.output_dir, caching=self.caching,
+                n_jobs=self.n_jobs)
         elif modality == 'perf':
             self.undistorted_perf_ = coregistration.coreg_epi_
         else:           
@@ -260,7 +268,7 @@ class Coregistrator(BaseRegistrator):
             coreg_apply_to_file = _apply_perslice_warp(
                 apply_to_file, self.__getattribute__(modality_undistort_warps),
                 .1, .1, write_dir=self.output_dir, caching=self.caching,
-                verbose=self.verbose)
+                verbose=self.verbose, n_jobs=self.n_jobs)
         else:
             transforms = [
                 self.get_params()['_{}_to_anat_transform'.format(modality)]]
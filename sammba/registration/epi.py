@@ -13,7 +13,7 @@ def _coregister_epi(unifized_anat_file,
                     reorient_only=False,
                     apply_to_file=None,
                     voxel_size_x=.1, voxel_size_y=.1, caching=False,
-                    verbose=True, **environ_kwargs):
+                    verbose=True, n_jobs=1, **environ_kwargs):
     """
     Coregistration of the subject's EPI and anatomical images.
     The EPI volume is aligned to the anatomical, first with a
@@ -40,6 +40,8 @@ def _coregister_epi(unifized_anat_file,
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+    n_jobs : int, optional
+        The number of slices to register in parallel. -1 means all CPUs.
     environ_kwargs : extra arguments keywords
         Extra arguments keywords, passed to interfaces environ variable.
 
@@ -107,7 +109,7 @@ def _coregister_epi(unifized_anat_file,
                          verbose=verbose,
                          write_dir=write_dir,
                          caching=caching, terminal_output=terminal_output,
-                         environ=environ)
+                         environ=environ, n_jobs=n_jobs)
 
     return Bunch(coreg_apply_to_=warped_apply_to_file,
                  coreg_epi_=warped_epi_file,
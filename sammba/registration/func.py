@@ -4,15 +4,16 @@ import numpy as np
 import nibabel
 from sklearn.datasets.base import Bunch
 from sklearn.utils import deprecated
-from nipype.caching import Memory
 from nipype.interfaces import afni, ants, fsl
 from nipype.utils.filemanip import fname_presuffix
 from nilearn._utils.exceptions import VisibleDeprecationWarning
 from sammba import segmentation
+from ..caching import _get_memory
 from ..orientation import fix_obliquity
 from .fmri_session import FMRISession
 from .struct import anats_to_template
 from .base import (_rigid_body_register, _warp, _per_slice_qwarp)
+from .utils import _parallel_apply
 
 
 def _realign(func_filename, write_dir, caching=False,
@@ -21,7 +22,7 @@ def _realign(func_filename, write_dir, caching=False,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         clip_level = memory.cache(afni.ClipLevel)
         threshold = memory.cache(fsl.Threshold)
         volreg = memory.cache(afni.Volreg)
@@ -111,7 +112,7 @@ def _slice_time(func_file, t_r, write_dir, caching=False,
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         tshift = memory.cache(afni.TShift)
         tshift.interface().set_default_terminal_output(terminal_output)
     else:
@@ -135,7 +136,7 @@ def coregister(unifized_anat_file, unbiased_mean_func_file, write_dir,
                prior_rigid_body_registration=None,
                reorient_only=False,
                voxel_size_x=.1, voxel_size_y=.1, caching=False,
-               verbose=True, **environ_kwargs):
+               verbose=True, n_jobs=1, **environ_kwargs):
     """
     Coregistration of the subject's functional and anatomical images.
     The functional volume is aligned to the anatomical, first with a
@@ -165,6 +166,8 @@ def coregister(unifized_anat_file, unbiased_mean_func_file, write_dir,
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+    n_jobs : int, optional
+        The number of slices to register in parallel. -1 means all CPUs.
     environ_kwargs : extra arguments keywords
         Extra arguments keywords, passed to interfaces environ variable.
 
@@ -199,7 +202,7 @@ def coregister(unifized_anat_file, unbiased_mean_func_file, write_dir,
         terminal_output = 'none'
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         catmatvec = memory.cache(afni.CatMatvec)
     else:
         catmatvec = afni.CatMatvec().run
@@ -267,7 +270,7 @@ def coregister(unifized_anat_file, unbiased_mean_func_file, write_dir,
                          voxel_size_y,
                          write_dir=write_dir, verbose=verbose,
                          caching=caching, terminal_output=terminal_output,
-                         environ=environ)
+                         environ=environ, n_jobs=n_jobs)
 
     # Update the outputs
     if not caching:
@@ -379,7 +382,7 @@ def coregister_fmri_session(session_data, t_r, write_dir, brain_volume,
         raise ValueError('Can not locate ANTS')
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         tshift = memory.cache(afni.TShift)
         clip_level = memory.cache(afni.ClipLevel)
         volreg = memory.cache(afni.Volreg)
@@ -833,7 +836,7 @@ def _func_to_template(func_coreg_filename, template_filename, write_dir,
         terminal_output = 'none'
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         resample = memory.cache(afni.Resample)
         catmatvec = memory.cache(afni.CatMatvec)
         allineate = memory.cache(afni.Allineate)
@@ -847,8 +850,6 @@ def _func_to_template(func_coreg_filename, template_filename, write_dir,
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         environ['AFNI_DECONFLICT'] = 'OVERWRITE'
 
-    current_dir = os.getcwd()
-    os.chdir(write_dir)  # XXX to remove
     normalized_filename = fname_presuffix(func_coreg_filename,
                                           suffix='_normalized')
     if voxel_size is None:
@@ -857,6 +858,9 @@ def _func_to_template(func_coreg_filename, template_filename, write_dir,
         out_resample = resample(in_file=template_filename,
                                 voxel_size=voxel_size,
                                 outputtype='NIFTI_GZ',
+                                out_file=fname_presuffix(
+                                    template_filename, suffix='_resample',
+                                    newpath=write_dir),
                                 environ=environ)
         func_template_filename = out_resample.outputs.out_file
 
@@ -884,10 +888,17 @@ def _func_to_template(func_coreg_filename, template_filename, write_dir,
                        warp=warp,
                        out_file=normalized_filename,
                        environ=environ)
-    os.chdir(current_dir)
     return normalized_filename
 
 
+def _coregister_session(session_data, **kwargs):
+    """ Coregisters one fMRI session and returns it, so that the updated
+    attributes are passed back from worker processes.
+    """
+    coregister_fmri_session(session_data, **kwargs)
+    return session_data
+
+
 @deprecated("Function 'fmri_sessions_to_template' is deprecated "
             "and will be removed in future release. Use class "
             "'TemplateRegistrator' instead.")
@@ -901,7 +912,7 @@ def fmri_sessions_to_template(sessions, t_r, head_template_filename,
                               registration_kind='nonlinear',
                               maxlev=2,
                               func_voxel_size=None,
-                              caching=False, verbose=True):
+                              caching=False, verbose=True, n_jobs=1):
     """ Registration of subject's functional and anatomical images to
     a given template.
 
@@ -952,6 +963,12 @@ def fmri_sessions_to_template(sessions, t_r, head_template_filename,
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
 
+    n_jobs : int, optional
+        The number of CPUs to use to process the sessions in parallel, both
+        for the coregistration and for the transform to the template. -1
+        means all CPUs. The anatomical registration to the template is done
+        once all sessions are coregistered.
+
     Returns
     -------
     the same sequence with each animal_data updated: the following attributes
@@ -1000,19 +1017,30 @@ def fmri_sessions_to_template(sessions, t_r, head_template_filename,
     if len(set(animals_ids)) != len(animals_ids):
         raise ValueError('Animals ids must be different. You'
                          ' provided {0}'.format(animals_ids))
-    for n, animal_data in enumerate(sessions):
+    coregistration_kwargs_list = []
+    for animal_data in sessions:
         animal_data._check_inputs()
         animal_output_dir = os.path.join(os.path.abspath(write_dir),
                                          animal_data.animal_id)
         animal_data._set_output_dir_(animal_output_dir)
         # XXX do a function for creating new attributes ?
         setattr(animal_data, "template_", head_template_filename)
-        coregister_fmri_session(
-            animal_data, t_r, write_dir, brain_volume,
+        coregistration_kwargs_list.append(dict(
+            session_data=animal_data, t_r=t_r, write_dir=write_dir,
+            brain_volume=brain_volume,
             use_rats_tool=use_rats_tool,
             prior_rigid_body_registration=prior_rigid_body_registration,
             slice_timing=slice_timing,
-            caching=caching, verbose=verbose)
+            caching=caching, verbose=verbose))
+
+    coregistered_sessions = _parallel_apply(_coregister_session,
+                                            coregistration_kwargs_list,
+                                            n_jobs=n_jobs)
+    for n, (animal_data, coregistered_data) in enumerate(zip(
+            sessions, coregistered_sessions)):
+        # Sessions processed in worker processes are copies
+        if coregistered_data is not animal_data:
+            animal_data._set_items(**vars(coregistered_data))
         sessions[n] = animal_data
 
     anat_filenames = [animal_data.anat for animal_data in sessions]
@@ -1032,20 +1060,26 @@ def fmri_sessions_to_template(sessions, t_r, head_template_filename,
         setattr(animal_data, "registered_anat_", normalized_anat_filename)
         sessions[n] = animal_data
 
-    for n, (animal_data, anat_to_template_oned_filename,
-            anat_to_template_warp_filename) in enumerate(zip(sessions,
-                anats_registration.pre_transforms,
-                anats_registration.transforms)):
-        normalized_func_filename = _func_to_template(
-            animal_data.coreg_func_,
-            head_template_filename,
-            animal_data.output_dir_,
-            animal_data.coreg_transform_,
-            anat_to_template_oned_filename,
-            anat_to_template_warp_filename,
+    normalization_kwargs_list = []
+    for (animal_data, anat_to_template_oned_filename,
+            anat_to_template_warp_filename) in zip(
+                sessions, anats_registration.pre_transforms,
+                anats_registration.transforms):
+        normalization_kwargs_list.append(dict(
+            func_coreg_filename=animal_data.coreg_func_,
+            template_filename=head_template_filename,
+            write_dir=animal_data.output_dir_,
+            func_to_anat_oned_filename=animal_data.coreg_transform_,
+            anat_to_template_oned_filename=anat_to_template_oned_filename,
+            anat_to_template_warp_filename=anat_to_template_warp_filename,
             voxel_size=func_voxel_size,
-            caching=caching, verbose=verbose)
+            caching=caching, verbose=verbose))
 
+    normalized_func_filenames = _parallel_apply(_func_to_template,
+                                                normalization_kwargs_list,
+                                                n_jobs=n_jobs)
+    for n, (animal_data, normalized_func_filename) in enumerate(zip(
+            sessions, normalized_func_filenames)):
         setattr(animal_data, "registered_func_", normalized_func_filename)
         sessions[n] = animal_data
 
@@ -1,10 +1,10 @@
 import warnings
 import os
 from sklearn.datasets.base import Bunch
-from nipype.caching import Memory
 from nipype.interfaces import afni
 from nipype.utils.filemanip import fname_presuffix
 from nilearn._utils.exceptions import VisibleDeprecationWarning
+from ..caching import _get_memory
 from .base import (_rigid_body_register, _warp, _per_slice_qwarp)
 
 
@@ -15,7 +15,7 @@ def coregister(unifized_anat_file,
                reorient_only=False,
                apply_to_file=None,
                voxel_size_x=.1, voxel_size_y=.1, caching=False,
-               verbose=True, **environ_kwargs):
+               verbose=True, n_jobs=1, **environ_kwargs):
     """
     Coregistration of the subject's M0 and anatomical images.
     The M0 volume is aligned to the anatomical, first with a
@@ -45,6 +45,8 @@ def coregister(unifized_anat_file,
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+    n_jobs : int, optional
+        The number of slices to register in parallel. -1 means all CPUs.
     environ_kwargs : extra arguments keywords
         Extra arguments keywords, passed to interfaces environ variable.
 
@@ -83,7 +85,7 @@ def coregister(unifized_anat_file,
         terminal_output = 'none'
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         catmatvec = memory.cache(afni.CatMatvec)
     else:
         catmatvec = afni.CatMatvec().run
@@ -144,7 +146,7 @@ def coregister(unifized_anat_file,
                          verbose=verbose,
                          write_dir=write_dir,
                          caching=caching, terminal_output=terminal_output,
-                         environ=environ)
+                         environ=environ, n_jobs=n_jobs)
 
     # Remove the intermediate outputs
     if not caching:
@@ -1,11 +1,231 @@
 import os
 from nipype.interfaces import afni, fsl
 from nipype.utils.filemanip import fname_presuffix
-from nipype.caching import Memory
 from sklearn.datasets.base import Bunch
 from sklearn.utils import deprecated
 from sammba import segmentation
+from ..caching import _get_memory, _get_cache_base_dir, pin_files
+from ..preprocessing.bias_correction import _equivalent_unifize_kwargs
 from ..orientation import fix_obliquity
+from .utils import (_parallel_apply, _list_files, _load_checkpoint,
+                    _save_checkpoint)
+
+
+def _center_anat(n, anat_file, write_dir, brain_volume, copy, unifize,
+                 clip_level, compute_mask, calc, center_mass, refit,
+                 verbosity_kwargs=None, brain_masking_unifize_kwargs=None,
+                 unifize_kwargs=None):
+    """ Copies one anatomical image, corrects it for bias, extracts its brain
+    and sets the header center of both brain and head to the brain center of
+    mass.
+
+    Returns
+    -------
+    3-tuple of str : Paths to the copied anatomical image, the centered
+        brain and the centered head.
+    """
+    if verbosity_kwargs is None:
+        verbosity_kwargs = {}
+    if brain_masking_unifize_kwargs is None:
+        brain_masking_unifize_kwargs = {}
+    if unifize_kwargs is None:
+        unifize_kwargs = {}
+
+    suffixed_file = fname_presuffix(anat_file, suffix='_{}'.format(n))
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_copy = copy(in_file=anat_file, out_file=out_file, **verbosity_kwargs)
+    copied_anat_file = out_copy.outputs.out_file
+
+    # bias correction for the image to be used for brain mask creation
+    out_unifize = unifize(in_file=copied_anat_file,
+                          out_file=fname_presuffix(
+                              copied_anat_file,
+                              suffix='_Unifized_for_brain_masking.nii.gz',
+                              use_ext=False),
+                          outputtype='NIFTI_GZ',
+                          **brain_masking_unifize_kwargs)
+    brain_masking_in_file = out_unifize.outputs.out_file
+
+    # brain mask creation
+    out_clip_level = clip_level(in_file=brain_masking_in_file)
+    out_compute_mask = compute_mask(
+        in_file=brain_masking_in_file,
+        out_file=fname_presuffix(brain_masking_in_file, suffix='_mask'),
+        volume_threshold=brain_volume,
+        intensity_threshold=int(out_clip_level.outputs.clip_val))
+    brain_mask_file = out_compute_mask.outputs.out_file
+
+    # bias correction for the image to be both brain-extracted with the mask
+    # generated above and then passed on to the rest of the pipeline
+    unifized_file = fname_presuffix(
+        copied_anat_file, suffix='_Unifized_for_brain_extraction.nii.gz',
+        use_ext=False)
+    if _equivalent_unifize_kwargs(brain_masking_unifize_kwargs,
+                                  unifize_kwargs):
+        # The bias correction is not repeated. Its output is copied, as the
+        # header of the head file is modified below.
+        out_copy = copy(in_file=brain_masking_in_file, out_file=unifized_file,
+                        **verbosity_kwargs)
+        unifized_file = out_copy.outputs.out_file
+    else:
+        out_unifize = unifize(in_file=copied_anat_file,
+                              out_file=unifized_file,
+                              outputtype='NIFTI_GZ',
+                              **unifize_kwargs)
+        unifized_file = out_unifize.outputs.out_file
+
+    # extract brain and set NIfTI image center (as defined in the header) to
+    # the brain CoM
+    out_calc_mask = calc(in_file_a=unifized_file,
+                         in_file_b=brain_mask_file,
+                         expr='a*b',
+                         out_file=fname_presuffix(unifized_file,
+                                                  suffix='_calc'),
+                         outputtype='NIFTI_GZ')
+    out_center_mass = center_mass(
+        in_file=out_calc_mask.outputs.out_file,
+        cm_file=fname_presuffix(unifized_file, suffix='_cm.txt',
+                                use_ext=False),
+        set_cm=(0, 0, 0))
+    brain_file = out_center_mass.outputs.out_file
+
+    # apply center change to head file too
+    out_refit = refit(in_file=unifized_file, duporigin_file=brain_file)
+    head_file = out_refit.outputs.out_file
+
+    return copied_anat_file, brain_file, head_file
+
+
+def _resample_to_center(brain_file, head_file, master_file, resample):
+    """ Shifts brain and head images to place their centers at the center of
+    the given master.
+    """
+    centered_files = []
+    for in_file in [brain_file, head_file]:
+        out_resample = resample(in_file=in_file,
+                                resample_mode='Cu',
+                                master=master_file,
+                                out_file=fname_presuffix(in_file,
+                                                         suffix='_resample'),
+                                outputtype='NIFTI_GZ')
+        centered_files.append(out_resample.outputs.out_file)
+
+    return tuple(centered_files)
+
+
+def _rigid_register_to_mean(centered_brain_file, centered_head_file,
+                            reference_file, write_dir, allineate, allineate2,
+                            convergence=.005, blur_radius_coarse=1.1,
+                            verbosity_quietness_kwargs=None):
+    """ Rigid-body registration of a centered brain to the given mean and
+    application of the estimated transform to the centered head.
+
+    Returns
+    -------
+    3-tuple of str : Paths to the rigid transform, the registered brain and
+        the registered head.
+    """
+    if verbosity_quietness_kwargs is None:
+        verbosity_quietness_kwargs = {}
+
+    suffixed_matrix = fname_presuffix(centered_brain_file,
+                                      suffix='_shr.aff12.1D',
+                                      use_ext=False)
+    out_matrix = os.path.join(write_dir, os.path.basename(suffixed_matrix))
+    out_allineate = allineate(
+        in_file=centered_brain_file,
+        reference=reference_file,
+        out_matrix=out_matrix,
+        convergence=convergence,
+        two_blur=blur_radius_coarse,
+        warp_type='shift_rotate',
+        out_file=fname_presuffix(centered_brain_file, suffix='_shr'),
+        **verbosity_quietness_kwargs)
+    rigid_transform_file = out_allineate.outputs.out_matrix
+    shift_rotated_brain_file = out_allineate.outputs.out_file
+
+    # application to the head image
+    suffixed_file = fname_presuffix(centered_head_file, suffix='_shr')
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_allineate = allineate2(
+        in_file=centered_head_file,
+        master=reference_file,
+        in_matrix=rigid_transform_file,
+        out_file=out_file,
+        **verbosity_quietness_kwargs)
+    shift_rotated_head_file = out_allineate.outputs.out_file
+
+    return (rigid_transform_file, shift_rotated_brain_file,
+            shift_rotated_head_file)
+
+
+def _affine_register_to_mean(shift_rotated_head_file, rigid_transform_file,
+                             centered_brain_file, centered_head_file,
+                             reference_file, weight_file, write_dir,
+                             allineate, allineate2, catmatvec,
+                             convergence=.005, blur_radius_coarse=1.1,
+                             verbosity_quietness_kwargs=None):
+    """ Affine registration of a rigidly registered head to the given mean,
+    concatenation with the rigid transform and application of the
+    concatenated transform to the centered brain and head.
+
+    Returns
+    -------
+    3-tuple of str : Paths to the concatenated affine transform, the
+        registered brain and the registered head.
+    """
+    if verbosity_quietness_kwargs is None:
+        verbosity_quietness_kwargs = {}
+
+    out_allineate = allineate(
+        in_file=shift_rotated_head_file,
+        reference=reference_file,
+        out_matrix=fname_presuffix(shift_rotated_head_file,
+                                   suffix='_affine.aff12.1D',
+                                   use_ext=False),
+        convergence=convergence,
+        two_blur=blur_radius_coarse,
+        one_pass=True,
+        weight=weight_file,
+        out_file=fname_presuffix(shift_rotated_head_file,
+                                 suffix='_affine'),
+        **verbosity_quietness_kwargs)
+
+    # matrix concatenation
+    suffixed_matrix = fname_presuffix(shift_rotated_head_file,
+                                      suffix='_affine_catenated.aff12.1D',
+                                      use_ext=False)
+    catmatvec_out_file = os.path.join(write_dir,
+                                      os.path.basename(suffixed_matrix))
+    out_catmatvec = catmatvec(in_file=[(rigid_transform_file, 'ONELINE'),
+                                       (out_allineate.outputs.out_matrix,
+                                        'ONELINE')],
+                              out_file=catmatvec_out_file)
+    affine_transform_file = out_catmatvec.outputs.out_file
+
+    # application to brain
+    out_allineate = allineate2(
+        in_file=centered_brain_file,
+        master=reference_file,
+        in_matrix=affine_transform_file,
+        out_file=fname_presuffix(centered_brain_file,
+                                 suffix='_shr_affine_catenated'),
+        **verbosity_quietness_kwargs)
+    allineated_brain_file = out_allineate.outputs.out_file
+
+    # application to head
+    suffixed_file = fname_presuffix(centered_head_file,
+                                    suffix='_shr_affine_catenated')
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_allineate = allineate2(
+        in_file=centered_head_file,
+        master=reference_file,
+        in_matrix=affine_transform_file,
+        out_file=out_file,
+        **verbosity_quietness_kwargs)
+    allineated_head_file = out_allineate.outputs.out_file
+
+    return affine_transform_file, allineated_brain_file, allineated_head_file
 
 
 def anats_to_common(anat_filenames, write_dir, brain_volume,
@@ -16,7 +236,8 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
                     nonlinear_weight_file=None,
                     convergence=0.005, blur_radius_coarse=1.1,
                     caching=False, verbose=1,
-                    unifize_kwargs=None, brain_masking_unifize_kwargs=None):
+                    unifize_kwargs=None, brain_masking_unifize_kwargs=None,
+                    n_jobs=1, checkpoint=False):
     """ Create common template from native anatomical images and achieve
     their registration to it.
 
@@ -74,6 +295,19 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         Is passed to nipype.interfaces.afni.Unifize, to tune
         the seperate bias correction step done prior to brain masking.
 
+    n_jobs : int, optional
+        The number of processes used to run the per-animal steps. -1 means
+        all CPUs. Steps mixing all animals, such as the computation of the
+        intermediate templates, are run once all animals have been processed.
+
+    checkpoint : bool, optional
+        If True, the outputs of each completed stage (centering, rigid,
+        affine, each nonlinear level and each minimal patch pass) are
+        recorded with their size and modification time in the manifest
+        `anats_to_common_checkpoints.json` within `write_dir`. A rerun with
+        the same parameters skips the stages whose recorded files are
+        unchanged, without hashing the images.
+
     Returns
     -------
     data : sklearn.datasets.base.Bunch
@@ -148,7 +382,7 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         verbosity_quietness_kwargs = {'quiet': True}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         copy = memory.cache(afni.Copy)
         unifize = memory.cache(afni.Unifize)
         clip_level = memory.cache(afni.ClipLevel)
@@ -198,28 +432,13 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         nwarp_adjust = afni.NwarpAdjust(terminal_output=terminal_output).run
 
-    current_dir = os.getcwd()
-    os.chdir(write_dir)
+    write_dir = os.path.abspath(write_dir)
 
     ###########################################################################
     # First copy anatomical files to make sure the originals are never changed
     # and they have different names across individuals. Then produce a video of
     # this raw data and a mean
-    copied_anat_filenames = []
-    for n, anat_file in enumerate(anat_filenames):
-        suffixed_file = fname_presuffix(anat_file, suffix='_{}'.format(n))
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_copy = copy(in_file=anat_file, out_file=out_file,
-                        **verbosity_kwargs)
-        copied_anat_filenames.append(out_copy.outputs.out_file)
-
-
-    out_tcat = tcat(in_files=copied_anat_filenames,
-                    out_file=os.path.join(write_dir, 'raw_heads.nii.gz'),
-                    outputtype='NIFTI_GZ', **verbosity_kwargs)
-    out_tstat = tstat(in_file=out_tcat.outputs.out_file, outputtype='NIFTI_GZ')
-
-    ###########################################################################
+    #
     # Bias correct and register using center of mass
     # -----------------------------
     # An initial coarse registration is done using brain centre of mass (CoM).
@@ -258,101 +477,98 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     # parameter individually. However, -parini can be overidden by other flags, 
     # so careful checks need to be made to ensure that this will never happen 
     # with the particular command or set of commands used here.
-    
-    # bias correction for images to be used for brain mask creation
+    #
+    # All these steps are independent across animals, so they are run in
+    # parallel for each animal.
+    if checkpoint:
+        manifest_file = os.path.join(write_dir,
+                                     'anats_to_common_checkpoints.json')
+    else:
+        manifest_file = None
+
     if brain_masking_unifize_kwargs is None:
         brain_masking_unifize_kwargs = {}
     brain_masking_unifize_kwargs.update(quietness_kwargs)
-    brain_masking_in_files = []
-    for n, anat_file in enumerate(copied_anat_filenames):
-        out_unifize = unifize(in_file=anat_file,
-                              out_file='%s_Unifized_for_brain_masking',
-                              outputtype='NIFTI_GZ',
-                              **brain_masking_unifize_kwargs)
-        brain_masking_in_files.append(out_unifize.outputs.out_file)
-
-    # brain mask creation
-    brain_mask_files = []
-    for n, brain_masking_in_file in enumerate(brain_masking_in_files):
-        out_clip_level = clip_level(in_file=brain_masking_in_file)
-        out_compute_mask = compute_mask(
-            in_file=brain_masking_in_file,
-            out_file=fname_presuffix(brain_masking_in_file, suffix='_mask'),
-            volume_threshold=brain_volume,
-            intensity_threshold=int(out_clip_level.outputs.clip_val))
-        brain_mask_files.append(out_compute_mask.outputs.out_file)
 
-    # bias correction for images to be both brain-extracted with the mask 
-    # generated above and then passed on to the rest of the function
     if unifize_kwargs is None:
         unifize_kwargs = {}
-
     unifize_kwargs.update(quietness_kwargs)
-    unifized_files = []
-    for n, anat_file in enumerate(copied_anat_filenames):
-        out_unifize = unifize(in_file=anat_file,
-                              out_file='%s_Unifized_for_brain_extraction',
-                              outputtype='NIFTI_GZ',
-                              **unifize_kwargs)
-        unifized_files.append(out_unifize.outputs.out_file)
 
-    # extrcat brains and set NIfTI image center (as defined in the header) to 
-    # the brain CoM
-    brain_files = []
-    for (brain_mask_file, unifized_file) in zip(brain_mask_files,
-                                                unifized_files):
-        out_calc_mask = calc(in_file_a=unifized_file,
-                             in_file_b=brain_mask_file,
-                             expr='a*b',
-                             outputtype='NIFTI_GZ')
-        out_center_mass = center_mass(
-            in_file=out_calc_mask.outputs.out_file,
-            cm_file=fname_presuffix(unifized_file, suffix='_cm.txt',
-                                    use_ext=False),
-            set_cm=(0, 0, 0))
-        brain_files.append(out_center_mass.outputs.out_file)
-
-    # apply center change to head files too
-    head_files = []    
-    for unifized_file, brain_file in zip(unifized_files, brain_files):
-        out_refit = refit(in_file=unifized_file, duporigin_file=brain_file)
-        head_files.append(out_refit.outputs.out_file)
-
-    # create an empty template with a center at the image matrix center
-    out_undump = undump(in_file=out_tstat.outputs.out_file,
-                        out_file=os.path.join(write_dir, 'undump.nii.gz'),
-                        outputtype='NIFTI_GZ')
-    out_refit = refit2(in_file=out_undump.outputs.out_file,
-                       xorigin='cen', yorigin='cen', zorigin='cen')
-
-    # shift brains to place their new centers at the same central position. 
-    # make a quality check video and mean
-    centered_brain_files = []
-    for brain_file in brain_files:
-        out_resample = resample(in_file=brain_file,
-                                resample_mode='Cu',
-                                master=out_refit.outputs.out_file,
-                                outputtype='NIFTI_GZ')
-        centered_brain_files.append(out_resample.outputs.out_file)
-    out_tcat = tcat(in_files=centered_brain_files,
-                    out_file=os.path.join(write_dir, 'centered_brains.nii.gz'),
-                    **verbosity_kwargs)
-    out_tstat_centered_brain = tstat(in_file=out_tcat.outputs.out_file,
-                                     outputtype='NIFTI_GZ')
+    centering_parameters = dict(
+        anat_filenames=anat_filenames, brain_volume=brain_volume,
+        use_rats_tool=use_rats_tool, unifize_kwargs=unifize_kwargs,
+        brain_masking_unifize_kwargs=brain_masking_unifize_kwargs)
+    centering = _load_checkpoint(manifest_file, 'centering',
+                                 centering_parameters)
+    if centering is None:
+        centering_outputs = _parallel_apply(
+            _center_anat,
+            [dict(n=n, anat_file=anat_file, write_dir=write_dir,
+                  brain_volume=brain_volume, copy=copy, unifize=unifize,
+                  clip_level=clip_level, compute_mask=compute_mask, calc=calc,
+                  center_mass=center_mass, refit=refit,
+                  verbosity_kwargs=verbosity_kwargs,
+                  brain_masking_unifize_kwargs=brain_masking_unifize_kwargs,
+                  unifize_kwargs=unifize_kwargs)
+             for n, anat_file in enumerate(anat_filenames)],
+            n_jobs=n_jobs)
+        copied_anat_filenames, brain_files, head_files = [
+            list(files) for files in zip(*centering_outputs)]
+
+        out_tcat = tcat(in_files=copied_anat_filenames,
+                        out_file=os.path.join(write_dir, 'raw_heads.nii.gz'),
+                        outputtype='NIFTI_GZ', **verbosity_kwargs)
+        out_tstat = tstat(
+            in_file=out_tcat.outputs.out_file,
+            out_file=os.path.join(write_dir, 'raw_heads_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
+
+        # create an empty template with a center at the image matrix center
+        out_undump = undump(in_file=out_tstat.outputs.out_file,
+                            out_file=os.path.join(write_dir, 'undump.nii.gz'),
+                            outputtype='NIFTI_GZ')
+        out_refit = refit2(in_file=out_undump.outputs.out_file,
+                           xorigin='cen', yorigin='cen', zorigin='cen')
+
+        # shift brains and heads to place their new centers at the same central
+        # position
+        centered_outputs = _parallel_apply(
+            _resample_to_center,
+            [dict(brain_file=brain_file, head_file=head_file,
+                  master_file=out_refit.outputs.out_file, resample=resample)
+             for brain_file, head_file in zip(brain_files, head_files)],
+            n_jobs=n_jobs)
+        centered_brain_files, centered_head_files = [
+            list(files) for files in zip(*centered_outputs)]
+
+        # make a quality check video and mean
+        out_tcat = tcat(in_files=centered_brain_files,
+                        out_file=os.path.join(write_dir,
+                                              'centered_brains.nii.gz'),
+                        **verbosity_kwargs)
+        out_tstat_centered_brain = tstat(
+            in_file=out_tcat.outputs.out_file,
+            out_file=os.path.join(write_dir, 'centered_brains_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
     
-    # do the same for heads. is also a better quality check than the brain
-    centered_head_files = []
-    for head_file in head_files:
-        out_resample = resample(in_file=head_file,
-                                resample_mode='Cu',
-                                master=out_refit.outputs.out_file,
-                                outputtype='NIFTI_GZ')
-        centered_head_files.append(out_resample.outputs.out_file)
-    out_tcat = tcat(in_files=centered_head_files,
-                    out_file=os.path.join(write_dir, 'centered_heads.nii.gz'),
-                    **verbosity_kwargs)
-    out_tstat_centered_brain = tstat(in_file=out_tcat.outputs.out_file,
-                                     outputtype='NIFTI_GZ')
+        # do the same for heads. is also a better quality check than the brain
+        out_tcat = tcat(in_files=centered_head_files,
+                        out_file=os.path.join(write_dir,
+                                              'centered_heads.nii.gz'),
+                        **verbosity_kwargs)
+        out_tstat_centered_brain = tstat(
+            in_file=out_tcat.outputs.out_file,
+            out_file=os.path.join(write_dir, 'centered_heads_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
+        centering = dict(
+            centered_brains=centered_brain_files,
+            centered_heads=centered_head_files,
+            reference=out_tstat_centered_brain.outputs.out_file)
+        _save_checkpoint(manifest_file, 'centering', centering_parameters,
+                         centering, input_files=anat_filenames)
+
+    centered_brain_files = centering['centered_brains']
+    centered_head_files = centering['centered_heads']
 
     ###########################################################################
     # At this point, we have achieved a translation-only registration of the 
@@ -372,56 +588,62 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     # is no current functionality), but we have never found a case that extreme 
     # so it is not implemented.
     
-    # rigid-body registration
-    shift_rotated_brain_files = []
-    rigid_transform_files = []
-    for centered_brain_file in centered_brain_files:
-        suffixed_matrix = fname_presuffix(centered_brain_file,
-                                          suffix='_shr.aff12.1D',
-                                          use_ext=False)
-        out_matrix = os.path.join(write_dir, os.path.basename(suffixed_matrix))
-        out_allineate = allineate(
-            in_file=centered_brain_file,
-            reference=out_tstat_centered_brain.outputs.out_file,
-            out_matrix=out_matrix,
-            convergence=convergence,
-            two_blur=blur_radius_coarse,
-            warp_type='shift_rotate',
-            out_file=fname_presuffix(centered_brain_file, suffix='_shr'),
-            **verbosity_quietness_kwargs)
-        rigid_transform_files.append(out_allineate.outputs.out_matrix)
-        shift_rotated_brain_files.append(out_allineate.outputs.out_file)
-
-    # application to the head images
-    shift_rotated_head_files = []
-    for centered_head_file, rigid_transform_file in zip(centered_head_files,
-                                                        rigid_transform_files):
-        suffixed_file = fname_presuffix(centered_head_file, suffix='_shr')
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_allineate = allineate2(
-            in_file=centered_head_file,
-            master=out_tstat_centered_brain.outputs.out_file,
-            in_matrix=rigid_transform_file,
-            out_file=out_file,
-            **verbosity_quietness_kwargs)
-        shift_rotated_head_files.append(out_allineate.outputs.out_file)
-
-    # quality check video and mean for head and brain
-    out_tcat = tcat(
-        in_files=shift_rotated_head_files,
-        out_file=os.path.join(write_dir, 'rigid_body_registered_heads.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_shr = tstat(in_file=out_tcat.outputs.out_file,
-                          outputtype='NIFTI_GZ')
-    out_tcat = tcat(
-        in_files=shift_rotated_brain_files,
-        out_file=os.path.join(write_dir, 'rigid_body_registered_brains.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_shr = tstat(in_file=out_tcat.outputs.out_file,
-                          outputtype='NIFTI_GZ')
+    registration_parameters = dict(convergence=convergence,
+                                   blur_radius_coarse=blur_radius_coarse)
+    rigid = _load_checkpoint(manifest_file, 'rigid', registration_parameters)
+    if rigid is None:
+        # rigid-body registration and application to the head images
+        rigid_outputs = _parallel_apply(
+            _rigid_register_to_mean,
+            [dict(centered_brain_file=centered_brain_file,
+                  centered_head_file=centered_head_file,
+                  reference_file=centering['reference'],
+                  write_dir=write_dir, allineate=allineate,
+                  allineate2=allineate2, convergence=convergence,
+                  blur_radius_coarse=blur_radius_coarse,
+                  verbosity_quietness_kwargs=verbosity_quietness_kwargs)
+             for centered_brain_file, centered_head_file in zip(
+                centered_brain_files, centered_head_files)],
+            n_jobs=n_jobs)
+        (rigid_transform_files, shift_rotated_brain_files,
+         shift_rotated_head_files) = [list(files)
+                                      for files in zip(*rigid_outputs)]
+
+        # quality check video and mean for head and brain
+        out_tcat = tcat(
+            in_files=shift_rotated_head_files,
+            out_file=os.path.join(write_dir,
+                                  'rigid_body_registered_heads.nii.gz'),
+            **verbosity_kwargs)
+        out_tstat_shr = tstat(
+            in_file=out_tcat.outputs.out_file,
+            out_file=os.path.join(write_dir,
+                                  'rigid_body_registered_heads_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
+        out_tcat = tcat(
+            in_files=shift_rotated_brain_files,
+            out_file=os.path.join(write_dir,
+                                  'rigid_body_registered_brains.nii.gz'),
+            **verbosity_kwargs)
+        out_tstat_shr = tstat(
+            in_file=out_tcat.outputs.out_file,
+            out_file=os.path.join(write_dir,
+                                  'rigid_body_registered_brains_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
+        rigid = dict(transforms=rigid_transform_files,
+                     registered_brains=shift_rotated_brain_files,
+                     registered_heads=shift_rotated_head_files,
+                     brains=out_tcat.outputs.out_file,
+                     brains_mean=out_tstat_shr.outputs.out_file)
+        _save_checkpoint(manifest_file, 'rigid', registration_parameters,
+                         rigid, input_files=_list_files(centering))
+
+    rigid_transform_files = rigid['transforms']
+    shift_rotated_head_files = rigid['registered_heads']
 
     if registration_kind == 'rigid':
-        os.chdir(current_dir)
+        if caching:
+            pin_files(rigid_transform_files, _get_cache_base_dir(write_dir))
         return Bunch(registered=shift_rotated_head_files,
                      transforms=rigid_transform_files)
 
@@ -440,85 +662,76 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     #    brain size and extraction quality.
     # 3) There is an extra step for concatenation of transform results.
     
-    # make the count mask
-    out_mask_tool = mask_tool(in_file=out_tcat.outputs.out_file,
-                              count=True,
-                              verbose=verbose,
-                              outputtype='NIFTI_GZ')
-
-    #affine transform
-    affine_transform_files = []
-    for shift_rotated_head_file, rigid_transform_file in zip(
-            shift_rotated_head_files, rigid_transform_files):
-        out_allineate = allineate(
-            in_file=shift_rotated_head_file,
-            reference=out_tstat_shr.outputs.out_file,
-            out_matrix=fname_presuffix(shift_rotated_head_file,
-                                       suffix='_affine.aff12.1D',
-                                       use_ext=False),
-            convergence=convergence,
-            two_blur=blur_radius_coarse,
-            one_pass=True,
-            weight=out_mask_tool.outputs.out_file,
-            out_file=fname_presuffix(shift_rotated_head_file,
-                                     suffix='_affine'),
-            **verbosity_quietness_kwargs)
-        # matrix concatenation
-        suffixed_matrix = fname_presuffix(shift_rotated_head_file,
-                                          suffix='_affine_catenated.aff12.1D',
-                                          use_ext=False)
-        catmatvec_out_file = os.path.join(write_dir,
-                                          os.path.basename(suffixed_matrix))
-        out_catmatvec = catmatvec(in_file=[(rigid_transform_file, 'ONELINE'),
-                                           (out_allineate.outputs.out_matrix,
-                                            'ONELINE')],
-                                  out_file=catmatvec_out_file)
-        affine_transform_files.append(out_catmatvec.outputs.out_file)
-
-    # application to brains
-    allineated_brain_files = []
-    for centered_brain_file, affine_transform_file in zip(
-            centered_brain_files, affine_transform_files):
-        out_allineate = allineate2(
-            in_file=centered_brain_file,
-            master=out_tstat_shr.outputs.out_file,
-            in_matrix=affine_transform_file,
-            out_file=fname_presuffix(centered_brain_file,
-                                     suffix='_shr_affine_catenated'),
-            **verbosity_quietness_kwargs)
-        allineated_brain_files.append(out_allineate.outputs.out_file)
-
-    # application to heads
-    allineated_head_files = []
-    for centered_head_file, affine_transform_file in zip(
-            centered_head_files, affine_transform_files):
-        suffixed_file = fname_presuffix(centered_head_file,
-                                        suffix='_shr_affine_catenated')
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_allineate = allineate2(
-            in_file=centered_head_file,
-            master=out_tstat_shr.outputs.out_file,
-            in_matrix=affine_transform_file,
-            out_file=out_file,
-            **verbosity_quietness_kwargs)
-        allineated_head_files.append(out_allineate.outputs.out_file)
-
-    #quality check videos and template for head and brain
-    out_tcat_head = tcat(
-        in_files=allineated_head_files,
-        out_file=os.path.join(write_dir, 'affine_registered_heads.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_allineated_head = tstat(in_file=out_tcat_head.outputs.out_file,
-                                      outputtype='NIFTI_GZ')
-    out_tcat_brain = tcat(
-        in_files=allineated_brain_files,
-        out_file=os.path.join(write_dir, 'affine_registered_brains.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_allineated_brain = tstat(in_file=out_tcat_brain.outputs.out_file,
-                                       outputtype='NIFTI_GZ')
+    affine = _load_checkpoint(manifest_file, 'affine',
+                              registration_parameters)
+    if affine is None:
+        # make the count mask
+        out_mask_tool = mask_tool(
+            in_file=rigid['brains'],
+            count=True,
+            verbose=verbose,
+            out_file=os.path.join(write_dir,
+                                  'rigid_body_registered_brains_mask.nii.gz'),
+            outputtype='NIFTI_GZ')
+
+        # affine transform, matrix concatenation and application to brains and
+        # heads
+        affine_outputs = _parallel_apply(
+            _affine_register_to_mean,
+            [dict(shift_rotated_head_file=shift_rotated_head_file,
+                  rigid_transform_file=rigid_transform_file,
+                  centered_brain_file=centered_brain_file,
+                  centered_head_file=centered_head_file,
+                  reference_file=rigid['brains_mean'],
+                  weight_file=out_mask_tool.outputs.out_file,
+                  write_dir=write_dir, allineate=allineate,
+                  allineate2=allineate2,
+                  catmatvec=catmatvec, convergence=convergence,
+                  blur_radius_coarse=blur_radius_coarse,
+                  verbosity_quietness_kwargs=verbosity_quietness_kwargs)
+             for (shift_rotated_head_file, rigid_transform_file,
+                  centered_brain_file, centered_head_file) in zip(
+                shift_rotated_head_files, rigid_transform_files,
+                centered_brain_files, centered_head_files)],
+            n_jobs=n_jobs)
+        (affine_transform_files, allineated_brain_files,
+         allineated_head_files) = [list(files)
+                                   for files in zip(*affine_outputs)]
+
+        #quality check videos and template for head and brain
+        out_tcat_head = tcat(
+            in_files=allineated_head_files,
+            out_file=os.path.join(write_dir, 'affine_registered_heads.nii.gz'),
+            **verbosity_kwargs)
+        out_tstat_allineated_head = tstat(
+            in_file=out_tcat_head.outputs.out_file,
+            out_file=os.path.join(write_dir,
+                                  'affine_registered_heads_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
+        out_tcat_brain = tcat(
+            in_files=allineated_brain_files,
+            out_file=os.path.join(write_dir,
+                                  'affine_registered_brains.nii.gz'),
+            **verbosity_kwargs)
+        out_tstat_allineated_brain = tstat(
+            in_file=out_tcat_brain.outputs.out_file,
+            out_file=os.path.join(write_dir,
+                                  'affine_registered_brains_tstat.nii.gz'),
+            outputtype='NIFTI_GZ')
+        affine = dict(transforms=affine_transform_files,
+                      registered_brains=allineated_brain_files,
+                      registered_heads=allineated_head_files,
+                      brains=out_tcat_brain.outputs.out_file,
+                      heads_mean=out_tstat_allineated_head.outputs.out_file)
+        _save_checkpoint(manifest_file, 'affine', registration_parameters,
+                         affine, input_files=_list_files(rigid))
+
+    affine_transform_files = affine['transforms']
+    allineated_head_files = affine['registered_heads']
 
     if registration_kind == 'affine':
-        os.chdir(current_dir)
+        if caching:
+            pin_files(affine_transform_files, _get_cache_base_dir(write_dir))
         return Bunch(registered=allineated_head_files,
                      transforms=affine_transform_files)
 
@@ -529,23 +742,28 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     # surrounding tissue, is needed to help better define the brain head
     # boundary.
     if nonlinear_weight_file is None:
-        out_mask_tool = mask_tool(
-            in_file=out_tcat.outputs.out_file,
-            union=True,
-            out_file=os.path.join(
-                write_dir,
-                'affine_registered_brains_unionmask.nii.gz'),
-            outputtype='NIFTI_GZ',
-            verbose=verbose)
-        out_mask_tool = mask_tool(
-            in_file=out_mask_tool.outputs.out_file,
-            out_file=os.path.join(
-                write_dir,
-                'affine_registered_brains_unionmask_dil4.nii.gz'),
-            dilate_inputs='4',
-            outputtype='NIFTI_GZ',
-            verbose=verbose)
-        nonlinear_weight_file = out_mask_tool.outputs.out_file
+        weight = _load_checkpoint(manifest_file, 'weight_mask', {})
+        if weight is None:
+            out_mask_tool = mask_tool(
+                in_file=rigid['brains'],
+                union=True,
+                out_file=os.path.join(
+                    write_dir,
+                    'affine_registered_brains_unionmask.nii.gz'),
+                outputtype='NIFTI_GZ',
+                verbose=verbose)
+            out_mask_tool = mask_tool(
+                in_file=out_mask_tool.outputs.out_file,
+                out_file=os.path.join(
+                    write_dir,
+                    'affine_registered_brains_unionmask_dil4.nii.gz'),
+                dilate_inputs='4',
+                outputtype='NIFTI_GZ',
+                verbose=verbose)
+            weight = dict(weight=out_mask_tool.outputs.out_file)
+            _save_checkpoint(manifest_file, 'weight_mask', {}, weight,
+                             input_files=[rigid['brains']])
+        nonlinear_weight_file = weight['weight']
 
     ###########################################################################
     # Successive cycles of non-linear registration are executed.
@@ -562,126 +780,183 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     if nonlinear_levels is None:
         nonlinear_levels = [1, 2, 3]
 
+    # first cycle registers the centered heads to the affine template
+    inilev = 0
+    common_head_file = affine['heads_mean']
+    previous_stage = affine
     for n_lev, maxlev in enumerate(nonlinear_levels):        
-        if n_lev == 0:
-            inilev = 0
-            # first cycle registers the centered heads to the affine template
-            common_head_file = out_tstat_allineated_head.outputs.out_file
-            # Transform the affine transforms to warps for initializing
-            # the first cycle non-linear registration
-            previous_warp_files = []
-            for affine_file, centered_head_file in zip(affine_transform_files, 
-                                                       centered_head_files):
-                out_nwarp_cat = nwarp_cat(
-                    in_files=[('IDENT', centered_head_file), affine_file],
-                    out_file=fname_presuffix(centered_head_file,
-                                             suffix='_iniwarp'))
-                previous_warp_files.append(out_nwarp_cat.outputs.out_file)
-
-        warped_files = []
-        warp_files = []
-        for warp_file, centered_head_file in zip(previous_warp_files, 
-                                                 centered_head_files):
-            out_file = fname_presuffix(centered_head_file,
-                                       suffix='_warped{}'.format(n_lev))
-            out_qwarp = qwarp(
-                in_file=centered_head_file,
-                base_file=common_head_file,
-                noneg=True,
-                iwarp=True,
-                weight=nonlinear_weight_file,
-                iniwarp=[warp_file],
-                inilev=inilev,
-                maxlev=maxlev,
-                out_file=out_file,
-                **verb_quietness_kwargs)
-            warped_files.append(out_qwarp.outputs.warped_source)
+        stage = 'nonlinear_level{}'.format(n_lev)
+        level_parameters = dict(weight=nonlinear_weight_file,
+                                base=common_head_file,
+                                inilev=inilev, maxlev=maxlev)
+        level = _load_checkpoint(manifest_file, stage, level_parameters)
+        if level is None:
+            if n_lev == 0:
+                # Transform the affine transforms to warps for initializing
+                # the first cycle non-linear registration
+                out_nwarp_cats = _parallel_apply(
+                    nwarp_cat,
+                    [dict(in_files=[('IDENT', centered_head_file),
+                                    affine_file],
+                          out_file=fname_presuffix(centered_head_file,
+                                                   suffix='_iniwarp'))
+                     for affine_file, centered_head_file in zip(
+                        affine_transform_files, centered_head_files)],
+                    n_jobs=n_jobs)
+                previous_warp_files = [out_nwarp_cat.outputs.out_file
+                                       for out_nwarp_cat in out_nwarp_cats]
+
+            out_qwarps = _parallel_apply(
+                qwarp,
+                [dict(in_file=centered_head_file,
+                      base_file=common_head_file,
+                      noneg=True,
+                      iwarp=True,
+                      weight=nonlinear_weight_file,
+                      iniwarp=[warp_file],
+                      inilev=inilev,
+                      maxlev=maxlev,
+                      out_file=fname_presuffix(
+                          centered_head_file,
+                          suffix='_warped{}'.format(n_lev)),
+                      **verb_quietness_kwargs)
+                 for warp_file, centered_head_file in zip(
+                    previous_warp_files, centered_head_files)],
+                n_jobs=n_jobs)
+            warped_files = [out_qwarp.outputs.warped_source
+                            for out_qwarp in out_qwarps]
             # Collect the current warps to initialize the transforms of
             # the next non-linear cycle
-            warp_files.append(out_qwarp.outputs.source_warp)
-            previous_warp_files = warp_files
-
+            warp_files = [out_qwarp.outputs.source_warp
+                          for out_qwarp in out_qwarps]
+
+            # Compute the average of the warped images while accounting
+            # for systematic biases in the non-linear transforms
+            out_nwarp_adjust = nwarp_adjust(
+                warps=warp_files,
+                in_files=centered_head_files,
+                out_file=os.path.join(
+                    write_dir,
+                    'warped_{0}_adjusted_mean.nii.gz'.format(n_lev)))
+            level = dict(warps=warp_files, warped=warped_files,
+                         mean=out_nwarp_adjust.outputs.out_file)
+            input_files = _list_files(previous_stage) + [nonlinear_weight_file]
+            _save_checkpoint(manifest_file, stage, level_parameters, level,
+                             input_files=input_files)
+
+        previous_warp_files = level['warps']
+        common_head_file = level['mean']
+        previous_stage = level
         inilev = maxlev + 1
-        # Compute the average of the warped images while accounting
-        # for systematic biases in the non-linear transforms
-        common_head_file = os.path.join(
-                write_dir, 'warped_{0}_adjusted_mean.nii.gz'.format(n_lev))
-        out_nwarp_adjust = nwarp_adjust(warps=warp_files,
-                                        in_files=centered_head_files,
-                                        out_file=common_head_file)                            
 
     if nonlinear_levels == []:
         previous_warp_files = affine_transform_files
         inilev = 0
-        n_lev = 0
-    else:
-        inilev = maxlev + 1    # not ideal
   
     if nonlinear_minimal_patches is None:
        nonlinear_minimal_patches = []
-       n_iter = n_lev
 
+    template_file = common_head_file
     for n_patch, minpatch in enumerate(nonlinear_minimal_patches):        
-        warped_files = []
-        warp_files = []
-        n_iter = n_lev + n_patch
-        for warp_file, centered_head_file in zip(previous_warp_files, 
-                                                 centered_head_files):            
-            out_file = fname_presuffix(centered_head_file,
-                                       suffix='_warped{}'.format(n_iter))
-            out_qwarp = qwarp2(
-                in_file=centered_head_file,
-                base_file=common_head_file,
-                noneg=True,
-                iwarp=True,
-                weight=nonlinear_weight_file,
-                iniwarp=[warp_file],
-                inilev=inilev,
-                minpatch=minpatch,
-                out_file=out_file,
-                **verb_quietness_kwargs)
-                    
-            warped_files.append(out_qwarp.outputs.warped_source)
-            warp_files.append(out_qwarp.outputs.source_warp)
-            previous_warp_files = warp_files
+        # Number the patches after the levels, so that their outputs do not
+        # overwrite the ones of the last level
+        n_iter = len(nonlinear_levels) + n_patch
+        stage = 'minimal_patch{}'.format(n_patch)
+        patch_parameters = dict(weight=nonlinear_weight_file,
+                                base=common_head_file,
+                                inilev=inilev, minpatch=minpatch)
+        patch = _load_checkpoint(manifest_file, stage, patch_parameters)
+        if patch is None:
+            out_qwarps = _parallel_apply(
+                qwarp2,
+                [dict(in_file=centered_head_file,
+                      base_file=common_head_file,
+                      noneg=True,
+                      iwarp=True,
+                      weight=nonlinear_weight_file,
+                      iniwarp=[warp_file],
+                      inilev=inilev,
+                      minpatch=minpatch,
+                      out_file=fname_presuffix(
+                          centered_head_file,
+                          suffix='_warped{}'.format(n_iter)),
+                      **verb_quietness_kwargs)
+                 for warp_file, centered_head_file in zip(
+                    previous_warp_files, centered_head_files)],
+                n_jobs=n_jobs)
+            warped_files = [out_qwarp.outputs.warped_source
+                            for out_qwarp in out_qwarps]
+            warp_files = [out_qwarp.outputs.source_warp
+                          for out_qwarp in out_qwarps]
+
+            out_tcat = tcat(
+                in_files=warped_files,
+                out_file=os.path.join(
+                    write_dir,
+                    'warped_{0}iters_template.nii.gz'.format(n_iter)),
+                **verbosity_kwargs)
+            out_tstat_warp_head = tstat(
+                in_file=out_tcat.outputs.out_file,
+                out_file=os.path.join(
+                    write_dir,
+                    'warped_{0}iters_template_tstat.nii.gz'.format(n_iter)),
+                outputtype='NIFTI_GZ')
+
+            out_nwarp_adjust = nwarp_adjust(
+                warps=warp_files,
+                in_files=centered_head_files,
+                out_file=os.path.join(
+                    write_dir,
+                    'warped_{0}_adjusted_mean.nii.gz'.format(n_iter)))
+            patch = dict(warps=warp_files, warped=warped_files,
+                         template=out_tstat_warp_head.outputs.out_file,
+                         mean=out_nwarp_adjust.outputs.out_file)
+            input_files = _list_files(previous_stage) + [nonlinear_weight_file]
+            _save_checkpoint(manifest_file, stage, patch_parameters, patch,
+                             input_files=input_files)
+
+        previous_warp_files = patch['warps']
+        common_head_file = patch['mean']
+        template_file = patch['template']
+        previous_stage = patch
 
-        out_tcat = tcat(
-            in_files=warped_files,
-            out_file=os.path.join(
-                write_dir,
-                'warped_{0}iters_template.nii.gz'.format(n_iter)),
-            **verbosity_kwargs)
-        out_tstat_warp_head = tstat(in_file=out_tcat.outputs.out_file,
-                                    outputtype='NIFTI_GZ')
-
-        common_head_file = os.path.join(
-                write_dir, 'warped_{0}_adjusted_mean.nii.gz'.format(n_iter))
-        out_nwarp_adjust = nwarp_adjust(warps=warp_files,
-                                        in_files=centered_head_files,
-                                        out_file=common_head_file)                            
-                                    
     ###########################################################################
     # Register to template
     # --------------------
     # Apply non-linear registration results to uncorrected images
     # XXX has already been computed !
-    warped_files = []
-    for centered_head_file, warp_file in zip(centered_head_files, warp_files):
-        suffixed_file = fname_presuffix(
-            centered_head_file,
-            suffix='affine_warp{}_catenated'.format(len(nonlinear_levels)))
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_warp_apply = warp_apply(
-            in_file=centered_head_file,
-            warp=warp_file,
-            master=out_tstat_warp_head.outputs.out_file,
-            out_file=out_file,
-            **verb_quietness_kwargs)
-        warped_files.append(out_warp_apply.outputs.out_file)
+    registration_parameters = dict(warps=previous_warp_files,
+                                   template=template_file)
+    registration = _load_checkpoint(manifest_file, 'registration',
+                                    registration_parameters)
+    if registration is None:
+        out_warp_applies = _parallel_apply(
+            warp_apply,
+            [dict(in_file=centered_head_file,
+                  warp=warp_file,
+                  master=template_file,
+                  out_file=os.path.join(write_dir, os.path.basename(
+                      fname_presuffix(centered_head_file,
+                                      suffix='affine_warp{}_catenated'.format(
+                                          len(nonlinear_levels))))),
+                  **verb_quietness_kwargs)
+             for centered_head_file, warp_file in zip(centered_head_files,
+                                                      previous_warp_files)],
+            n_jobs=n_jobs)
+        registration = dict(
+            registered=[out_warp_apply.outputs.out_file
+                        for out_warp_apply in out_warp_applies],
+            transforms=previous_warp_files)
+        _save_checkpoint(manifest_file, 'registration',
+                         registration_parameters, registration,
+                         input_files=_list_files(previous_stage))
+
+    # Keep the final transforms when the cache is pruned
+    if caching:
+        pin_files(registration['transforms'], _get_cache_base_dir(write_dir))
 
-    os.chdir(current_dir)
-    return Bunch(registered=warped_files,
-                 transforms=warp_files)
+    return Bunch(registered=registration['registered'],
+                 transforms=registration['transforms'])
 
 
 def anat_to_template(anat_filename, brain_filename,
@@ -765,7 +1040,7 @@ def anat_to_template(anat_filename, brain_filename,
         write_dir = os.path.dirname(anat_filename)
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         clip_level = memory.cache(afni.ClipLevel)
         threshold = memory.cache(fsl.Threshold)
         mask_tool = memory.cache(afni.MaskTool)
@@ -878,6 +1153,9 @@ def anat_to_template(anat_filename, brain_filename,
         for intermediate_file in intermediate_files:
             if os.path.isfile(intermediate_file):
                 os.remove(intermediate_file)
+    else:
+        pin_files([warp_transform, affine_transform_filename],
+                  _get_cache_base_dir(write_dir))
 
     return Bunch(registered=registered,
                  transform=warp_transform,
@@ -1000,7 +1278,7 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
         ComputeMask = segmentation.HistogramMask
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         clip_level = memory.cache(afni.ClipLevel)
         compute_mask = memory.cache(ComputeMask)
         calc = memory.cache(afni.Calc)
@@ -1,11 +1,18 @@
 import warnings
 import os
 from nilearn._utils.exceptions import VisibleDeprecationWarning
+from nilearn._utils.compat import _basestring
+from sklearn.base import clone
 from ..segmentation.brain_mask import (compute_histo_brain_mask,
                                        compute_morpho_brain_mask,
                                        _apply_mask)
 from ..preprocessing.bias_correction import ants_n4, afni_unifize
-from .base import _apply_perslice_warp, _apply_transforms
+from ..caching import _shared_write_dir
+from .base import (_apply_perslice_warp, _apply_transforms,
+                   _apply_transforms_to_many, _compose_transforms,
+                   _transform_steps)
+from .utils import (_compose_affine_transforms, _write_affine_transform,
+                    _parallel_apply)
 from .perfusion import coregister as coregister_perf
 from .func import _realign, _slice_time
 from .func import coregister as coregister_func
@@ -13,6 +20,21 @@ from .struct import anat_to_template
 from .base_registrator import BaseRegistrator
 
 
+def _fit_animal(registrator, template_brain, anat_file, brain_mask_file=None,
+                modality_file=None, modality=None, fit_modality_kwargs=None):
+    """Fits a registrator on one animal, reusing the given template brain.
+    """
+    registrator._fit()
+    registrator.template_brain_ = template_brain
+    registrator._fit_anat(anat_file, brain_mask_file=brain_mask_file)
+    if modality_file is not None:
+        if fit_modality_kwargs is None:
+            fit_modality_kwargs = {}
+        registrator.fit_modality(modality_file, modality,
+                                 **fit_modality_kwargs)
+    return registrator
+
+
 class TemplateRegistrator(BaseRegistrator):
     """
     Class for registering anatomical and possibly other modality images from
@@ -64,6 +86,10 @@ class TemplateRegistrator(BaseRegistrator):
     registration_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
         The allowed transform kind from the anatomical image to the template.
 
+    n_jobs : int, optional
+        The number of CPUs to use for the per-slice registration of EPI
+        modalities and for transforming lists of images. -1 means all CPUs.
+
     Attributes
     ----------
     `template_brain_` : str
@@ -77,7 +103,7 @@ class TemplateRegistrator(BaseRegistrator):
                  dilated_template_mask=None, output_dir=None, caching=False,
                  verbose=True, use_rats_tool=True,
                  clipping_fraction=.2, convergence=0.005,
-                 registration_kind='nonlinear'):
+                 registration_kind='nonlinear', n_jobs=1):
         self.template = template
         self.template_brain_mask = template_brain_mask
         self.dilated_template_mask = dilated_template_mask
@@ -89,6 +115,7 @@ class TemplateRegistrator(BaseRegistrator):
         self.clipping_fraction = clipping_fraction
         self.convergence = convergence
         self.registration_kind = registration_kind
+        self.n_jobs = n_jobs
 
     def _check_inputs(self):
         if not os.path.isfile(self.template):
@@ -112,19 +139,27 @@ class TemplateRegistrator(BaseRegistrator):
                              'transform_anat() or fit_modality().'
                              % self.__class__.__name__)
 
-    def fit_anat(self, anat_file, brain_mask_file=None):
-        """Estimates registration from anatomical to template space.
+    def _fit_template(self):
+        """Computes the template brain.
         """
-        self._fit()
         if self.use_rats_tool:
             compute_brain_mask = compute_morpho_brain_mask
         else:
             compute_brain_mask = compute_histo_brain_mask               
 
+        # The template steps are shared by all the animals pipelines
+        if self.caching:
+            template_dir = _shared_write_dir(
+                [self.template, self.template_brain_mask], self.output_dir,
+                brain_volume=self.brain_volume,
+                use_rats_tool=self.use_rats_tool)
+        else:
+            template_dir = self.output_dir
+
         if not self.template_brain_mask:
             template_brain_mask_file = compute_brain_mask(
                 self.template, self.brain_volume,
-                write_dir=self.output_dir,
+                write_dir=template_dir,
                 caching=self.caching,
                 terminal_output=self.terminal_output,
                 unifize=False,
@@ -134,10 +169,19 @@ class TemplateRegistrator(BaseRegistrator):
 
         self.template_brain_ = _apply_mask(
             self.template, template_brain_mask_file,
-            write_dir=self.output_dir,
+            write_dir=template_dir,
             caching=self.caching,
             terminal_output=self.terminal_output)
+        return self
 
+    def fit_anat(self, anat_file, brain_mask_file=None):
+        """Estimates registration from anatomical to template space.
+        """
+        self._fit()
+        self._fit_template()
+        return self._fit_anat(anat_file, brain_mask_file=brain_mask_file)
+
+    def _fit_anat(self, anat_file, brain_mask_file=None):
         self.anat_ = anat_file
         if brain_mask_file is None:
             self._unifized_anat, self.anat_brain_ = self.segment(self.anat_)
@@ -164,19 +208,71 @@ class TemplateRegistrator(BaseRegistrator):
         if self.registration_kind == 'nonlinear':
             self._normalization_transforms = [normalization.transform,
                                               normalization.pretransform]
+            # Compose the warps once, to avoid AFNI recomposing them for
+            # every transformed image
+            self._composed_normalization_transforms = [
+                self._compose_normalization()]
         else:
             self._normalization_transforms = [normalization.pretransform]
+            self._composed_normalization_transforms = \
+                self._normalization_transforms
+        self._inverse_normalization_warp = None
 
         return self
 
+    def _compose_normalization(self, inverse=False):
+        """Composes the transforms from anatomical to template space into a
+        single warp dataset, saved in the output directory.
+        """
+        _, _, _, nwarp_cat = _transform_steps(
+            self.output_dir, caching=self.caching,
+            terminal_output=self.terminal_output)
+        return _compose_transforms(self._normalization_transforms,
+                                   self.output_dir, nwarp_cat,
+                                   transforms_kind=self.registration_kind,
+                                   inverse=inverse,
+                                   environ={'AFNI_DECONFLICT': 'OVERWRITE'})
+
+    def _get_inverse_transforms(self, coreg_transform_file):
+        """Returns the transforms chain from template space to the space of
+        the given coregistration transform, whether it must be inverted and
+        the name to give to its composition, or None to name it after the
+        last transform of the chain. For nonlinear registrations, the
+        inverse normalization warp is computed on the first call and reused
+        later.
+        """
+        if self.registration_kind != 'nonlinear':
+            return (self._normalization_transforms + [coreg_transform_file],
+                    True, None)
+
+        if self._inverse_normalization_warp is None:
+            self._inverse_normalization_warp = self._compose_normalization(
+                inverse=True)
+
+        inverse_coreg_transform_file = os.path.basename(coreg_transform_file)
+        if inverse_coreg_transform_file.endswith('.aff12.1D'):
+            inverse_coreg_transform_file = \
+                inverse_coreg_transform_file[:-len('.aff12.1D')]
+        composed_basename = inverse_coreg_transform_file + '_INV'
+        inverse_coreg_transform_file = _write_affine_transform(
+            _compose_affine_transforms([coreg_transform_file], inverse=True),
+            os.path.join(self.output_dir,
+                         composed_basename + '.aff12.1D'))
+        # The chains of all modalities end with the inverse normalization
+        # warp, so their compositions are named after the coregistration
+        return ([inverse_coreg_transform_file,
+                 self._inverse_normalization_warp], False, composed_basename)
+
     def transform_anat_like(self, in_file, interpolation='wsinc5'):
         """Transforms the given in_file from anatomical space to template
         space.
 
         Parameters
         ----------
-        in_file : str
-            Path to the file in the same space as the anatomical image.
+        in_file : str or list of str
+            Path to the file in the same space as the anatomical image. If a
+            list is given, the transforms are composed once and the files
+            are transformed in parallel.
 
         interpolation : one of {'nearestneighbour', 'trilinear', 'tricubic',
                                 'triquintic', 'wsinc5'}, optional
@@ -185,16 +281,28 @@ class TemplateRegistrator(BaseRegistrator):
 
         Returns
         -------
-        transformed_file : str
+        transformed_file : str or list of str
             Path to the transformed file, in template space.
         """
         self._check_anat_fitted()
 
+        if not isinstance(in_file, _basestring):
+            return _apply_transforms_to_many(
+                in_file,
+                self.template,
+                self.output_dir,
+                self._composed_normalization_transforms,
+                transforms_kind=self.registration_kind,
+                interpolation=interpolation,
+                caching=self.caching,
+                verbose=self.verbose,
+                n_jobs=self.n_jobs)
+
         transformed_file = _apply_transforms(
             in_file,
             self.template,
             self.output_dir,
-            self._normalization_transforms,
+            self._composed_normalization_transforms,
             transforms_kind=self.registration_kind,
             interpolation=interpolation,
             caching=self.caching,
@@ -315,17 +423,20 @@ class TemplateRegistrator(BaseRegistrator):
                 func_brain_file=brain_file,
                 reorient_only=reorient_only,
                 caching=self.caching,
-                verbose=self.verbose)
+                verbose=self.verbose,
+                n_jobs=self.n_jobs)
             self._func_undistort_warps = coregistration.coreg_warps_
             self.anat_in_func_space_ = coregistration.coreg_anat_
             self._func_to_anat_transform = coregistration.coreg_transform_
             self.undistorted_func_ = _apply_perslice_warp(
                 allineated_file, self._func_undistort_warps, .1, .1,
-                write_dir=self.output_dir, caching=self.caching)
+                write_dir=self.output_dir, caching=self.caching,
+                n_jobs=self.n_jobs)
 
             self.registered_func_ = _apply_transforms(
                 self.undistorted_func_, self.template, self.output_dir,
-                self._normalization_transforms + [self._func_to_anat_transform],
+                self._composed_normalization_transforms +
+                [self._func_to_anat_transform],
                 transforms_kind=self.registration_kind,
                 voxel_size=voxel_size, caching=self.caching)
         elif modality == 'perf':
@@ -337,7 +448,8 @@ class TemplateRegistrator(BaseRegistrator):
                 m0_brain_file=brain_file,
                 reorient_only=reorient_only,
                 caching=self.caching,
-                verbose=self.verbose)
+                verbose=self.verbose,
+                n_jobs=self.n_jobs)
             self.undistorted_perf_ = coregistration.coreg_m0_
             self._perf_undistort_warps = coregistration.coreg_warps_
             self.anat_in_perf_space_ = coregistration.coreg_anat_
@@ -345,13 +457,110 @@ class TemplateRegistrator(BaseRegistrator):
 
             self.registered_perf_ = _apply_transforms(
                 self.undistorted_perf_, self.template, self.output_dir,
-                self._normalization_transforms + [self._perf_to_anat_transform],
+                self._composed_normalization_transforms +
+                [self._perf_to_anat_transform],
                 transforms_kind=self.registration_kind,
                 voxel_size=voxel_size, caching=self.caching,
                 verbose=self.verbose)
 
         return self
 
+    def fit_many(self, anat_files, modality_files=None, modality='func',
+                 animal_ids=None, brain_mask_files=None,
+                 **fit_modality_kwargs):
+        """Estimates the registrations of several animals to the template.
+        The template brain is computed once, then the animals are processed
+        in parallel, each in its own subdirectory of the output directory.
+
+        Parameters
+        ----------
+        anat_files : list of str
+            Paths to the anatomical images.
+
+        modality_files : list of str or None, optional
+            Paths to the modality images, in the same order as the
+            anatomical images. If None, only the anatomical registrations
+            are estimated.
+
+        modality : one of {'func', 'perf'}, optional
+            Name of the modality.
+
+        animal_ids : list of str or None, optional
+            Animals ids, used to name the output subdirectories. If None,
+            animals are named 'animal000', 'animal001', ...
+
+        brain_mask_files : list of str or None, optional
+            Paths to the anatomical brain masks.
+
+        fit_modality_kwargs : extra keyword arguments
+            Extra keyword arguments passed to fit_modality, such as `t_r` or
+            `voxel_size`.
+
+        Returns
+        -------
+        registered_files : list of str
+            Paths to the registered modality images if `modality_files` is
+            given, or to the registered anatomical images otherwise, in the
+            same order as the inputs.
+
+        Notes
+        -----
+        The fitted per-animal registrators are stored in the
+        `registrators_` attribute.
+        """
+        n_animals = len(anat_files)
+        if animal_ids is None:
+            animal_ids = ['animal{0:03d}'.format(n) for n in range(n_animals)]
+        if brain_mask_files is None:
+            brain_mask_files = [None] * n_animals
+        if modality_files is None:
+            modality_files = [None] * n_animals
+        for name, values in [('animal_ids', animal_ids),
+                             ('brain_mask_files', brain_mask_files),
+                             ('modality_files', modality_files)]:
+            if len(values) != n_animals:
+                raise ValueError('`{0}` must have the same length as '
+                                 '`anat_files`, you provided {1} and {2} '
+                                 'elements'.format(name, len(values),
+                                                   n_animals))
+        if len(set(animal_ids)) != n_animals:
+            raise ValueError('`animal_ids` must be unique, you provided '
+                             '{}'.format(animal_ids))
+
+        self._fit()
+        self._fit_template()
+
+        # Each animal is processed serially within its worker
+        animal_registrators = []
+        for animal_id in animal_ids:
+            animal_registrator = clone(self)
+            animal_registrator.set_params(
+                output_dir=os.path.join(self.output_dir, animal_id),
+                n_jobs=1)
+            animal_registrators.append(animal_registrator)
+
+        self.registrators_ = _parallel_apply(
+            _fit_animal,
+            [dict(registrator=animal_registrator,
+                  template_brain=self.template_brain_,
+                  anat_file=anat_file,
+                  brain_mask_file=brain_mask_file,
+                  modality_file=modality_file,
+                  modality=modality,
+                  fit_modality_kwargs=fit_modality_kwargs)
+             for (animal_registrator, anat_file, brain_mask_file,
+                  modality_file) in zip(animal_registrators, anat_files,
+                                        brain_mask_files, modality_files)],
+            n_jobs=self.n_jobs)
+
+        if modality_files[0] is None:
+            registered_attribute = 'registered_anat_'
+        else:
+            registered_attribute = 'registered_{}_'.format(modality)
+
+        return [getattr(registrator, registered_attribute)
+                for registrator in self.registrators_]
+
     def transform_modality_like(self, in_file, modality,
                                 interpolation='wsinc5', voxel_size=None):
         """Transforms the given file from the space of the given modality to
@@ -360,8 +569,10 @@ class TemplateRegistrator(BaseRegistrator):
 
         Parameters
         ----------
-        in_file : str
-            Path to the file in the same space as the modality image.
+        in_file : str or list of str
+            Path to the file in the same space as the modality image. If a
+            list is given, the transforms are composed once and the files
+            are transformed in parallel.
 
         modality : one of {'func', 'perf'}
             Name of the modality.
@@ -377,7 +588,7 @@ class TemplateRegistrator(BaseRegistrator):
 
         Returns
         -------
-        transformed_file : str
+        transformed_file : str or list of str
             Path to the transformed file, in template space.
         """
         self._check_anat_fitted()
@@ -386,15 +597,30 @@ class TemplateRegistrator(BaseRegistrator):
             '_{}_undistort_warps'.format(modality))
         coreg_transform_file = self.__getattribute__(
             '_{}_to_anat_transform'.format(modality))
+        if not isinstance(in_file, _basestring):
+            undistorted_files = [
+                _apply_perslice_warp(modality_file, modality_undistort_warps,
+                                     .1, .1, write_dir=self.output_dir,
+                                     caching=self.caching, n_jobs=self.n_jobs)
+                for modality_file in in_file]
+            return _apply_transforms_to_many(
+                undistorted_files, self.template, self.output_dir,
+                self._composed_normalization_transforms +
+                [coreg_transform_file],
+                transforms_kind=self.registration_kind,
+                voxel_size=voxel_size, caching=self.caching,
+                verbose=self.verbose, n_jobs=self.n_jobs)
+
         undistorted_file = _apply_perslice_warp(in_file,
                                                 modality_undistort_warps,
                                                 .1,
                                                 .1,
                                                 write_dir=self.output_dir,
-                                                caching=self.caching)
+                                                caching=self.caching,
+                                                n_jobs=self.n_jobs)
         normalized_file = _apply_transforms(
             undistorted_file, self.template, self.output_dir,
-            self._normalization_transforms + [coreg_transform_file],
+            self._composed_normalization_transforms + [coreg_transform_file],
             transforms_kind=self.registration_kind,
             voxel_size=voxel_size, caching=self.caching, verbose=self.verbose)
         return normalized_file
@@ -405,8 +631,13 @@ class TemplateRegistrator(BaseRegistrator):
 
         Parameters
         ----------
-        in_file : str
-            Path to the file in the same space as the modality image.
+        in_file : str or list of str
+            Path to the file in template space. If a list is given, the
+            transforms are composed and inverted once and the files are
+            transformed in parallel.
+
+        modality : one of {'func', 'perf'}
+            Name of the modality.
 
         interpolation : one of {'nearestneighbour', 'trilinear', 'tricubic',
                                 'triquintic', 'wsinc5'}, optional
@@ -419,21 +650,34 @@ class TemplateRegistrator(BaseRegistrator):
 
         Returns
         -------
-        transformed_file : str
-            Path to the transformed file, in template space.
+        transformed_file : str or list of str
+            Path to the transformed file, in modality space.
         """
         self._check_anat_fitted()
         self._check_modality_fitted(modality)
         coreg_transform_file = self.__getattribute__(
             '_{}_to_anat_transform'.format(modality))
         modality_file = self.__getattribute__(modality + '_')
+        transforms, inverse, composed_basename = \
+            self._get_inverse_transforms(coreg_transform_file)
+
+        if not isinstance(in_file, _basestring):
+            return _apply_transforms_to_many(
+                in_file, modality_file, self.output_dir,
+                transforms,
+                transforms_kind=self.registration_kind,
+                inverse=inverse,
+                composed_basename=composed_basename,
+                interpolation=interpolation,
+                caching=self.caching,
+                verbose=self.verbose,
+                n_jobs=self.n_jobs)
 
         inverted_file = _apply_transforms(in_file, modality_file,
                                           self.output_dir,
-                                          self._normalization_transforms +\
-                                          [coreg_transform_file],
+                                          transforms,
                                           transforms_kind=self.registration_kind,
-                                          inverse=True,
+                                          inverse=inverse,
                                           interpolation=interpolation,
                                           caching=self.caching,
                                           verbose=self.verbose)
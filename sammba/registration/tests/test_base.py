@@ -1,6 +1,7 @@
 import os
 from nose import with_setup
-from nose.tools import assert_true
+from nose.tools import assert_true, assert_equal
+import numpy as np
 import nibabel
 from nilearn.datasets.tests import test_utils as tst
 from nilearn.image import index_img
@@ -25,3 +26,70 @@ def test_warp():
     assert_true(_check_same_fov(nibabel.load(registered_anat_oblique_file),
                                 func_img0))
     assert_true(os.path.isfile(mat_file))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_slice_and_merge():
+    func_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'func.nii.gz')
+    func_img = nibabel.load(func_file)
+    sliced_files = base._slice_img(func_file,
+                                   os.path.join(tst.tmpdir, 'func'))
+    assert_equal(len(sliced_files), func_img.shape[2])
+    assert_equal(os.path.basename(sliced_files[1]), 'func_slice_0001.nii')
+    slice_img = nibabel.load(sliced_files[1])
+    assert_equal(slice_img.shape,
+                 func_img.shape[:2] + (1,) + func_img.shape[3:])
+    np.testing.assert_array_almost_equal(
+        slice_img.affine.dot([0, 0, 0, 1]),
+        func_img.affine.dot([0, 0, 1, 1]))
+
+    merged_file = base._merge_slices(
+        sliced_files, os.path.join(tst.tmpdir, 'merged_func.nii.gz'))
+    merged_img = nibabel.load(merged_file)
+    np.testing.assert_array_almost_equal(merged_img.affine, func_img.affine)
+    np.testing.assert_array_almost_equal(merged_img.get_data(),
+                                         func_img.get_data())
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_compose_transforms():
+    shift = np.eye(4)
+    shift[:3, 3] = [1., 2., 3.]
+    scaling = np.diag([2., 2., .5, 1.])
+    shift_file = os.path.join(tst.tmpdir, 'shift.aff12.1D')
+    scaling_file = os.path.join(tst.tmpdir, 'scaling.aff12.1D')
+    for matrix, transform_file in zip([shift, scaling],
+                                      [shift_file, scaling_file]):
+        np.savetxt(transform_file, matrix[:3].reshape((1, 12)))
+
+    # A single transform is used as is
+    assert_equal(base._compose_transforms([shift_file], tst.tmpdir, None,
+                                          transforms_kind='affine'),
+                 shift_file)
+
+    composed_file = base._compose_transforms([shift_file, scaling_file],
+                                             tst.tmpdir, None,
+                                             transforms_kind='affine')
+    assert_equal(composed_file,
+                 os.path.join(tst.tmpdir, 'scaling_composed.aff12.1D'))
+    composed = np.eye(4)
+    composed[:3] = np.loadtxt(composed_file).reshape((3, 4))
+    np.testing.assert_array_almost_equal(composed, shift.dot(scaling))
+
+    inverse_file = base._compose_transforms([shift_file, scaling_file],
+                                            tst.tmpdir, None,
+                                            transforms_kind='affine',
+                                            inverse=True)
+    assert_equal(inverse_file,
+                 os.path.join(tst.tmpdir, 'scaling_composed_INV.aff12.1D'))
+    inverse = np.eye(4)
+    inverse[:3] = np.loadtxt(inverse_file).reshape((3, 4))
+    np.testing.assert_array_almost_equal(inverse.dot(composed), np.eye(4))
+
+    # Chains ending with the same transform can be named apart
+    assert_equal(base._compose_transforms([shift_file, scaling_file],
+                                          tst.tmpdir, None,
+                                          transforms_kind='affine',
+                                          inverse=True, out_basename='shift'),
+                 os.path.join(tst.tmpdir, 'shift_composed_INV.aff12.1D'))
@@ -72,7 +72,7 @@ def test_coregistrator():
 
     # Similarly with rigid body registration
     registrator = Coregistrator(output_dir=tst.tmpdir, use_rats_tool=False,
-                                verbose=False, brain_volume=400)
+                                verbose=False, brain_volume=400, n_jobs=2)
     registrator.fit_anat(anat_file)
 
     # Provide manual brain mask
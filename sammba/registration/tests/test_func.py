@@ -75,6 +75,22 @@ def test_fmri_sessions_to_template():
     assert_true(os.path.isfile(registered_data[0].registered_func_))
     assert_true(os.path.isfile(registered_data[0].registered_anat_))
 
+    # Check sessions processed in parallel are updated
+    sessions = [FMRISession(anat=anat_file, func=func_file,
+                            animal_id='parallel{}'.format(n))
+                for n in range(2)]
+    registered_data = func.fmri_sessions_to_template(sessions, t_r,
+                                                     template_file,
+                                                     tst.tmpdir,
+                                                     brain_volume,
+                                                     slice_timing=False,
+                                                     verbose=False,
+                                                     use_rats_tool=False,
+                                                     n_jobs=2)
+    for session in sessions:
+        assert_true(os.path.isfile(session.coreg_func_))
+        assert_true(os.path.isfile(session.registered_func_))
+
     assert_raises_regex(ValueError,
                         "'animals_data' input argument must be an iterable",
                         func.fmri_sessions_to_template, mammal_data, t_r,
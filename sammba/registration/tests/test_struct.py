@@ -1,6 +1,6 @@
 import os
 import numpy as np
-from nose.tools import assert_true
+from nose.tools import assert_true, assert_equal
 from nose import with_setup
 from numpy.testing import assert_array_almost_equal
 from nilearn._utils.testing import assert_raises_regex
@@ -21,6 +21,7 @@ def test_anats_to_common():
                         registration_kind='rigidd')
 
     # test common space of one image is itself
+    current_dir = os.getcwd()
     rigid = struct.anats_to_common(
         [anat_file], tst.tmpdir, 400, registration_kind='rigid', verbose=0,
         use_rats_tool=False)
@@ -28,6 +29,22 @@ def test_anats_to_common():
     assert_array_almost_equal(transform,
                               [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0])
 
+    # Check the working directory is untouched and outputs are written to
+    # the given directory
+    assert_equal(os.getcwd(), current_dir)
+    assert_equal(os.path.dirname(rigid.registered[0]), tst.tmpdir)
+
+    # Check a checkpointed rerun returns the recorded outputs
+    rigid = struct.anats_to_common(
+        [anat_file], tst.tmpdir, 400, registration_kind='rigid', verbose=0,
+        use_rats_tool=False, checkpoint=True)
+    assert_true(os.path.isfile(os.path.join(
+        tst.tmpdir, 'anats_to_common_checkpoints.json')))
+    rerun_rigid = struct.anats_to_common(
+        [anat_file], tst.tmpdir, 400, registration_kind='rigid', verbose=0,
+        use_rats_tool=False, checkpoint=True)
+    assert_equal(rerun_rigid.transforms, rigid.transforms)
+
 
 @with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
 def test_anat_to_template():
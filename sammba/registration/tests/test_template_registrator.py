@@ -1,6 +1,6 @@
 import os
 from nose import with_setup
-from nose.tools import assert_true
+from nose.tools import assert_true, assert_equal
 import numpy as np
 import nibabel
 from nilearn.datasets.tests import test_utils as tst
@@ -69,6 +69,91 @@ def test_fit_anat_and_transform_anat_like():
     assert_true(_check_same_fov(nibabel.load(transformed_file),
                                 nibabel.load(template_file)))
 
+    # test transform_anat_like on a list of files
+    anat_like_file2 = os.path.join(tst.tmpdir, 'anat_like2.nii.gz')
+    empty_img_like(anat_file, anat_like_file2)
+    registrator.n_jobs = 2
+    transformed_files = registrator.transform_anat_like(
+        [anat_like_file, anat_like_file2])
+    assert_equal(len(transformed_files), 2)
+    assert_equal(transformed_files[0], transformed_file)
+    for transformed_file in transformed_files:
+        assert_true(_check_same_fov(nibabel.load(transformed_file),
+                                    nibabel.load(template_file)))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_fit_many():
+    anat_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    template_file = os.path.join(tst.tmpdir, 'template.nii.gz')
+    crop_and_oblique(anat_file, template_file)
+    registrator = TemplateRegistrator(template_file, 400,
+                                      output_dir=tst.tmpdir,
+                                      use_rats_tool=False, verbose=False,
+                                      registration_kind='affine', n_jobs=2)
+    assert_raises_regex(
+        ValueError, '`animal_ids` must have the same length',
+        registrator.fit_many, [anat_file, anat_file], animal_ids=['a'])
+    assert_raises_regex(
+        ValueError, '`animal_ids` must be unique',
+        registrator.fit_many, [anat_file, anat_file],
+        animal_ids=['a', 'a'])
+
+    registered_files = registrator.fit_many([anat_file, anat_file],
+                                            animal_ids=['a', 'b'])
+    assert_equal(len(registrator.registrators_), 2)
+    for animal_id, registered_file, animal_registrator in zip(
+            ['a', 'b'], registered_files, registrator.registrators_):
+        assert_equal(animal_registrator.output_dir,
+                     os.path.join(tst.tmpdir, animal_id))
+        assert_equal(animal_registrator.template_brain_,
+                     registrator.template_brain_)
+        assert_equal(registered_file, animal_registrator.registered_anat_)
+        assert_true(_check_same_fov(nibabel.load(registered_file),
+                                    nibabel.load(template_file)))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_composed_normalization_warp():
+    anat_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    func_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'func.nii.gz')
+    template_file = os.path.join(tst.tmpdir, 'template.nii.gz')
+    crop_and_oblique(anat_file, template_file)
+    registrator = TemplateRegistrator(template_file, 400,
+                                      output_dir=tst.tmpdir,
+                                      use_rats_tool=False, verbose=False,
+                                      registration_kind='nonlinear')
+    registrator.fit_anat(anat_file)
+
+    # The normalization warps are composed once, in the output directory
+    assert_equal(len(registrator._composed_normalization_transforms), 1)
+    composed_warp = registrator._composed_normalization_transforms[0]
+    assert_equal(os.path.dirname(composed_warp), tst.tmpdir)
+    assert_true(os.path.isfile(composed_warp))
+    assert_true(registrator._inverse_normalization_warp is None)
+
+    anat_like_file = os.path.join(tst.tmpdir, 'anat_like.nii.gz')
+    empty_img_like(anat_file, anat_like_file)
+    transformed_file = registrator.transform_anat_like(anat_like_file)
+    assert_true(_check_same_fov(nibabel.load(transformed_file),
+                                nibabel.load(template_file)))
+
+    # The inverse warp is only computed when needed
+    registrator.fit_modality(func_file, 'func', slice_timing=False,
+                             reorient_only=True)
+    assert_true(registrator._inverse_normalization_warp is None)
+    inverse_transformed_file = registrator.inverse_transform_towards_modality(
+        transformed_file, 'func')
+    inverse_warp = registrator._inverse_normalization_warp
+    assert_true(os.path.isfile(inverse_warp))
+    assert_true(_check_same_fov(nibabel.load(inverse_transformed_file),
+                                nibabel.load(func_file)))
+    registrator.inverse_transform_towards_modality(transformed_file, 'func')
+    assert_equal(registrator._inverse_normalization_warp, inverse_warp)
+
 
 @with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
 def test_fit_transform_and_inverse_modality_with_func():
@@ -0,0 +1,111 @@
+import os
+from nose import with_setup
+from nose.tools import assert_equal
+import numpy as np
+from nilearn._utils.testing import assert_raises_regex
+from nilearn.datasets.tests import test_utils as tst
+from sammba.registration import utils
+
+
+def _write_index(index, out_basename):
+    with open(out_basename, 'w') as fp:
+        fp.write(str(index))
+    return os.path.abspath(out_basename), index
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_parallel_apply():
+    current_dir = os.getcwd()
+    kwargs_list = [dict(index=n,
+                        out_basename=os.path.join(tst.tmpdir,
+                                                  'out_{}.txt'.format(n)))
+                   for n in range(5)]
+    for n_jobs in [1, 2]:
+        outputs = utils._parallel_apply(_write_index, kwargs_list,
+                                        n_jobs=n_jobs)
+        # Check order is kept
+        assert_equal([index for (_, index) in outputs], list(range(5)))
+        for out_file, index in outputs:
+            assert_equal(out_file,
+                         os.path.join(tst.tmpdir, 'out_{}.txt'.format(index)))
+        # Check the working directory is never changed
+        assert_equal(os.getcwd(), current_dir)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_affine_transforms():
+    rotation = np.array([[0., -1., 0., 1.],
+                         [1., 0., 0., 2.],
+                         [0., 0., 1., 3.],
+                         [0., 0., 0., 1.]])
+    scaling = np.diag([2., 2., .5, 1.])
+    rotation_file = os.path.join(tst.tmpdir, 'rotation.aff12.1D')
+    scaling_file = os.path.join(tst.tmpdir, 'scaling.aff12.1D')
+    utils._write_affine_transform(rotation, rotation_file)
+
+    # Transforms saved by 3dAllineate have a comment line
+    with open(scaling_file, 'w') as fp:
+        fp.write('# 3dAllineate matrices (DICOM-to-DICOM, row-by-row):\n')
+        fp.write(' '.join([str(value) for value in scaling[:3].ravel()]))
+    np.testing.assert_array_almost_equal(
+        utils._read_affine_transform(rotation_file), rotation)
+    np.testing.assert_array_almost_equal(
+        utils._read_affine_transform(scaling_file), scaling)
+
+    composed = utils._compose_affine_transforms([rotation_file,
+                                                 scaling_file])
+    np.testing.assert_array_almost_equal(composed, rotation.dot(scaling))
+    inverted = utils._compose_affine_transforms([rotation_file,
+                                                 scaling_file],
+                                                inverse=True)
+    np.testing.assert_array_almost_equal(inverted.dot(composed), np.eye(4))
+
+    # Check an identical transform is not rewritten
+    os.utime(rotation_file, (0, 0))
+    utils._write_affine_transform(rotation, rotation_file)
+    assert_equal(os.path.getmtime(rotation_file), 0)
+    utils._write_affine_transform(scaling, rotation_file)
+    np.testing.assert_array_almost_equal(
+        utils._read_affine_transform(rotation_file), scaling)
+
+    with open(scaling_file, 'w') as fp:
+        fp.write('1 0 0 0 0 1 0 0')
+    assert_raises_regex(ValueError, 'does not hold a single affine',
+                        utils._read_affine_transform, scaling_file)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_checkpoints():
+    manifest_file = os.path.join(tst.tmpdir, 'checkpoints.json')
+    out_files = [os.path.join(tst.tmpdir, 'out_{}.txt'.format(n))
+                 for n in range(2)]
+    for out_file in out_files:
+        _write_index(0, out_file)
+    outputs = {'registered': out_files, 'mean': out_files[0]}
+    parameters = {'maxlev': 2}
+
+    # Nothing is recorded without manifest
+    utils._save_checkpoint(None, 'rigid', parameters, outputs)
+    assert_equal(utils._load_checkpoint(None, 'rigid', parameters), None)
+    assert_equal(utils._load_checkpoint(manifest_file, 'rigid', parameters),
+                 None)
+
+    utils._save_checkpoint(manifest_file, 'rigid', parameters, outputs)
+    utils._save_checkpoint(manifest_file, 'affine', parameters, outputs)
+    assert_equal(utils._load_checkpoint(manifest_file, 'rigid', parameters),
+                 outputs)
+    assert_equal(utils._load_checkpoint(manifest_file, 'rigid',
+                                        {'maxlev': 3}), None)
+
+    # Check changed outputs invalidate the stage
+    with open(out_files[1], 'w') as fp:
+        fp.write('changed')
+    assert_equal(utils._load_checkpoint(manifest_file, 'rigid', parameters),
+                 None)
+
+    # Check recording a stage again discards the following ones
+    utils._save_checkpoint(manifest_file, 'rigid', parameters, outputs)
+    assert_equal(utils._load_checkpoint(manifest_file, 'rigid', parameters),
+                 outputs)
+    assert_equal(utils._load_checkpoint(manifest_file, 'affine', parameters),
+                 None)
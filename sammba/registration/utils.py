@@ -0,0 +1,245 @@
+import os
+import json
+import numpy as np
+from joblib import Parallel, delayed
+from nilearn._utils.compat import _basestring
+from ..caching import _get_caching_environ, _set_caching_environ
+
+
+def _call_with_caching_environ(function, caching_environ, kwargs):
+    """ Calls the given function with the caching settings of the parent
+    process, which reused worker processes may not have inherited.
+    """
+    _set_caching_environ(caching_environ)
+    return function(**kwargs)
+
+
+def _parallel_apply(function, kwargs_list, n_jobs=1):
+    """ Calls a function once per set of keyword arguments, possibly in
+    parallel. The working directory is never changed, so the function must
+    only use absolute paths.
+
+    Parameters
+    ----------
+    function : callable
+        Function to apply, typically a nipype interface run method or a
+        per-animal processing helper.
+
+    kwargs_list : list of dict
+        Keyword arguments for each call.
+
+    n_jobs : int, optional
+        The number of processes to use. -1 means all CPUs. If 1, calls are
+        done serially within the current process.
+
+    Returns
+    -------
+    list of the function outputs, in the same order as `kwargs_list`.
+    """
+    if n_jobs == 1:
+        return [function(**kwargs) for kwargs in kwargs_list]
+
+    caching_environ = _get_caching_environ()
+    return Parallel(n_jobs=n_jobs)(
+        delayed(_call_with_caching_environ)(function, caching_environ, kwargs)
+        for kwargs in kwargs_list)
+
+
+def _read_affine_transform(transform_file):
+    """ Reads an AFNI affine transform file, stored as 12 numbers on one
+    line or as 3 lines of 4 numbers.
+
+    Parameters
+    ----------
+    transform_file : str
+        Path to the .aff12.1D file.
+
+    Returns
+    -------
+    numpy.ndarray of shape (4, 4)
+        The augmented transform matrix, in AFNI DICOM coordinates.
+    """
+    values = np.loadtxt(transform_file, comments='#', ndmin=1).ravel()
+    if values.size != 12:
+        raise ValueError('{0} does not hold a single affine transform, '
+                         'found {1} values'.format(transform_file,
+                                                   values.size))
+    matrix = np.eye(4)
+    matrix[:3] = values.reshape((3, 4))
+    return matrix
+
+
+def _write_affine_transform(matrix, transform_file):
+    """ Writes an augmented transform matrix as an AFNI one line affine
+    transform file. An existing file holding the same transform is not
+    written again, so that its timestamp is kept for caching.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray of shape (4, 4)
+        The augmented transform matrix.
+
+    transform_file : str
+        Path to the output .aff12.1D file.
+
+    Returns
+    -------
+    transform_file : str
+        Path to the written file.
+    """
+    line = ' '.join(['{:.9g}'.format(value)
+                     for value in np.ravel(matrix[:3])]) + '\n'
+    if os.path.isfile(transform_file):
+        with open(transform_file, 'r') as fp:
+            if fp.read() == line:
+                return transform_file
+
+    with open(transform_file, 'w') as fp:
+        fp.write(line)
+    return transform_file
+
+
+def _compose_affine_transforms(transform_files, inverse=False):
+    """ Composes affine transforms, as AFNI cat_matvec does.
+
+    Parameters
+    ----------
+    transform_files : list of str
+        Paths to .aff12.1D files. The resulting matrix is the product of the
+        matrices in the given order.
+
+    inverse : bool, optional
+        If True, the composed transform is inverted.
+
+    Returns
+    -------
+    numpy.ndarray of shape (4, 4)
+        The augmented composed transform matrix.
+    """
+    matrix = np.eye(4)
+    for transform_file in transform_files:
+        matrix = matrix.dot(_read_affine_transform(transform_file))
+
+    if inverse:
+        matrix = np.linalg.inv(matrix)
+
+    return matrix
+
+
+def _file_fingerprint(in_file):
+    """ Returns a cheap fingerprint of a file, made of its size and its
+    modification time.
+    """
+    stat = os.stat(in_file)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _list_files(outputs):
+    """ Lists the existing files among the values of a stage outputs
+    dictionary, whose values are paths or lists of paths.
+    """
+    files = []
+    for value in outputs.values():
+        if not isinstance(value, list):
+            value = [value]
+        files.extend([path for path in value
+                      if isinstance(path, _basestring) and
+                      os.path.isfile(path)])
+    return files
+
+
+def _load_checkpoint(manifest_file, stage, parameters):
+    """ Returns the recorded outputs of a completed pipeline stage.
+
+    Parameters
+    ----------
+    manifest_file : str or None
+        Path to the JSON checkpoint manifest. If None, checkpointing is
+        disabled.
+
+    stage : str
+        Name of the stage.
+
+    parameters : dict
+        JSON serializable parameters of the stage, which must match the
+        recorded ones.
+
+    Returns
+    -------
+    dict or None
+        The recorded stage outputs, or None if the stage has to be run, that
+        is if it has not been recorded, has been run with other parameters or
+        if any of its recorded files has changed since.
+    """
+    if manifest_file is None or not os.path.isfile(manifest_file):
+        return None
+
+    with open(manifest_file, 'r') as fp:
+        manifest = json.load(fp)
+
+    checkpoint = manifest.get(stage)
+    if checkpoint is None:
+        return None
+
+    if checkpoint['parameters'] != json.loads(json.dumps(parameters)):
+        return None
+
+    for path, fingerprint in checkpoint['fingerprints'].items():
+        if not os.path.isfile(path) or _file_fingerprint(path) != fingerprint:
+            return None
+
+    return checkpoint['outputs']
+
+
+def _save_checkpoint(manifest_file, stage, parameters, outputs,
+                     input_files=None):
+    """ Records the outputs of a completed pipeline stage, with the size and
+    modification time of its files. The stages recorded after the given one
+    are discarded, as they depend on its outputs.
+
+    Parameters
+    ----------
+    manifest_file : str or None
+        Path to the JSON checkpoint manifest. If None, nothing is done.
+
+    stage : str
+        Name of the stage.
+
+    parameters : dict
+        JSON serializable parameters of the stage.
+
+    outputs : dict
+        Paths or lists of paths to the stage outputs.
+
+    input_files : list of str or None, optional
+        Paths to input files not produced by previous stages, to be
+        fingerprinted too.
+    """
+    if manifest_file is None:
+        return
+
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as fp:
+            manifest = json.load(fp)
+
+    stages = list(manifest.keys())
+    if stage in stages:
+        for later_stage in stages[stages.index(stage):]:
+            manifest.pop(later_stage)
+
+    files = _list_files(outputs)
+    if input_files is not None:
+        files.extend([path for path in input_files if os.path.isfile(path)])
+
+    manifest[stage] = {
+        'parameters': parameters,
+        'outputs': outputs,
+        'fingerprints': dict([(path, _file_fingerprint(path))
+                              for path in files])}
+
+    # Write then rename, so that a crash never leaves a truncated manifest
+    tmp_manifest_file = manifest_file + '.tmp'
+    with open(tmp_manifest_file, 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.rename(tmp_manifest_file, manifest_file)
@@ -4,9 +4,9 @@ from scipy import ndimage, stats
 import nibabel
 from nilearn.image.resampling import (coord_transform,
                                       resample_img)
-from nipype.caching import Memory
 from nipype.interfaces import afni, fsl
 from nipype.utils.filemanip import fname_presuffix
+from ..caching import _get_memory
 from . import interfaces
 from ..preprocessing import afni_unifize
 from ..orientation import _check_same_geometry
@@ -162,6 +162,20 @@ def brain_extraction_report(head_file, brain_volume, write_dir=None,
     return report
 
 
+def _get_unifized_filename(head_file, write_dir, caching, unifize_kwargs):
+    """ Returns the path to the unifized image to mask. With caching and
+    no unifization options, the default output of afni_unifize is used,
+    so that the cached bias correction of the head image is not repeated.
+    """
+    if caching and not unifize_kwargs:
+        return None
+
+    unifization_options = ['{}_{}'.format(k, v)
+                           for (k, v) in unifize_kwargs.items()]
+    suffix = 'unifized_' + '_'.join(unifization_options)
+    return fname_presuffix(head_file, suffix=suffix, newpath=write_dir)
+
+
 def compute_morpho_brain_mask(head_file, brain_volume, write_dir=None,
                               unifize=True,
                               caching=False, verbose=True,
@@ -202,7 +216,7 @@ def compute_morpho_brain_mask(head_file, brain_volume, write_dir=None,
     environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         clip_level = memory.cache(afni.ClipLevel)
         compute_mask = memory.cache(interfaces.MathMorphoMask)
         compute_mask.interface().set_default_terminal_output(terminal_output)
@@ -217,15 +231,10 @@ def compute_morpho_brain_mask(head_file, brain_volume, write_dir=None,
         copy_geom = fsl.CopyGeom(terminal_output=terminal_output).run
 
     if unifize:
-        unifization_options = ['{}_{}'.format(k, v)
-                               for (k, v) in unifize_kwargs.items()]
-        suffix = 'unifized_' + '_'.join(unifization_options)
-
         file_to_mask = afni_unifize(
             head_file, write_dir,
-            out_file=fname_presuffix(head_file,
-                                     suffix=suffix,
-                                     newpath=write_dir),
+            out_file=_get_unifized_filename(head_file, write_dir, caching,
+                                            unifize_kwargs),
             caching=caching,
             terminal_output=terminal_output,
             verbose=verbose,
@@ -299,7 +308,7 @@ def compute_histo_brain_mask(head_file, brain_volume, write_dir=None,
 
     environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         clip_level = memory.cache(afni.ClipLevel)
         compute_mask = memory.cache(interfaces.HistogramMask)
     else:
@@ -307,14 +316,10 @@ def compute_histo_brain_mask(head_file, brain_volume, write_dir=None,
         compute_mask = interfaces.HistogramMask().run
 
     if unifize:
-        unifization_options = ['{}_{}'.format(k, v) for (k, v) in unifize_kwargs.items()]
-        suffix = 'unifized_' + '_'.join(unifization_options)
-
         file_to_mask = afni_unifize(
             head_file, write_dir,
-            out_file=fname_presuffix(head_file,
-                                     suffix=suffix,
-                                     newpath=write_dir),
+            out_file=_get_unifized_filename(head_file, write_dir, caching,
+                                            unifize_kwargs),
             caching=caching,
             verbose=verbose,
             terminal_output=terminal_output,
@@ -373,7 +378,7 @@ def _apply_mask(head_file, mask_file, write_dir=None,
         write_dir = os.path.dirname(head_file)
 
     if caching:
-        memory = Memory(write_dir)
+        memory = _get_memory(write_dir)
         apply_mask = memory.cache(fsl.ApplyMask)
         apply_mask.interface().set_default_terminal_output(terminal_output)
     else:
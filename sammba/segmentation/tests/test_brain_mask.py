@@ -23,6 +23,22 @@ def test_compute_histo_brain_mask():
                                 nibabel.load(head_file)))
 
 
+def test_get_unifized_filename():
+    head_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    write_dir = os.path.abspath('out')
+    assert_equal(brain_mask._get_unifized_filename(head_file, write_dir, True,
+                                                   {}),
+                 None)
+    # A non default clipping fraction must not share the default output
+    assert_equal(brain_mask._get_unifized_filename(head_file, write_dir, True,
+                                                   {'cl_frac': .2}),
+                 os.path.join(write_dir, 'anatunifized_cl_frac_0.2.nii.gz'))
+    assert_equal(brain_mask._get_unifized_filename(head_file, write_dir,
+                                                   False, {}),
+                 os.path.join(write_dir, 'anatunifized_.nii.gz'))
+
+
 @with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
 def test_get_mask_measures():
     # Create ellipsoid image
@@ -0,0 +1,191 @@
+import os
+import time
+from nose import with_setup
+from nose.tools import (assert_equal, assert_not_equal, assert_true,
+                        assert_false)
+from nose.plugins.skip import SkipTest
+from nipype import config
+from nipype.interfaces import afni
+from nipype.interfaces.utility import Rename
+from nilearn.datasets.tests import test_utils as tst
+from nilearn._utils.testing import assert_raises_regex
+from sammba import caching
+from sammba.registration.utils import _parallel_apply
+
+
+def _write(out_file, content):
+    with open(out_file, 'w') as fp:
+        fp.write(content)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_file_fingerprint():
+    in_file = os.path.join(tst.tmpdir, 'in.txt')
+    _write(in_file, 'a')
+    assert_raises_regex(ValueError, 'Fingerprint method must be one of',
+                        caching.file_fingerprint, in_file, method='md5')
+
+    methods = ['stat']
+    try:
+        import xxhash
+        methods.append('xxhash')
+    except ImportError:
+        pass
+
+    for method in methods:
+        fingerprint = caching.file_fingerprint(in_file, method=method)
+        assert_equal(caching.file_fingerprint(in_file, method=method),
+                     fingerprint)
+        # Check the memoised fingerprint is updated when the file changes
+        _write(in_file, 'ab')
+        assert_not_equal(caching.file_fingerprint(in_file, method=method),
+                         fingerprint)
+        _write(in_file, 'a')
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_set_fingerprint_method():
+    in_file = os.path.join(tst.tmpdir, 'in.nii.gz')
+    _write(in_file, 'a')
+    assert_raises_regex(ValueError, 'Fingerprint method must be one of',
+                        caching.set_fingerprint_method, 'md5')
+
+    hash_method = config.get('execution', 'hash_method')
+    tstat = afni.TStat(in_file=in_file)
+    default_hash = tstat.inputs.get_hashval()[1]
+    try:
+        caching.set_fingerprint_method('stat')
+        stat_hash = tstat.inputs.get_hashval()[1]
+        assert_not_equal(stat_hash, default_hash)
+        _write(in_file, 'b')
+        os.utime(in_file, (time.time() + 1, time.time() + 1))
+        assert_not_equal(tstat.inputs.get_hashval()[1], stat_hash)
+    finally:
+        caching.set_fingerprint_method(None)
+    assert_equal(config.get('execution', 'hash_method'), hash_method)
+
+    try:
+        import xxhash
+    except ImportError:
+        raise SkipTest('xxhash is not installed')
+    try:
+        caching.set_fingerprint_method('xxhash')
+        assert_equal(tstat.inputs.get_hashval()[0][0][1][1],
+                     caching.file_fingerprint(in_file, method='xxhash'))
+    finally:
+        caching.set_fingerprint_method(None)
+
+
+def _cached_rename(write_dir, in_file, format_string):
+    rename = caching._get_memory(write_dir).cache(Rename)
+    return rename(in_file=in_file,
+                  format_string=format_string).outputs.out_file
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_fingerprint_method_in_workers():
+    in_file = os.path.join(tst.tmpdir, 'in.txt')
+    _write(in_file, 'a')
+    # The output is written in the step directory, as nipype would hash an
+    # existing output path as a file input
+    kwargs = dict(write_dir=tst.tmpdir, in_file=in_file,
+                  format_string='out.txt')
+    try:
+        caching.set_fingerprint_method('stat')
+        _parallel_apply(_cached_rename, [kwargs], n_jobs=2)
+        # Check the step run by a worker is hit by the parent process
+        _cached_rename(**kwargs)
+    finally:
+        caching.set_fingerprint_method(None)
+    assert_equal(len(caching._get_cache_entries(tst.tmpdir)), 1)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_set_cache_dir():
+    cache_dir = os.path.join(tst.tmpdir, 'cache')
+    write_dirs = [os.path.join(tst.tmpdir, 'animal{}'.format(n))
+                  for n in range(2)]
+    for write_dir in write_dirs:
+        os.mkdir(write_dir)
+    in_file = os.path.join(tst.tmpdir, 'template.nii.gz')
+    _write(in_file, 'a')
+
+    assert_equal(caching.get_cache_dir(), None)
+    assert_equal(caching._get_memory(write_dirs[0]).base_dir,
+                 os.path.join(write_dirs[0], 'nipype_mem'))
+    assert_equal(caching._shared_write_dir([in_file], write_dirs[0]),
+                 write_dirs[0])
+    try:
+        caching.set_cache_dir(cache_dir)
+        assert_equal(caching.get_cache_dir(), cache_dir)
+        for write_dir in write_dirs:
+            assert_equal(caching._get_memory(write_dir).base_dir,
+                         os.path.join(cache_dir, 'nipype_mem'))
+
+        # Identical inputs and parameters share the same output directory
+        shared_dir = caching._shared_write_dir([in_file, None],
+                                               write_dirs[0],
+                                               voxel_size=(.1, .1, .1))
+        assert_true(os.path.isdir(shared_dir))
+        assert_true(shared_dir.startswith(cache_dir))
+        assert_equal(caching._shared_write_dir([in_file], write_dirs[1],
+                                               voxel_size=[.1, .1, .1]),
+                     shared_dir)
+        assert_not_equal(caching._shared_write_dir([in_file], write_dirs[0],
+                                                   voxel_size=(.2, .2, .2)),
+                         shared_dir)
+        # Check the directory is addressed by the file content
+        _write(in_file, 'b')
+        assert_not_equal(caching._shared_write_dir([in_file], write_dirs[0],
+                                                   voxel_size=(.1, .1, .1)),
+                         shared_dir)
+    finally:
+        caching.set_cache_dir(None)
+    assert_equal(caching.get_cache_dir(), None)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_prune_cache():
+    rename = caching._get_memory(tst.tmpdir).cache(Rename)
+    out_files = []
+    for n in range(3):
+        in_file = os.path.join(tst.tmpdir, 'in{}.txt'.format(n))
+        _write(in_file, 'a' * 1000 * (n + 1))
+        out_rename = rename(
+            in_file=in_file,
+            format_string=os.path.join(tst.tmpdir, 'out{}.txt'.format(n)))
+        out_files.append(out_rename.outputs.out_file)
+    entries = caching._get_cache_entries(tst.tmpdir)
+    assert_equal(len(entries), 3)
+
+    # Make the first step the least recently used and the last one too old
+    job_dirs = []
+    for n, out_file in enumerate(out_files):
+        job_dir = [entry['dir'] for entry in entries
+                   if out_file in entry['files']][0]
+        job_dirs.append(job_dir)
+        last_used = time.time() - [2, 1, 10][n] * 24 * 3600
+        os.utime(job_dir, (last_used, last_used))
+
+    assert_equal(caching.prune_cache(tst.tmpdir, max_age=5, dry_run=True,
+                                     verbose=False), [job_dirs[2]])
+    assert_true(os.path.isfile(out_files[2]))
+    assert_equal(caching.prune_cache(tst.tmpdir, max_age=5, verbose=False),
+                 [job_dirs[2]])
+    assert_false(os.path.exists(out_files[2]))
+    assert_false(os.path.exists(job_dirs[2]))
+
+    # Pinned outputs are kept whatever the budget
+    caching.pin_files([out_files[0], None], tst.tmpdir)
+    assert_equal(caching.prune_cache(tst.tmpdir, max_bytes=0, verbose=False),
+                 [job_dirs[1]])
+    assert_true(os.path.isfile(out_files[0]))
+    assert_true(os.path.isdir(job_dirs[0]))
+
+    # Check a cached call marks its step as used
+    in_file = os.path.join(tst.tmpdir, 'in0.txt')
+    out_rename = rename(in_file=in_file, format_string='copy.txt')
+    job_dir = os.path.dirname(out_rename.outputs.out_file)
+    os.utime(job_dir, (0, 0))
+    rename(in_file=in_file, format_string='copy.txt')
+    assert_true(os.path.getmtime(job_dir) > 0)
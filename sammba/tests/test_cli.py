@@ -0,0 +1,24 @@
+import os
+from nose import with_setup
+from nose.tools import assert_equal, assert_true
+from nilearn.datasets.tests import test_utils as tst
+from nilearn._utils.testing import assert_raises_regex
+from sammba import cli
+
+
+def test_parse_size():
+    assert_equal(cli._parse_size('500'), 500)
+    assert_equal(cli._parse_size('2k'), 2048)
+    assert_equal(cli._parse_size('1.5GB'), int(1.5 * 1024 ** 3))
+    assert_raises_regex(Exception, 'Size must be a number of bytes',
+                        cli._parse_size, '20X')
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_main():
+    out_file = os.path.join(tst.tmpdir, 'out.txt')
+    with open(out_file, 'w') as fp:
+        fp.write('a')
+    assert_equal(cli.main(['cache', 'prune', tst.tmpdir, '--max-size', '0',
+                           '--max-age', '30', '--dry-run']), 0)
+    assert_true(os.path.isfile(out_file))
@@ -1,8 +1,14 @@
 import os
+import shutil
+import nibabel
 from nose import with_setup
+from nose.tools import assert_true, assert_equal
 from nilearn.datasets.tests import test_utils as tst
 from nilearn._utils.testing import assert_raises_regex
-from sammba import graphs
+from nilearn._utils.niimg_conversions import _check_same_fov
+from sklearn.datasets.base import Bunch
+from sammba import graphs, testing_data
+from sammba.registration import struct
 
 
 @with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
@@ -20,3 +26,128 @@ def test_create_pipeline_graph():
     graph_file = os.path.join(tst.tmpdir, 'tmp_graph.png')
     graphs.create_pipeline_graph('anats_to_common_rigid', graph_file)
     assert(os.path.exists(graph_file))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_create_pipeline_workflow():
+    assert_raises_regex(NotImplementedError, 'Pipeline name must be one of',
+                        graphs.create_pipeline_workflow, 'rigid-body')
+
+    anat_files = []
+    for n in range(2):
+        anat_dir = os.path.join(tst.tmpdir, str(n))
+        os.makedirs(anat_dir)
+        anat_files.append(os.path.join(anat_dir, 'anat.nii.gz'))
+        open(anat_files[-1], 'w').close()
+
+    workflow = graphs.create_pipeline_workflow('anats_to_common_rigid',
+                                               anat_filenames=anat_files,
+                                               brain_volume=400)
+    # Check copied files have different names across individuals
+    assert_equal(workflow.get_node('copy').inputs.out_file,
+                 ['anat_0.nii.gz', 'anat_1.nii.gz'])
+    assert_true('allineate' not in workflow.list_node_names())
+    # Check equivalent bias corrections are not repeated
+    assert_true('bias_correct' not in workflow.list_node_names())
+    workflow = graphs.create_pipeline_workflow('anats_to_common_rigid',
+                                               anat_filenames=anat_files,
+                                               brain_volume=400,
+                                               unifize_kwargs={'urad': 18.3})
+    assert_true('bias_correct' in workflow.list_node_names())
+
+    # Check one non-linear registration node is created per iteration
+    workflow = graphs.create_pipeline_workflow(
+        'anats_to_common_nonlinear', anat_filenames=anat_files,
+        brain_volume=400, nonlinear_levels=[1, 2],
+        nonlinear_minimal_patches=[75])
+    node_names = workflow.list_node_names()
+    for n_iter in range(3):
+        assert_true('warp{}'.format(n_iter) in node_names)
+    assert_true('warp3' not in node_names)
+    assert_true('outputnode' in node_names)
+
+    # Check the references match those of anats_to_common
+    def source_names(node_name, input_name):
+        graph = workflow._graph
+        node = workflow.get_node(node_name)
+        return [source.name for source in graph.predecessors(node)
+                if any(connection[1] == input_name
+                       for connection in graph[source][node]['connect'])]
+
+    assert_equal(source_names('shift_rotate', 'reference'),
+                 ['average_centered_heads'])
+    assert_equal(source_names('apply_shift_rotate', 'master'),
+                 ['average_centered_heads'])
+    assert_equal(source_names('generate_union_mask', 'in_file'),
+                 ['concatenate_rigid_body_registered_brains'])
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_run_pipeline():
+    anat_files = []
+    for n in range(2):
+        anat_dir = os.path.join(tst.tmpdir, str(n))
+        os.makedirs(anat_dir)
+        anat_files.append(os.path.join(anat_dir, 'anat.nii.gz'))
+        open(anat_files[-1], 'w').close()
+
+    # Replace the execution by a record of the requested plugin
+    run_calls = []
+    output_node = Bunch(name='outputnode',
+                        result=Bunch(outputs=Bunch(registered=anat_files,
+                                                   transforms=['t0', 't1'])))
+
+    def mock_run(workflow, plugin=None, plugin_args=None):
+        run_calls.append((workflow.base_dir, plugin, plugin_args))
+        return Bunch(nodes=lambda: [Bunch(name='warp0'), output_node])
+
+    original_run = graphs.pe.Workflow.run
+    graphs.pe.Workflow.run = mock_run
+    try:
+        registration = graphs.run_pipeline(
+            'anats_to_common_rigid', anat_files, tst.tmpdir, 400)
+        assert_equal(registration.registered, anat_files)
+        assert_equal(registration.transforms, ['t0', 't1'])
+        graphs.run_pipeline('anats_to_common_rigid', anat_files, tst.tmpdir,
+                            400, n_jobs=3)
+        graphs.run_pipeline('anats_to_common_rigid', anat_files, tst.tmpdir,
+                            400, n_jobs=-1)
+    finally:
+        graphs.pe.Workflow.run = original_run
+
+    base_dir = os.path.abspath(tst.tmpdir)
+    assert_equal(run_calls, [(base_dir, 'Linear', None),
+                             (base_dir, 'MultiProc', {'n_procs': 3}),
+                             (base_dir, 'MultiProc', {})])
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_run_pipeline_as_anats_to_common():
+    anat_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    anat_files = []
+    for n in range(2):
+        anat_dir = os.path.join(tst.tmpdir, str(n))
+        os.makedirs(anat_dir)
+        anat_files.append(os.path.join(anat_dir, 'anat.nii.gz'))
+        shutil.copy(anat_file, anat_files[-1])
+
+    pipeline_dir = os.path.join(tst.tmpdir, 'pipeline')
+    rigid = graphs.run_pipeline('anats_to_common_rigid', anat_files,
+                                pipeline_dir, 400, use_rats_tool=False,
+                                verbose=0)
+    assert_equal(len(rigid.registered), 2)
+    assert_equal(len(rigid.transforms), 2)
+    for filename in rigid.registered + rigid.transforms:
+        assert_true(os.path.isfile(filename))
+
+    # Check the outputs match those of the imperative pipeline
+    struct_dir = os.path.join(tst.tmpdir, 'struct')
+    os.makedirs(struct_dir)
+    struct_rigid = struct.anats_to_common(
+        anat_files, struct_dir, 400, registration_kind='rigid', verbose=0,
+        use_rats_tool=False)
+    for registered_file, struct_registered_file in zip(
+            rigid.registered, struct_rigid.registered):
+        assert_true(_check_same_fov(nibabel.load(registered_file),
+                                    nibabel.load(struct_registered_file)))
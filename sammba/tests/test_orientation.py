@@ -1,5 +1,6 @@
 import os
 import shutil
+import numpy as np
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from nose.tools import assert_true, assert_false
 from nose import with_setup
@@ -75,6 +76,41 @@ def test_fix_obliquity():
                                           target_filename))
 
 
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_fix_obliquity_in_place():
+    target_filename = os.path.join(os.path.dirname(testing_data.__file__),
+                                   'anat.nii.gz')
+    target_img = nibabel.load(target_filename)
+    data = target_img.get_data()
+    img = nibabel.Nifti1Image(data, np.eye(4))
+    for extension in ['.nii', '.nii.gz']:
+        tmp_filename = os.path.join(tst.tmpdir,
+                                    'img_test_obliquity' + extension)
+        img.to_filename(tmp_filename)
+        assert_false(
+            orientation._check_same_obliquity(tmp_filename, target_filename))
+        tmp_filename_oblique = orientation.fix_obliquity(tmp_filename,
+                                                         target_filename)
+        assert_true(tmp_filename_oblique.endswith('_oblique' + extension))
+        assert_true(
+            orientation._check_same_obliquity(tmp_filename_oblique,
+                                              target_filename))
+        assert_array_equal(nibabel.load(tmp_filename_oblique).get_data(),
+                           data)
+
+    assert_raises_regex(ValueError,
+                        'Only uncompressed NIfTI files can be fixed',
+                        orientation.fix_obliquity, tmp_filename,
+                        target_filename, in_place=True)
+    tmp_filename = os.path.join(tst.tmpdir, 'img_test_obliquity.nii')
+    fixed_filename = orientation.fix_obliquity(tmp_filename, target_filename,
+                                               in_place=True)
+    assert_true(fixed_filename == tmp_filename)
+    assert_true(
+        orientation._check_same_obliquity(tmp_filename, target_filename))
+    assert_array_equal(nibabel.load(tmp_filename).get_data(), data)
+
+
 def test_check_same_geometry():
     img_filename1 = os.path.join(os.path.dirname(testing_data.__file__),
                                  'anat.nii.gz')
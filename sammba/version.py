@@ -48,7 +48,10 @@ REQUIRED_MODULE_METADATA = (
     ('nipype', {
         'min_version': '1.0.4',
         'required_at_installation': True,
-        'install_info': _SAMMBA_INSTALL_MSG})
+        'install_info': _SAMMBA_INSTALL_MSG}),
+    ('joblib', {
+        'min_version': '0.12',
+        'required_at_installation': False})
     )
     
 OPTIONAL_MATPLOTLIB_MIN_VERSION = '1.5.1'
@@ -83,4 +83,5 @@ if __name__ == "__main__":
           packages=find_packages(),
           package_data={'sammba.testing_data': ['*.nii.gz', '*.nii'],
                         'sammba.data_fetchers.description': ['*.rst']},
+          entry_points={'console_scripts': ['sammba = sammba.cli:main']},
           install_requires=install_requires,)